@@ -33,7 +33,7 @@ cp $confdir/config/gauss_3.0_7x7.conv .
 
 if [ $# -eq 5 ]; then dry=1; else dry=0; fi
 
-comm="python $pydir/cleanSky.py -l $1 -s $2 -f $3 -o $4 "
+comm="python $pydir/background_lib.py -l $1 -s $2 -f $3 -o $4 "
 echo $comm
 
 if [ $dry -eq 1 ]; then
@@ -110,7 +110,7 @@ stout=@REFMASK@   #DR5_${FILTER}
 refs=" -S ${stout}  -M zeroes.fits  "
 thresh=" --threshold 1.5 "   # in practice the default value
 args=" --inweight-suffix _weight.fits  --outweight-suffix $osuff  $thresh  \
-       --conf-path $confdir  -T 6 -v NORMAL "
+       --conf-path $confdir  -T 5 -v NORMAL "
 
 comm="python $pydir/mkMasks.py -l $list  $refs $args"
 logfile=$(echo $list | cut -d\. -f1)
@@ -3,10 +3,12 @@
 # 22.oct.12:  modified to work on new data for DR6; all filters combined;
 #             ==> remove filter dependency
 # 6.jun.23: modified to work on list of converted files and include bpm data
+# oct.26:   keywords read with fitshead_lib.py instead of dfits | fitsort
 #-----------------------------------------------------------------------------
 set -u
 
 export PATH=$PATH:/softs/dfits/bin
+pydir=${pydir:-$(dirname $0)/../python}
 
 echo "#-----------------------------------------------------------------------------"
 echo "## Build FileInfo.dat table"
@@ -15,7 +17,8 @@ echo "#-------------------------------------------------------------------------
 # J files are /n08data/UltraVista/DR6/J/images/origs/v2010011*.fits   v20100120*.fits 
 
 
-dfits -x1 $* | fitsort -d OBJECT FILTER IMRED_FF IMRED_MK STACK SKYSUB | \
+# keywords of ext 1, read directly from the headers (was dfits -x1 | fitsort -d)
+python $pydir/fitshead_lib.py -x 1 -k OBJECT,FILTER,IMRED_FF,IMRED_MK,STACK,SKYSUB $* | \
     sed -e 's/Done with //' -e 's/\[1\]/s/' -e 's/_st/_st.fits/' -e 's/\t/  /g' -e 's/   /  /g' \
 	> FileInfo_temp.dat
 
@@ -24,6 +24,9 @@ to modify other pipeline scripts.
 - bpm read from MIRED_MK in ext 0
 - sky read form SUBSKY in ext 4 (same for all exts.)
 - mean sky level read from SKYLEVEL or MEDSKLEV kwds (as in subAltSky.py), not recomputed
+Oct.18: the chips are processed in parallel (-T threads, within --mem-max MB)
+Oct.18: the image, bpm and sky of the next --prefetch images are read in the background while an
+        image is processed, and the outputs are written in the background
 '''
 
 import argparse
@@ -32,6 +35,8 @@ import astropy.io.fits as pyfits
 import numpy as np
 import numpy.ma as MA
 from logger_lib import setup_logger
+from mask_lib import bitmask
+from parallel_lib import chip_map, prefetch, async_writer, read_fits
 
 def get_parser():
     """
@@ -43,12 +48,38 @@ def get_parser():
 
     parser.add_argument('-o', '--osuff', dest='osuff', help='Suffix for sky added files (default = s.fits)', type=str, default='s.fits')
     parser.add_argument('-t', '--infotab', dest='infotab',  help='name of info table (def: fileinfo.txt)', type=str, default='fileinfo.txt')
+    parser.add_argument('-T', '--n-thread', dest='nproc', help='Number of chips processed in parallel (def: 1)', type=int, default=1)
+    parser.add_argument('--mem-max', dest='mem_max', help='Max memory (MB) for the chips processed in parallel (def: 0 = no limit)', type=int, default=0)
+    parser.add_argument('--prefetch', dest='nprefetch', help='Number of images read ahead, and written, in the background (def: 1; 0 = none)', type=int, default=1)
 
     # verbose options
     parser.add_argument('-v', '--verbose_level', dest='verbose_level', help='Verbose level (ERROR,WARNING,INFO,DEBUG)', type=str, default='INFO')
     parser.add_argument('--log', dest='flog', help='Log filename', type=str, default="addSky.log")
     return parser
 
+def add_chip(item):
+    """ Add the sky, less its level, to a chip, and set its bad pixels to 0 """
+    (data, sky, level, bpm) = item
+    data = data.astype('float32') + sky - level
+    # Not sure this final step is useful, but it's been there from the beginning.
+    # finally apply the mask to set masked pixels to nought
+    bitmask.from_array(bpm).apply(data)
+    return data
+
+def load_inputs(ima):
+    """ Read an image, its bpm and its sky (run in the background by prefetch) """
+    pyima = read_fits(ima)
+    bpm = pyima[0].header["IMRED_MK"]
+    # NB. the sky filename is the same for all extensions; the extension number 
+    #     in the SKYSUB kwd is not used here, only the file name.
+    sky = pyima[4].header["SKYSUB"]   
+    sky = sky[10:].split('[')[0]+'s'
+    return (pyima, bpm, read_fits(bpm), sky, read_fits(sky))
+
+def write_output(pyima, out):
+    pyima.writeto(out, overwrite=True)
+    pyima.close()
+
 def main(args):
     """
     Main fonction. Get the arguments from the args dictionary
@@ -67,43 +98,33 @@ def main(args):
         
     # Extract lists of skies and bpms from fileinfo table
     lines = os.popen("cat " + args.infotab).readlines()
-    for line in lines:
-        if line.strip()[0] == "#":
-            continue
-        ima = line.strip().split()[0]
+    images = [line.strip().split()[0] for line in lines if line.strip()[0] != "#"]
+    writer = async_writer(args.nprefetch)
+    for (ima, inputs) in prefetch(load_inputs, images, args.nprefetch):
         out = ima.replace(".fits", args.osuff)
-
-        pyima = pyfits.open(ima)
-        bpm = pyima[0].header["IMRED_MK"]
-        # NB. the sky filename is the same for all extensions; the extension number 
-        #     in the SKYSUB kwd is not used here, only the file name.
-        sky = pyima[4].header["SKYSUB"]   
-        sky = sky[10:].split('[')[0]+'s'
+        (pyima, bpm, pybpm, sky, pysky) = inputs
         logging.info("on %s with %s and %s"%(ima, bpm, sky))
-        # open the files
-        pybpm = pyfits.open(bpm)
-        pysky = pyfits.open(sky)
 
         n_ext = len(pyima)
-        for iext in range(n_ext - 1):
-#            print(iext+1, np.mean(pysky[iext+1].data))
-#            print(iext+1, np.median(pysky[iext+1].data))
+        exts = range(1, n_ext)
+        items = []
+        for ext in exts:
             # Get the median sky level from casu kwd
             # sometimes one, sometimes the other, sometines both ... va savoir!
             try: 
-                med2 = pysky[iext+1].header["SKYLEVEL"]
+                med2 = pysky[ext].header["SKYLEVEL"]
             except:
-                med2 = pysky[iext+1].header["MEDSKLEV"]
-    
-            pyima[iext + 1].data = pyima[iext + 1].data.astype('float32') + pysky[iext + 1].data - med2
-            # Not sure this final step is useful, but it's been there from the beginning.
-            # finally multiply by the mask to set masked pixels to nought
-            pyima[iext + 1].data = pyima[iext + 1].data * pybpm[iext + 1].data
-        pyima.writeto(out, overwrite=True)
+                med2 = pysky[ext].header["MEDSKLEV"]
+            items.append((pyima[ext].data, pysky[ext].data, med2, pybpm[ext].data))
+
+        nbytes = 16 * items[0][0].size if items else 0
+        for (ext, data) in zip(exts, chip_map(add_chip, items, args.nproc, mem_max=args.mem_max, nbytes=nbytes)):
+            pyima[ext].data = data
+        writer.submit(write_output, pyima, out)
     
-        pyima.close()
         pysky.close()
         pybpm.close()
+    writer.close()
 
 
 # Command line running
@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+"""
+Large-scale background of the chips, computed as SExtractor does it, in
+place of the  sex ... -CHECKIMAGE_TYPE -BACKGROUND  runs of subSky.py and
+subAltSky.py (and cleanSky.sh).
+
+The chip is cut into meshes of BACK_SIZE pixels.  In each mesh the pixels
+with a non-zero weight (the mask, as MAP_WEIGHT) are clipped at +-2 sigma
+around their mean, histogrammed, and the histogram clipped at +-3 sigma
+around its median until convergence; the level of the mesh is then the
+mode 2.5*median - 1.5*mean, or the median in crowded meshes (mesh_stats).
+Meshes with less than half of their pixels valid are replaced by the mean
+of the nearest valid ones, and the mesh map is median filtered over
+BACK_FILTERSIZE meshes (filter_meshes).  The background map is the bicubic
+spline interpolation of the mesh map, along y for each mesh column, then
+along x for each row (back_image), with the same pixel <-> mesh positions
+as SExtractor.
+
+All the meshes of a chip are processed together with array operations, and
+the chips of an image can be processed by several threads
+(subtract_backgrounds, with parallel_lib).
+
+Until it is validated against SExtractor on real data (-c below), the
+default engine of subSky.py, subAltSky.py and of the command line stays
+SExtractor itself (sex_backgrounds); the estimator above is the 'native'
+engine.
+
+Command line (cleanSky.sh), writes root + suffix + '.fits':
+   background_lib.py -l list -s 64 -f 3 -o _bgcln [-m _mask.fits] [-e sex|native] [-T nthread]
+and, to validate against SExtractor, compares the result of the native
+engine with its -BACKGROUND check images root + chksuf instead of writing
+it:
+   background_lib.py -l list -s 64 -f 3 -e native -c _chk.fits
+"""
+
+import os, sys
+import math
+import optparse
+from collections import OrderedDict
+import numpy
+import astropy.io.fits as pyfits
+from parallel_lib import chip_map
+
+BIG = 1e30
+NSIGMA = 5            # QUANTIF_NSIGMA: histogram range, in sigma
+NMAXLEVELS = 4096     # QUANTIF_NMAXLEVELS
+AMIN = 4              # QUANTIF_AMIN
+EPS = 1e-4
+
+
+def pair(size):
+    """ (width, height) from a size given as n or (w, h) """
+    if numpy.ndim(size) == 0:
+        return int(size), int(size)
+    return int(size[0]), int(size[1])
+
+
+def mesh_cube(arr, bw, bh, fill):
+    """ The meshes of a 2D array as a (nmesh, bh*bw) array, the partial
+    meshes at the top and right being padded with fill """
+    (h, w) = arr.shape
+    nx = (w - 1) // bw + 1
+    ny = (h - 1) // bh + 1
+    if (ny * bh, nx * bw) != arr.shape:
+        pad = numpy.full((ny * bh, nx * bw), fill, dtype=arr.dtype)
+        pad[:h, :w] = arr
+        arr = pad
+    return arr.reshape(ny, bh, nx, bw).transpose(0, 2, 1, 3).reshape(ny * nx, bh * bw)
+
+
+def first_ge(csum, rows, thr, lo, hi):
+    """ First column c in [lo, hi] of each row of csum (non-decreasing along
+    the rows) with csum[row, c] >= thr, hi if none """
+    lo = lo.copy()
+    hi = hi.copy()
+    while (lo < hi).any():
+        mid = (lo + hi) // 2
+        ge = csum[rows, mid] >= thr
+        hi = numpy.where(ge, mid, hi)
+        lo = numpy.where(ge, lo, mid + 1)
+    return lo
+
+
+def guess_levels(histo, nlevels, mean):
+    """ Clipped mean, median and sigma (in histogram bins) of the histograms
+    of the meshes (SExtractor backguess), iterated until sigma converges """
+    (nm, nl) = histo.shape
+    idx = numpy.arange(nl)
+    nlm1 = nlevels - 1
+    lcut = numpy.zeros(nm, dtype=numpy.int64)
+    hcut = nlm1.astype(numpy.int64)
+    sig = 10.0 * nlm1
+    sig1 = numpy.ones(nm)
+    mea = numpy.array(mean, dtype=numpy.float64)
+    med = mea.copy()
+    active = numpy.ones(nm, dtype=bool)
+    for n in range(100):
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            active &= (sig >= 0.1) & (numpy.abs(sig / sig1 - 1.0) > EPS)
+        act = numpy.nonzero(active)[0]
+        if len(act) == 0:
+            break
+        h = histo[act]
+        lc = lcut[act][:, None]
+        hc = hcut[act][:, None]
+        inr = (idx >= lc) & (idx <= hc)
+        hr = numpy.where(inr, h, 0)
+        csum = numpy.cumsum(hr, axis=1)
+        tot = csum[:, -1]
+
+        # median: the bins are taken alternately from both ends of [lcut,
+        # hcut], from the side with the lower sum, until they meet.  The i-th
+        # bin from the low end comes before the bins from the high end whose
+        # partial sum is <= its own, so the number of bins taken from the low
+        # end is the first i such that i + (number of those) >= nbin.
+        rows = numpy.arange(len(act))
+        lc = lc[:, 0]
+        hc = hc[:, 0]
+        nbin = numpy.maximum(hc - lc + 1, 0)
+        lo = numpy.zeros(len(act), dtype=numpy.int64)
+        hi = nbin.copy()
+        while (lo < hi).any():
+            mid = (lo + hi) // 2
+            col = numpy.minimum(lc + mid, nl - 1)
+            low = csum[rows, col] - hr[rows, col]
+            first = first_ge(csum, rows, tot - low, lc, numpy.maximum(hc, lc))
+            ok = mid + (hc + 1 - first) >= nbin
+            hi = numpy.where(ok, mid, hi)
+            lo = numpy.where(ok, lo, mid + 1)
+        ilow = lc + lo
+        lowsum = numpy.where(ilow > 0, csum[rows, numpy.clip(ilow - 1, 0, nl - 1)], 0)
+        highsum = tot - lowsum
+        ihigh = numpy.where(nbin > 0, ilow - 1, hc)
+        vlow = numpy.where(ilow < nl, h[rows, numpy.minimum(ilow, nl - 1)], 0)
+        vhigh = numpy.where(ihigh >= 0, h[rows, numpy.clip(ihigh, 0, nl - 1)], 0)
+        den = 2.0 * numpy.maximum(vlow, vhigh)
+        den[den == 0] = 1.0
+        med[act] = numpy.where(ihigh >= 0, ihigh + 0.5 + (highsum - lowsum) / den, 0.0)
+
+        s = tot.astype(numpy.float64)
+        m1 = (hr * idx).sum(axis=1).astype(numpy.float64)
+        m2 = (hr * (idx * idx.astype(numpy.float64))).sum(axis=1)
+        ss = numpy.maximum(s, 1)
+        m = numpy.where(s > 0, m1 / ss, 0.0)
+        var = numpy.where(s > 0, m2 / ss - m * m, 0.0)
+        mea[act] = m
+        sig1[act] = sig[act]
+        sig[act] = numpy.sqrt(numpy.maximum(var, 0.0))
+
+        lo = med[act] - 3.0 * sig[act]
+        hi = med[act] + 3.0 * sig[act]
+        lcut[act] = numpy.where(lo > 0.0, (lo + 0.5).astype(numpy.int64), 0)
+        hround = numpy.where(hi > 0.0, numpy.trunc(hi + 0.5), numpy.trunc(hi - 0.5)).astype(numpy.int64)
+        hcut[act] = numpy.where(hi < nlm1[act], hround, nlm1[act])
+    return mea, med, sig
+
+
+def mesh_stats(data, weight=None, bw=64, bh=64):
+    """ Background level and sigma of the meshes of a chip, as 2D (ny, nx)
+    arrays; -BIG for the meshes with less than half of their pixels valid
+    (finite, and with non-zero weight) """
+    data = numpy.asarray(data, dtype=numpy.float32)
+    (h, w) = data.shape
+    nx = (w - 1) // bw + 1
+    ny = (h - 1) // bh + 1
+    cube = mesh_cube(data, bw, bh, numpy.nan)
+    valid = numpy.isfinite(cube)
+    valid[valid] = cube[valid] > -BIG
+    if weight is not None:
+        valid &= mesh_cube(numpy.asarray(weight), bw, bh, 0) > 0
+    cube = numpy.where(valid, cube, 0)
+    mh = numpy.minimum(bh, h - numpy.arange(ny) * bh)
+    mw = numpy.minimum(bw, w - numpy.arange(nx) * bw)
+    bufsize = (mh[:, None] * mw[None, :]).ravel()
+
+    # mean and sigma, then again within +-2 sigma
+    vals = cube.astype(numpy.float64)
+    npix = valid.sum(axis=1)
+    nn = numpy.maximum(npix, 1)
+    mean = vals.sum(axis=1) / nn
+    sig = numpy.sqrt(numpy.maximum((vals * vals).sum(axis=1) / nn - mean * mean, 0.0))
+    bad = npix < bufsize // 2
+    lcut = (mean - 2.0 * sig).astype(numpy.float32)[:, None]
+    hcut = (mean + 2.0 * sig).astype(numpy.float32)[:, None]
+    sel = valid & (cube >= lcut) & (cube <= hcut)
+    vals = numpy.where(sel, vals, 0)
+    npix = sel.sum(axis=1)
+    nn = numpy.maximum(npix, 1)
+    mean = numpy.where(npix > 0, vals.sum(axis=1) / nn, 0.0)
+    sig = numpy.where(npix > 0, numpy.sqrt(numpy.maximum((vals * vals).sum(axis=1) / nn - mean * mean, 0.0)), 0.0)
+    del vals, sel
+
+    # histograms of the valid pixels over +-NSIGMA sigma
+    step = math.sqrt(2 / math.pi) * NSIGMA / AMIN
+    nlevels = numpy.minimum((step * npix + 1).astype(numpy.int64), NMAXLEVELS)
+    qscale = numpy.where(sig > 0, 2 * NSIGMA * sig / nlevels, 1.0).astype(numpy.float32)
+    qzero = (mean - NSIGMA * sig).astype(numpy.float32)
+    cste = (0.499999 - qzero / qscale).astype(numpy.float32)
+    nl = int(nlevels.max())
+    ibin = numpy.trunc(cube / qscale[:, None] + cste[:, None])
+    ok = valid & (ibin >= 0) & (ibin < nlevels[:, None])
+    code = numpy.nonzero(ok)[0] * nl + ibin[ok].astype(numpy.int64)
+    histo = numpy.bincount(code, minlength=len(npix) * nl).reshape(len(npix), nl)
+    del ibin, ok, code
+
+    mea, med, gsig = guess_levels(histo, nlevels, mean)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mode = numpy.where(numpy.abs((mea - med) / gsig) < 0.3, 2.5 * med - 1.5 * mea, med)
+    level = numpy.where(gsig > 0, qzero + mode * qscale, qzero + mea * qscale)
+    sigma = gsig * qscale
+    level[bad] = -BIG
+    sigma[bad] = -BIG
+    return level.reshape(ny, nx), sigma.reshape(ny, nx)
+
+
+def filter_meshes(back, fw=3, fh=3):
+    """ Replace the bad meshes (-BIG) by the mean of the nearest valid
+    ones, and median filter the mesh map over fw x fh meshes """
+    back = numpy.array(back, dtype=numpy.float64)
+    bad = back <= -BIG
+    if bad.any():
+        gy, gx = numpy.nonzero(~bad)
+        fill = back.copy()
+        for (py, px) in zip(*numpy.nonzero(bad)):
+            if len(gy) == 0:
+                fill[py, px] = 0.0
+                continue
+            d2 = (gx - px)**2 + (gy - py)**2
+            near = d2 == d2.min()
+            fill[py, px] = back[gy[near], gx[near]].mean()
+        back = fill
+
+    npx = fw // 2
+    npy = fh // 2
+    if npx == 0 and npy == 0:
+        return back
+    (ny, nx) = back.shape
+    pad = numpy.full((ny + 2 * npy, nx + 2 * npx), numpy.nan)
+    pad[npy:npy + ny, npx:npx + nx] = back
+    stack = [pad[dy:dy + ny, dx:dx + nx] for dy in range(2 * npy + 1) for dx in range(2 * npx + 1)]
+    return numpy.nanmedian(numpy.array(stack), axis=0)
+
+
+def spline_d2(vals, axis=0):
+    """ Second derivatives (divided by 6) of the natural cubic splines through
+    vals along axis, with unit spacing """
+    vals = numpy.moveaxis(numpy.asarray(vals, dtype=numpy.float64), axis, 0)
+    n = vals.shape[0]
+    d2 = numpy.zeros(vals.shape)
+    if n > 2:
+        mat = 4 * numpy.eye(n - 2) + numpy.eye(n - 2, k=1) + numpy.eye(n - 2, k=-1)
+        rhs = 6 * (vals[2:] - 2 * vals[1:-1] + vals[:-2])
+        d2[1:-1] = numpy.linalg.solve(mat, rhs.reshape(n - 2, -1)).reshape(rhs.shape) / 6.
+    return numpy.moveaxis(d2, 0, axis)
+
+
+def back_image(back, shape, bw=64, bh=64):
+    """ Background map of a chip of the given shape from its (ny, nx) mesh
+    map, by bicubic spline interpolation: node j of the mesh map is at
+    row y = (j + 0.5) * bh, and, but for the first mesh and a half, at
+    column x = (j + 0.5) * bw (at x + 0.5 before), as in SExtractor """
+    (ny, nx) = back.shape
+    (h, w) = shape
+    if ny > 1:
+        d2 = spline_d2(back, 0)
+        t = numpy.arange(h) / float(bh) - 0.5
+        k = numpy.clip(numpy.floor(t), 0, ny - 2).astype(int)
+        dy = (t - k)[:, None]
+        cdy = 1 - dy
+        node = cdy * back[k] + dy * back[k + 1] + (cdy**3 - cdy) * d2[k] + (dy**3 - dy) * d2[k + 1]
+    else:
+        node = numpy.repeat(back[:1], h, axis=0)
+
+    if nx == 1:
+        return numpy.repeat(node.astype(numpy.float32), w, axis=1)
+    dnode = spline_d2(node, 1)
+    x = numpy.arange(w, dtype=numpy.float64)
+    u = (x + 0.5) / bw - 0.5
+    if nx > 2:
+        late = x >= bw + bw // 2
+        u[late] = x[late] / bw - 0.5
+    k = numpy.clip(numpy.floor(u), 0, nx - 2).astype(int)
+    dx = u - k
+    cdx = 1 - dx
+    out = cdx * (node[:, k] + (cdx**2 - 1) * dnode[:, k]) + dx * (node[:, k + 1] + (dx**2 - 1) * dnode[:, k + 1])
+    return out.astype(numpy.float32)
+
+
+def background(data, weight=None, bsize=64, bfilt=3):
+    """ Background map of a chip (BACK_SIZE bsize, BACK_FILTERSIZE bfilt,
+    each n or (w, h)); pixels with weight 0 are not used """
+    (bw, bh) = pair(bsize)
+    (fw, fh) = pair(bfilt)
+    back = mesh_stats(data, weight, bw, bh)[0]
+    back = filter_meshes(back, fw, fh)
+    return back_image(back, numpy.shape(data), bw, bh)
+
+
+def subtract_background(data, weight=None, bsize=64, bfilt=3):
+    """ Background-subtracted chip (the -BACKGROUND check image), float32;
+    as in the check image, the pixels with weight 0 are blanked (-BIG) """
+    data = numpy.asarray(data, dtype=numpy.float32)
+    sub = data - background(data, weight, bsize, bfilt)
+    if weight is not None:
+        sub[numpy.asarray(weight) == 0] = -BIG
+    return sub
+
+
+def subtract_backgrounds(chips, weights=None, bsize=64, bfilt=3, nthread=1, mem_max=0):
+    """ Background-subtracted chips of an image, computed by nthread threads
+    (within mem_max MB if given) """
+    if weights is None:
+        weights = [None] * len(chips)
+    sub = lambda i: subtract_background(chips[i], weights[i], bsize, bfilt)
+    nbytes = 40 * numpy.size(chips[0]) if len(chips) else 0
+    return chip_map(sub, range(len(chips)), nthread, mem_max=mem_max, nbytes=nbytes)
+
+
+def sex_background(image, weight, out, bsize=64, bfilt=3, xml=None):
+    """ Run  sex image ... -CHECKIMAGE_TYPE -BACKGROUND -CHECKIMAGE_NAME out
+    with weight as WEIGHT_IMAGE (if given).  The configuration files
+    bgsub.conf, bgsub.param and gauss_3.0_7x7.conv are taken from the
+    current directory.  Returns the return code of sex. """
+    from subsky_sub import sextract2
+    (bw, bh) = pair(bsize)
+    (fw, fh) = pair(bfilt)
+    cparam = OrderedDict([('c', 'bgsub.conf'),
+                          ('CHECKIMAGE_TYPE', '-BACKGROUND'), ('CHECKIMAGE_NAME', out),
+                          ('BACK_SIZE', '%i,%i' % (bw, bh)), ('BACK_FILTERSIZE', '%i,%i' % (fw, fh))])
+    if weight is not None:
+        cparam['WEIGHT_IMAGE'] = weight
+    cparam['PARAMETERS_NAME'] = 'bgsub.param'
+    cparam['FILTER_NAME'] = 'gauss_3.0_7x7.conv'
+    cparam['CATALOG_TYPE'] = 'NONE'
+    cparam['INTERP_TYPE'] = 'NONE'
+    cparam['VERBOSE_TYPE'] = 'QUIET'
+    if xml:
+        cparam['WRITE_XML'] = 'Y'
+        cparam['XML_NAME'] = xml
+    else:
+        cparam['WRITE_XML'] = 'N'
+    return sextract2(image, cparam)
+
+
+def sex_backgrounds(chips, heads, weight, bsize=64, bfilt=3, scratch='.', root='bg', xml=None):
+    """ Background-subtracted chips computed by SExtractor (sex_background):
+    the chips (with headers heads) are written to a scratch MEF, and the
+    check image read back (float32); the scratch files are removed. """
+    from subsky_sub import mef_writer
+    sub = os.path.join(scratch, root + '_sub.fits')
+    bgs = os.path.join(scratch, root + '_bgs.fits')
+    with mef_writer(sub) as mef:
+        for (data, hd) in zip(chips, heads):
+            mef.add(data, hd)
+    sex_background(sub, weight, bgs, bsize, bfilt, xml)
+    os.remove(sub)
+
+    with pyfits.open(bgs) as pbgs:
+        exts = [0] if len(pbgs) == 1 else list(range(1, len(pbgs)))
+        out = [pbgs[ext].data.astype(numpy.float32) for ext in exts]
+    os.remove(bgs)
+    return out
+
+
+def compare_check(im, out, check):
+    """ Differences (max, rms) per chip with a SExtractor -BACKGROUND check
+    image, on the pixels that are not blanked (-1e30) in either, and number
+    of pixels blanked in only one of them """
+    with pyfits.open(check) as pchk:
+        for (i, sub) in enumerate(out):
+            ref = pchk[i + 1 if len(pchk) > 1 else 0].data
+            rblank = ref <= -BIG / 10
+            sblank = sub <= -BIG / 10
+            ok = numpy.isfinite(ref) & numpy.isfinite(sub) & ~rblank & ~sblank
+            diff = (sub - ref)[ok]
+            print('%s [%i]: max |diff| %0.4f  rms %0.4f  (%i pixels; %i blanked in one only)' %
+                  (im, i + 1, numpy.abs(diff).max(), numpy.sqrt((diff**2).mean()), ok.sum(), (rblank != sblank).sum()))
+
+
+# Command line running
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(usage="%prog -l list -s back_size -f back_filtersize -o suffix")
+    parser.add_option('-l', '--list', dest='flist', help='List of images', type='string', default='')
+    parser.add_option('-s', '--back-size', dest='bsize', help='BACK_SIZE (def: 64)', type='int', default=64)
+    parser.add_option('-f', '--back-filtersize', dest='bfilt', help='BACK_FILTERSIZE (def: 3)', type='int', default=3)
+    parser.add_option('-o', '--outname-suffix', dest='outsuf', help='Output name suffix (def: _bgcln)', type='string', default='_bgcln')
+    parser.add_option('-m', '--mask-suffix', dest='mask_suf', help='Mask (weight) suffix (def: _mask.fits)', type='string', default='_mask.fits')
+    parser.add_option('-e', '--engine', dest='engine', help='Background: sex (SExtractor) or native (def: sex)', type='choice', choices=['sex', 'native'], default='sex')
+    parser.add_option('-c', '--check-suffix', dest='chksuf', help='Compare the native engine with the SExtractor check images root+suffix', type='string', default='')
+    parser.add_option('-T', '--n-thread', dest='nthread', help='Number of threads (def: 1)', type='int', default=1)
+    parser.add_option('-D', '--dry', dest='dry', help='Dry mode; list what is to be done', action='store_true', default=False)
+    (options, args) = parser.parse_args()
+
+    files = list(args)
+    if options.flist != '':
+        files += [line.split()[0] for line in open(options.flist) if line.strip()]
+
+    if options.chksuf:
+        options.engine = 'native'
+    for im in files:
+        root = im.split('.fits')[0]
+        mask = root + options.mask_suf
+        out = root + options.outsuf + '.fits'
+        if not os.path.isfile(mask):
+            mask = None
+        if options.dry:
+            print('%s (weight %s) ==> %s' % (im, mask, options.chksuf and root + options.chksuf or out))
+            continue
+        if options.engine == 'sex':
+            if sex_background(im, mask, out, options.bsize, options.bfilt) != 0:
+                sys.exit(1)
+            print('%s ==> %s' % (im, out))
+            continue
+        with pyfits.open(im) as pim:
+            exts = [0] if len(pim) == 1 else list(range(1, len(pim)))
+            chips = [pim[ext].data for ext in exts]
+            weights = [None] * len(exts)
+            if mask is not None:
+                with pyfits.open(mask) as pmsk:
+                    weights = [pmsk[ext].data for ext in exts]
+            subs = subtract_backgrounds(chips, weights, options.bsize, options.bfilt, options.nthread)
+            if options.chksuf:
+                compare_check(im, subs, root + options.chksuf)
+                continue
+            if exts == [0]:
+                hdu = pyfits.PrimaryHDU(subs[0], header=pim[0].header)
+                hdu.writeto(out, overwrite=True)
+            else:
+                from subsky_sub import mef_writer
+                with mef_writer(out, pim[0].header) as mef:
+                    for (ext, sub) in zip(exts, subs):
+                        mef.add(sub, pim[ext].header)
+        print('%s ==> %s' % (im, out))
@@ -5,20 +5,10 @@
 
 import sys 
 import numpy as np
-import astropy.io.fits as pyfits
+from mask_lib import read_bitmasks
 
 for n in range(1, len(sys.argv)):
     ima = sys.argv[n]
-    pima  = pyfits.open(ima)
-    n_ext = len(pima)         # num extensions
-    if n_ext == 1: n_ext = 2  # to handle SEF files
-
-    nv = []  # 
-    for e in range(1, n_ext):
-        Npix = pima[e].header['NAXIS1'] * pima[e].header['NAXIS2']
-        
-        nv.append(100*len(np.where(pima[e].data == 1)[0])/Npix)
-        
-    pima.close()
+    nv = [100 * m.fraction() for m in read_bitmasks(ima, lambda d: d == 1)]
     ave = np.array(nv).mean()
     print("{:17s} ".format(ima.split('.')[0]), ' '.join(["{:6.2f}".format(x) for x in nv]), ' | {:6.2f}'.format(ave))
@@ -14,6 +14,8 @@ import astropy.io.fits as pyfits
 # our libs
 import convertim_lib
 from logger_lib import setup_logger
+from metacat_lib import header_cat
+from fitshead_lib import scan_file, get_key, has_key
 
 
 def get_survey_keyname(name):
@@ -39,6 +41,7 @@ def get_parser():
     # Keywords from stacks
     parser.add_argument('-s', '--stack_dir', dest='stack_dir', help='Stacks directory', type=str, default='./')
     parser.add_argument('--stack_addzp', dest='stack_addzp', help='Config files of ZP to copy from stacks', type=str, default='')
+    parser.add_argument('--meta_cat', dest='meta_cat', help='Header catalogue file (def: none, read the stacks)', type=str, default='')
     
 #    # Keywords from QC files
 #    parser.add_argument('-q', '--QCfiles', dest='QCfiles', help='List of QC files (fits)', type=str, default='')
@@ -183,6 +186,7 @@ def main(args):
     logging.info(">> Read keywords in stacks :")
     prog_pattern = re.compile(r'PROV(\d\d\d\d)')
     
+    hcat = header_cat(args.meta_cat) if args.meta_cat != "" else None
     for st in list_st:
         stname = st.split("/")[-1].replace(".fits", "")
     
@@ -190,30 +194,33 @@ def main(args):
         data_progenitors[stname] = []
     
         logging.debug("  -- %s" % st)
-        pyim = pyfits.open(st)
+        if hcat is not None:
+            headers = hcat.headers(st)
+        else:
+            headers = scan_file(st, None)
     
         # Get keywords
-        filter = pyim[0].header['HIERARCH ESO INS FILT1 NAME']
         for ikey in list_keystacks:
             okey = data_STkeys[ikey]
             vals = []
-            for i in range(len(pyim)):
-                if ikey in pyim[i].header:
-                    vals.append(pyim[i].header[ikey])
+            for hd in headers:
+                if has_key(hd, ikey):
+                    vals.append(get_key(hd, ikey))
             if len(vals) == 0:
                 logging.error("Big problem of keys %s in %s " % (ikey, st))
                 sys.exit(1)
             data_stacks[stname].append(vals)
     
         # Get progenitors
-        keys = pyim[1].header.keys()
+        keys = headers[1].keys()
         for k in keys: 
             match = prog_pattern.search(k)
             if match and match.group(1) != "0000":
-                v = pyim[1].header[k].split(".")[0]
+                v = headers[1][k].split(".")[0]
                 data_progenitors[stname].append(v)
     
-        pyim.close()
+    if hcat is not None:
+        hcat.close()
     
     #############
     # Real work #
@@ -4,6 +4,8 @@
 # Destriping ... destripe.py
 # Jun.18, AMo: using numpy
 # Aug.18, AMo: change method to median
+# Oct.18: use destripe_lib (NaN-aware medians, float32 output, chips in
+#         parallel); order and method (median or clipped mean) as options
 #-----------------------------------------------------------------------------
 # inputs: list of files, input and output suffix
 # output: destriped images
@@ -18,9 +20,9 @@
 
 import math,sys,re,os
 import numpy as np
-import numpy.ma as ma
 import astropy.io.fits as pyfits
 from optparse import OptionParser
+from destripe_lib import destripe_chips
 
 #-----------------------------------------------------------------------------
 
@@ -29,6 +31,9 @@ parser = OptionParser()
 parser.add_option('-l', '--list', dest='list', help='List of images', type='string', default="")
 parser.add_option('-i', '--isuf', dest='isuf', help='input suffix',   type='string', default="")
 parser.add_option('-o', '--osuf', dest='osuf', help='output suffix',  type='string', default="_des")
+parser.add_option('--order',  dest='order',  help='destriping order: yx (Y first) or xy', type='string', default="yx")
+parser.add_option('--method', dest='method', help='median or clip (clipped mean)', type='string', default="median")
+parser.add_option('-T', '--n-thread', dest='nproc', help='Number of threads', type='int', default=1)
 
 opts, args = parser.parse_args(sys.argv[1:])
 #-----------------------------------------------------------------------------
@@ -58,20 +63,11 @@ for line in lines:
     else:
         rr = range(1,17)
 
-    for i in rr:
-        data=pout[i].data; hdr=pout[i].header
-        mask=pmsk[i].data.astype(">i4")
-
-        # destripe along Y
-        marr = ma.array(data, mask=(1-mask))
-        mmx  = ma.median(marr, axis=0).astype(">i4")
-        data -= mmx
-
-        #destripe along X
-        marr = ma.array(data, mask=(1-mask))
-        mmy  = ma.median(marr, axis=1)
-        mmy  = mmy.reshape(data.shape[0],1).astype(">i4")
-        data -= mmy
+    chips = [pout[i].data for i in rr]
+    masks = [pmsk[i].data for i in rr]
+    res = destripe_chips(chips, masks, opts.nproc, opts.order, opts.method)
+    for (i, (data, prof)) in zip(rr, res):
+        pout[i].data = data
 
     pout.close()
     pmsk.close()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Destriping of the chips: the profile of the sky along the columns, then
+along the rows (or in the other order), is measured on the unmasked pixels
+and subtracted, in place, as done by destripe.py, subSky.py and
+subAltSky.py.
+
+The profile of each line is the median of its valid pixels (mask != 0 and
+finite values), or optionally their kappa-sigma clipped mean.  The medians
+of all the lines of a chip are computed with a single partition: the
+masked pixels are set to +inf, so that they go to the end of their line,
+and the array is partitioned at all the ranks needed by the lines (the
+middle ranks of their numbers of valid pixels).  Lines without valid
+pixels are left unchanged.
+
+The chips of an image can be processed by several threads
+(destripe_chips, with parallel_lib).
+"""
+
+import numpy
+from parallel_lib import chip_map
+
+AXES = {'y': 0, 'x': 1}     # destriping along Y: one value per column
+
+
+def line_medians(data, valid, axis=0):
+    """ Medians of the valid pixels of data along axis (0: one value per
+    column, 1: one per row); 0 where a line has no valid pixel """
+    vals = numpy.where(valid, data, numpy.float32(numpy.inf)).astype(numpy.float32)
+    if axis == 0:
+        vals = vals.T
+    n = valid.sum(axis=axis)
+    lo = numpy.maximum((n - 1) // 2, 0)
+    hi = n // 2
+    vals = numpy.partition(vals, numpy.unique(numpy.concatenate([lo, hi])), axis=1)
+    rows = numpy.arange(vals.shape[0])
+    med = 0.5 * (vals[rows, lo] + vals[rows, hi])
+    med[n == 0] = 0.
+    return med.astype(numpy.float32)
+
+
+def line_clipped_means(data, valid, axis=0, nsig=3.0, niter=3):
+    """ Kappa-sigma clipped means of the valid pixels of data along axis,
+    clipped niter times at nsig sigma around the mean; 0 where a line has no
+    valid pixel """
+    data = numpy.where(valid, data, 0).astype(numpy.float64)
+    keep = valid.copy()
+    for it in range(niter + 1):
+        n = keep.sum(axis=axis)
+        nn = numpy.maximum(n, 1)
+        vals = numpy.where(keep, data, 0)
+        mean = vals.sum(axis=axis) / nn
+        if it == niter:
+            break
+        sig = numpy.sqrt(numpy.maximum((vals * vals).sum(axis=axis) / nn - mean * mean, 0.))
+        mean = numpy.expand_dims(mean, axis)
+        sig = numpy.expand_dims(sig, axis)
+        keep &= numpy.abs(data - mean) <= nsig * sig
+    mean[n == 0] = 0.
+    return mean.astype(numpy.float32)
+
+
+def destripe(data, mask, order='yx', method='median', nsig=3.0, niter=3):
+    """ Destripe a chip along the axes given by order ('yx': along Y, i.e.
+    subtract the profile of the columns, then along X).  The chip is
+    updated in place if it is a native float32 array, else a float32 copy
+    is made.  Returns (data, profiles), profiles being the list of the
+    profiles subtracted (one per axis in order). """
+    data = numpy.asarray(data)
+    if data.dtype != numpy.float32 or not data.dtype.isnative:
+        data = data.astype(numpy.float32)
+    valid = numpy.asarray(mask) != 0
+    profiles = []
+    for ax in order:
+        axis = AXES[ax]
+        ok = valid & numpy.isfinite(data)
+        if method == 'median':
+            prof = line_medians(data, ok, axis)
+        elif method == 'clip':
+            prof = line_clipped_means(data, ok, axis, nsig, niter)
+        else:
+            raise ValueError("destripe: unknown method %s" % method)
+        if axis == 0:
+            data -= prof[None, :]
+        else:
+            data -= prof[:, None]
+        profiles.append(prof)
+    return data, profiles
+
+
+def destripe_chips(chips, masks, nthread=1, order='yx', method='median', nsig=3.0, niter=3, mem_max=0):
+    """ Destripe the chips of an image, nthread at a time (within mem_max MB
+    if given); returns the list of (data, profiles) of the chips """
+    run = lambda i: destripe(chips[i], masks[i], order, method, nsig, niter)
+    nbytes = 16 * numpy.size(chips[0]) if len(chips) else 0
+    return chip_map(run, range(len(chips)), nthread, mem_max=mem_max, nbytes=nbytes)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Fast reading of FITS header keywords.
+
+The headers are read directly as 2880-byte blocks, without building an
+astropy HDU list: the headers of the extensions before the one wanted are
+only scanned for the cards that give the size of their data unit, and the
+data units are skipped by seeking.  Only the cards of the keywords asked
+for are decoded.
+
+Keywords are given as in astropy (case insensitive, HIERARCH keywords with
+or without the HIERARCH prefix) and returned normalised by norm_key(); the
+values are bool, int, float, str, or None for an undefined value.  With
+keys=None all the cards are returned, COMMENT and HISTORY as lists of
+strings.
+
+Command line, in the place of dfits | fitsort -d:
+   fitshead_lib.py -x 1 -k OBJECT,FILTER,STACK file1.fits file2.fits ...
+"""
+
+import os, sys
+import re
+import optparse
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+BLOCK = 2880
+CARD = 80
+STRUCT_KEYS = ('BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT')
+naxis_re = re.compile(r'NAXIS\d+$')
+int_re = re.compile(r'[+-]?\d+$')
+
+
+def norm_key(key):
+    """ Normalise a keyword name: upper case, without the HIERARCH prefix
+    (as astropy reports HIERARCH keywords) """
+    key = key.strip().upper()
+    if key.startswith('HIERARCH '):
+        key = key[9:].strip()
+    return ' '.join(key.split())
+
+
+def parse_value(field):
+    """ Value of a card from its value field (after '= ') """
+    field = field.strip()
+    if field == '':
+        return None
+    if field[0] == "'":
+        # string: up to the single quote that is not doubled
+        i = 1
+        val = []
+        while i < len(field):
+            c = field[i]
+            if c == "'":
+                if i + 1 < len(field) and field[i + 1] == "'":
+                    val.append("'")
+                    i += 2
+                    continue
+                break
+            val.append(c)
+            i += 1
+        return ''.join(val).rstrip()
+    field = field.split('/')[0].strip()
+    if field == 'T':
+        return True
+    if field == 'F':
+        return False
+    if field == '':
+        return None
+    if int_re.match(field):
+        return int(field)
+    try:
+        return float(field.replace('D', 'E'))
+    except ValueError:
+        return field
+
+
+def parse_card(card):
+    """ (keyword, value field) of a card; the value field is None for
+    commentary cards """
+    if card[:9] == 'HIERARCH ':
+        ieq = card.find('=')
+        if ieq < 0:
+            return card[:8].rstrip(), None
+        return norm_key(card[9:ieq]), card[ieq + 1:]
+    key = card[:8].rstrip()
+    if card[8:10] == '= ':
+        return key, card[10:]
+    return key, None
+
+
+def read_hdu_header(fobj, keys=None):
+    """ Read the header at the current position of fobj.
+    Returns (cards, datasize): the cards of the keywords in keys (a set of
+    normalised names, None for all), and the size in bytes of the data unit
+    that follows, padded to a whole number of blocks. """
+    cards = OrderedDict()
+    struct = {}
+    last = None
+    while True:
+        block = fobj.read(BLOCK)
+        if len(block) < BLOCK:
+            raise IOError("Truncated FITS header in %s" % getattr(fobj, 'name', '?'))
+        if not isinstance(block, str):
+            block = block.decode('ascii', 'replace')
+        for i in range(0, BLOCK, CARD):
+            card = block[i:i + CARD]
+            key, field = parse_card(card)
+            if key == 'END':
+                size = 0
+                naxis = struct.get('NAXIS', 0)
+                if naxis > 0:
+                    size = 1
+                    for n in range(1, naxis + 1):
+                        size *= struct.get('NAXIS%i' % n, 0)
+                    size = abs(struct.get('BITPIX', 8)) // 8 * struct.get('GCOUNT', 1) * \
+                        (struct.get('PCOUNT', 0) + size)
+                return cards, (size + BLOCK - 1) // BLOCK * BLOCK
+            if field is not None and (key in STRUCT_KEYS or naxis_re.match(key)):
+                struct[key] = parse_value(field)
+            if key == 'CONTINUE' and last is not None:
+                # long string continued: remove the & and append
+                val = cards[last]
+                if isinstance(val, str) and val.endswith('&'):
+                    cards[last] = val[:-1] + parse_value(card[10:])
+                continue
+            last = None
+            if keys is not None and key not in keys:
+                continue
+            if field is None:
+                if key in ('COMMENT', 'HISTORY'):
+                    cards.setdefault(key, []).append(card[8:].rstrip())
+                continue
+            cards[key] = parse_value(field)
+            last = key
+
+
+def scan_file(path, exts=(0,), keys=None):
+    """ Headers exts of a file (exts=None: all), as a list of OrderedDicts
+    keyword -> value, restricted to the keywords in keys if given """
+    if keys is not None:
+        keys = set(norm_key(k) for k in keys)
+    headers = {}
+    with open(path, 'rb') as fobj:
+        fsize = os.fstat(fobj.fileno()).st_size
+        ext = 0
+        while fobj.tell() < fsize and (exts is None or ext <= max(exts)):
+            want = exts is None or ext in exts
+            cards, size = read_hdu_header(fobj, keys if want else set())
+            if want:
+                headers[ext] = cards
+            fobj.seek(size, 1)
+            ext += 1
+    if exts is None:
+        exts = range(len(headers))
+    for ext in exts:
+        if ext not in headers:
+            raise IndexError("Extension %i not found in %s" % (ext, path))
+    return [headers[ext] for ext in exts]
+
+
+def scan_files(files, keys, ext=0, nproc=8, missing='Nada'):
+    """ Values of keywords in header ext of a list of files, as a dictionary
+    of lists (as read_header in subsky_sub.py); the files are read by nproc
+    threads """
+    nkeys = [norm_key(k) for k in keys]
+    scan = lambda f: scan_file(f, (ext,), nkeys)[0]
+    if nproc > 1 and len(files) > 1:
+        pool = ThreadPool(min(nproc, len(files)))
+        headers = pool.map(scan, files)
+        pool.close()
+        pool.join()
+    else:
+        headers = [scan(f) for f in files]
+
+    data = {}
+    for k, nk in zip(keys, nkeys):
+        data[k] = [hd.get(nk, missing) for hd in headers]
+    return data
+
+
+def get_key(hd, key, default=None):
+    """ Value of a keyword in a header read by scan_file """
+    return hd.get(norm_key(key), default)
+
+
+def has_key(hd, key):
+    """ True if the keyword is in a header read by scan_file """
+    return norm_key(key) in hd
+
+
+# Command line running
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(usage="%prog [-x ext] -k keys files")
+    parser.add_option('-x', '--ext',  dest='ext',  help='Extension (def: 0)', type='int', default=0)
+    parser.add_option('-k', '--keys', dest='keys', help='Comma separated keywords to print', type='string', default='')
+    parser.add_option('-l', '--list', dest='flist', help='File with the list of files', type='string', default='')
+    parser.add_option('-T', '--n-thread', dest='nproc', help='Number of threads (def: 8)', type='int', default=8)
+    (options, args) = parser.parse_args()
+
+    files = list(args)
+    if options.flist != '':
+        files += [line.split()[0] for line in open(options.flist) if line.strip()]
+    keys = [k for k in options.keys.split(',') if k != '']
+
+    # fitsort -d like: filename and values, tab separated, no title line
+    data = scan_files(files, keys, options.ext, options.nproc, missing='')
+    fmt = lambda v: {True: 'T', False: 'F'}[v] if isinstance(v, bool) else str(v)
+    for i, f in enumerate(files):
+        print('\t'.join([f] + [fmt(data[k][i]) for k in keys]))
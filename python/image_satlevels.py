@@ -12,16 +12,20 @@
 # values to root_dataHisto.dat.
 # NB: takes about 20 sec per frame.
 # AMo - Oct.20
+# Oct.18: the stats and histograms of the chips are computed in parallel
+#         (nthread threads); the plotting is done in turn afterwards
 #-----------------------------------------------------------------------------
 
 import os,sys
 import numpy as np
 import astropy.io.fits as fits
 from scipy.stats import sigmaclip
+from parallel_lib import chip_map
 
 #-----------------------------------------------------------------------------
 
 plot = True
+nthread = 8     # chips processed in parallel
 path = os.getcwd(); 
 dire = path.split('/')[-1]  #; print(dire)
 
@@ -44,6 +48,22 @@ if plot == True:
     mpl.rcParams['ytick.labelsize'] = 8
     mpl.rcParams['xtick.minor.visible'] = True
 
+#-----------------------------------------------------------------------------
+# stats and histogram of a chip
+
+def chip_stats(item):
+    (data, weight) = item
+    # compute chip * weight and get min, max, and "mode"
+    arr = np.multiply(data, weight)
+    arr = arr.flatten()/1000.
+    arr = arr[arr.nonzero()]
+
+    mini = np.min(arr) ; maxi = np.max(arr) ; medi = np.median(arr)
+    # use sigmaclip to get mean sky level
+    sky,low,upp = sigmaclip(arr[(arr < 1.5*medi)], low=3, high=2); msky = np.mean(sky); ssky = np.std(sky)
+    hist, edges = np.histogram(arr, bins=111, range=(-0.25,55.25))
+    return mini, maxi, medi, msky, ssky, hist, edges
+
 #-----------------------------------------------------------------------------
 # verbose mode
 
@@ -98,20 +118,14 @@ for n in range(1, len(sys.argv)):
 
     ylim = [0.8,1e7]
     if verbose == True: print("chip  mini   medi   sky   rms    maxi")
-    for e in range(1,17):
-        # compute chip * weight and get min, max, and "mode"
-        arr = np.multiply(ima[e].data, wgt[e].data)
-        arr = arr.flatten()/1000.
-        arr = arr[arr.nonzero()]
-        
-        mini = np.min(arr) ; maxi = np.max(arr) ; medi = np.median(arr)
+    items = [(ima[e].data, wgt[e].data) for e in range(1,17)]
+    for e, res in zip(range(1,17), chip_map(chip_stats, items, nthread)):
+        (mini, maxi, medi, msky, ssky, hist, edges) = res
         ss.append(mini); bb.append(maxi); me.append(medi)
-        # use sigmaclip to get mean sky level
-        sky,low,upp = sigmaclip(arr[(arr < 1.5*medi)], low=3, high=2); msky = np.mean(sky); ssky = np.std(sky)
         ms.append(msky); sd.append(ssky)
 
         nny = int(nn/4) ; nnx = nn - 4*nny # subplot counter
-        hist, edges, pats = axs[nny, nnx].hist(arr, bins=111, range=(-0.25,55.25), log=True)
+        hist, edges, pats = axs[nny, nnx].hist(edges[:-1], bins=edges, weights=hist, log=True)
         bins = (edges[1:] + edges[:-1])/2.    #; print(edges); print(bins)
 
         # use center of second hisghest bin to estimage saturation
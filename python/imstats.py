@@ -3,11 +3,25 @@
 #-----------------------------------------------------------------------------
 # some basic stats for each extension:
 # - mean, median, min, max ... Num of zeroes values
+# Oct.18: the extensions are processed in parallel (nthread threads)
 #-----------------------------------------------------------------------------
 
 import sys  #, re, os
 import numpy as np
 import astropy.io.fits as pyfits
+from parallel_lib import chip_map
+
+nthread = 8     # extensions processed in parallel
+thresh = 9500
+
+def ext_stats(data):
+    loc = ((data > -thresh) & (data < thresh))
+    mean = np.mean(data[loc]); medi = np.median(data[loc])
+    mini = np.min(data[loc]); maxi = np.max(data[loc])
+    std  = np.std(data[loc])
+
+    loc = np.where(data == 0)[0]
+    return mean, medi, std, mini, maxi, len(loc)
 
 fmt = " {:2n} {:8.2f}  {:8.2f}   {:8.2f}   {:8.0f} {:8.0f}   {:6.2f}"
 print(len(fmt), fmt.replace("{:2n}","  "))
@@ -23,21 +37,14 @@ for n in range(1,len(sys.argv)):
     mmean = 0 ; mmedi = 0 ; mstd = 0 ; mmaxi = 0 ; mmini = 0 ; nzero = 0
     print("File: {:}; {:} extenstions".format(ima,n_ext))
     print("ext    mean      median    st.dev       min      max    %zeros")
-    thresh = 9500
-    for e in range(1, n_ext):
-        data = pima[e].data
-
-        loc = ((data > -thresh) & (data < thresh))
-        mean = np.mean(data[loc]); medi = np.median(data[loc])
-        mini = np.min(data[loc]); maxi = np.max(data[loc])
-        std  = np.std(data[loc])
-
-        loc = np.where(data == 0)[0]
-        nz = 100*len(loc)/2048/2048
+    exts = range(1, n_ext)
+    stats = chip_map(ext_stats, [pima[e].data for e in exts], nthread)
+    for e, (mean, medi, std, mini, maxi, nloc) in zip(exts, stats):
+        nz = 100*nloc/2048/2048
         print(fmt.format(e, mean, medi, std, mini, maxi, nz))
         mmean += mean ; mmedi += medi ; mstd += std
         mmini = np.min([mini, mmini]);  mmaxi = np.max([mmaxi, maxi])
-        nzero += len(loc)
+        nzero += nloc
 
     print(fmt.replace(" {:2n}","All").format(mmean/16, mmedi/16, mstd/16, mmini, mmaxi, nzero/16/2048/20.48))
     
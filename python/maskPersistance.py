@@ -9,10 +9,20 @@
 #------------------------------------------------------------------
 # AMo nov.17
 # AMo may.18: modified to overwrite input weight file
+# Oct.18: chips processed in parallel (nthread threads)
 
 import os,sys
 import numpy as np
 import astropy.io.fits as fits
+from mask_lib import bitmask
+from parallel_lib import chip_map
+
+nthread = 8     # chips processed in parallel
+
+def mask_chip(item):
+    (wgt, msk) = item
+    bitmask.from_array(msk == 0).apply(wgt)    # i.e. w *= 1-m
+
 
 #print(len(sys.argv))
 
@@ -45,8 +55,7 @@ for g in wlist:
     w = fits.open(wgt, mode='update')
     m = fits.open(msk)
     
-    for i in range(1,17):
-        w[i].data *= (1-m[i].data)
+    chip_map(mask_chip, [(w[i].data, m[i].data) for i in range(1,17)], nthread)
 
     w[0].header['history'] = 'Multiplied by persistance mask'
     w.close()
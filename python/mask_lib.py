@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+"""
+In-process combination of weight and flag maps into masks, in place of the
+WeightWatcher (ww) runs of subsky_sub.py.
+
+The thresholds are those of WeightWatcher: a pixel of a weight map outside
+[WEIGHT_MIN, WEIGHT_MAX] (or NaN) gets weight 0 in the output and the bits
+WEIGHT_OUTFLAGS in the output flags; a pixel of a flag map with one of the
+bits FLAG_WMASKS set gets weight 0, and the bits FLAG_OUTFLAGS if it has one
+of the bits FLAG_MASKS.  The output weight is 1 elsewhere, written as uint8.
+
+The inputs are combined chip by chip in a single pass, and can be files
+(MEF or single extension; a single extension file is used for all the
+chips, as the bad pixel mask), arrays, or functions ext -> array, so that
+e.g. the projected stack mask (reproj_lib) is combined without being
+written to disk:
+
+    mask_combiner().weight('zeroes.fits', 0.5, 1.5) \\
+                   .weight('im_ob.fits', -0.5, 1.e-15) \\
+                   .weight(lambda ext: projector.project(hd[ext]), 0.5, 1.5) \\
+                   .write('im_mask.fits')
+
+mask_combiner.from_wwpar() and ww_mask() take the same parameter
+dictionaries as the ww wrappers (bertin_param.get_ww*param + add_val);
+compare_masks() compares their masks with those made by ww.
+
+Masks held in memory (sky frame buffers, bpm and persistence masks applied
+to weights, valid fractions) use bitmask: 1 bit per pixel (512 KB for a
+2048x2048 chip), logical operations on the packed bytes, counts by table
+lookup, and expansion to a boolean array only where pixels are touched.
+"""
+
+import os
+import numpy
+import astropy.io.fits as pyfits
+from parallel_lib import chip_map
+
+NOT_SET = ('', '""', "''", 'NONE')
+POPCOUNT = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+
+class bitmask:
+    """ Boolean mask of a chip packed 8 pixels per byte (numpy.packbits).
+
+    bitmask.from_array(data) sets the pixels where data != 0 (or where a
+    boolean array is True); &, | and ~ work on the packed bytes; count() and
+    fraction() give the number and fraction of pixels set; array() expands
+    to a boolean array, apply(data) zeroes data where the mask is not set.
+    numpy sees a bitmask as a 0/1 array of the dtype of the original mask
+    (e.g. counts += mask), so it can stand in place of it. """
+
+    def __init__(self, bits, shape, dtype=numpy.uint8):
+        self.bits = bits
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.size = int(numpy.prod(self.shape))
+
+    @classmethod
+    def from_array(cls, data):
+        data = numpy.asarray(data)
+        good = data if data.dtype == bool else data != 0
+        return cls(numpy.packbits(good.ravel()), data.shape, data.dtype)
+
+    @classmethod
+    def full(cls, shape, value=True, dtype=numpy.uint8):
+        size = int(numpy.prod(shape))
+        bits = numpy.empty((size + 7) // 8, dtype=numpy.uint8)
+        bits.fill(0xff if value else 0)
+        return cls(bits, shape, dtype).clear_pad()
+
+    def clear_pad(self):
+        """ Clear the bits beyond the last pixel, so that counts are right """
+        if self.size % 8:
+            self.bits[-1] &= (0xff << (8 - self.size % 8)) & 0xff
+        return self
+
+    def check(self, other):
+        if self.shape != other.shape:
+            raise ValueError("bitmask: shapes %s and %s differ" % (self.shape, other.shape))
+
+    def __and__(self, other):
+        self.check(other)
+        return bitmask(self.bits & other.bits, self.shape, self.dtype)
+
+    def __or__(self, other):
+        self.check(other)
+        return bitmask(self.bits | other.bits, self.shape, self.dtype)
+
+    def __invert__(self):
+        return bitmask(~self.bits, self.shape, self.dtype).clear_pad()
+
+    def __iand__(self, other):
+        self.check(other)
+        self.bits &= other.bits
+        return self
+
+    def __ior__(self, other):
+        self.check(other)
+        self.bits |= other.bits
+        return self
+
+    def count(self):
+        """ Number of pixels set """
+        return int(POPCOUNT[self.bits].sum(dtype=numpy.int64))
+
+    def fraction(self):
+        """ Fraction of pixels set """
+        return self.count() / float(self.size) if self.size > 0 else 0.
+
+    def array(self):
+        """ The mask as a boolean array """
+        return numpy.unpackbits(self.bits)[:self.size].view(bool).reshape(self.shape)
+
+    def __array__(self, dtype=None):
+        return self.array().astype(dtype or self.dtype)
+
+    def apply(self, data, fill=0):
+        """ Set data to fill (in place) where the mask is not set """
+        data[~self.array()] = fill
+        return data
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+
+def read_bitmasks(filename, good=None, nproc=1):
+    """ Bitmasks of the chips of a (MEF or single image) mask file: of the
+    pixels != 0, or of good(data) if given; nproc chips at a time """
+    if good is None:
+        pack = bitmask.from_array
+    else:
+        pack = lambda data: bitmask.from_array(good(data))
+    with pyfits.open(filename, memmap=True) as hdus:
+        chips = [hdu.data for hdu in hdus if hdu.header.get('NAXIS', 0) == 2]
+        return chip_map(pack, chips, nproc)
+
+
+def read_conf(filename):
+    """ Parameters of a configuration file of the Bertin tools (KEY value,
+    comments after #), as a dictionary of strings """
+    par = {}
+    if not filename or not os.path.isfile(filename):
+        return par
+    for line in open(filename):
+        line = line.split('#')[0].split()
+        if len(line) >= 2:
+            par[line[0].upper()] = ' '.join(line[1:])
+    return par
+
+
+def par_list(par, key, conf, n, conv=float):
+    """ Comma separated values of key, from par or else from conf, converted
+    by conv; with n > 0, cut or padded to n values by repeating the last one """
+    val = str(par.get(key, conf.get(key, '')))
+    vals = [conv(v) for v in val.split(',') if v.strip() not in NOT_SET]
+    if n == 0:
+        return vals
+    if len(vals) == 0:
+        raise ValueError("mask_lib: no value given for %s" % key)
+    return (vals + vals[-1:] * n)[:n]
+
+
+def to_int(val):
+    return int(val, 0) if isinstance(val, str) else int(val)
+
+
+class mask_source:
+    """ One input of a mask_combiner: a file (opened at first use), an array
+    (or list of arrays, one per chip), or a function ext -> array """
+
+    def __init__(self, source):
+        self.source = source
+        self.hdus = None
+        self.exts = None
+
+    def is_file(self):
+        return isinstance(self.source, str)
+
+    def open(self):
+        if self.hdus is None:
+            self.hdus = pyfits.open(self.source, memmap=True)
+            self.exts = [i for i, h in enumerate(self.hdus) if h.header.get('NAXIS', 0) == 2]
+            if len(self.exts) == 0:
+                raise ValueError("mask_lib: no image in %s" % self.source)
+        return self.hdus
+
+    def nchip(self):
+        if not self.is_file():
+            return None
+        self.open()
+        return len(self.exts)
+
+    def hdu(self, ext):
+        hdus = self.open()
+        return hdus[self.exts[0] if len(self.exts) == 1 else ext]
+
+    def data(self, ext):
+        """ Data of chip ext (1-based for MEF files, 0 for single images) """
+        if self.is_file():
+            return self.hdu(ext).data
+        if callable(self.source):
+            return self.source(ext)
+        if isinstance(self.source, (list, tuple)):
+            return self.source[ext - 1] if len(self.source) > 1 else self.source[0]
+        return self.source
+
+    def header(self, ext):
+        if not self.is_file():
+            return None
+        return self.hdu(ext).header
+
+    def close(self):
+        if self.hdus is not None:
+            self.hdus.close()
+            self.hdus = None
+
+
+class mask_combiner:
+    """ Chainable combination of weight and flag maps into a uint8 mask
+    (1 = good), with WeightWatcher thresholds """
+
+    def __init__(self):
+        self.inputs = []
+
+    def weight(self, source, wmin, wmax, outflag=0):
+        """ Add a weight map: pixels outside [wmin, wmax] are rejected """
+        self.inputs.append(('weight', mask_source(source), (wmin, wmax, outflag)))
+        return self
+
+    def flag(self, source, wmask=0xff, fmask=0, outflag=0):
+        """ Add a flag map: pixels with bits wmask are rejected, those with bits
+        fmask get the output flags outflag """
+        self.inputs.append(('flag', mask_source(source), (to_int(wmask), to_int(fmask), to_int(outflag))))
+        return self
+
+    def replace(self, name, source):
+        """ Use source in the place of the input file name (e.g. an image
+        produced in memory instead of its file) """
+        for i, (kind, src, args) in enumerate(self.inputs):
+            if src.source == name:
+                src.close()
+                self.inputs[i] = (kind, mask_source(source), args)
+                return self
+        raise KeyError("mask_lib: %s is not an input" % name)
+
+    @classmethod
+    def from_wwpar(cls, par):
+        """ Combiner of the WEIGHT_* and FLAG_* parameters of a ww parameter
+        dictionary; the values missing from it are taken from its
+        configuration file (par['c']) """
+        conf = read_conf(par.get('c', ''))
+        if str(par.get('POLY_NAMES', conf.get('POLY_NAMES', ''))).strip() not in NOT_SET:
+            raise ValueError("mask_lib: POLY_NAMES are not supported, use ww")
+        self = cls()
+        names = par_list(par, 'WEIGHT_NAMES', conf, 0, str)
+        n = len(names)
+        for name, wmin, wmax, outflag in zip(names, par_list(par, 'WEIGHT_MIN', conf, n),
+                                             par_list(par, 'WEIGHT_MAX', conf, n),
+                                             par_list(par, 'WEIGHT_OUTFLAGS', conf, n, to_int)):
+            self.weight(name.strip(), wmin, wmax, outflag)
+        names = par_list(par, 'FLAG_NAMES', conf, 0, str)
+        n = len(names)
+        if n > 0:
+            for name, wmask, fmask, outflag in zip(names, par_list(par, 'FLAG_WMASKS', conf, n, to_int),
+                                                   par_list(par, 'FLAG_MASKS', conf, n, to_int),
+                                                   par_list(par, 'FLAG_OUTFLAGS', conf, n, to_int)):
+                self.flag(name.strip(), wmask, fmask, outflag)
+        return self
+
+    def exts(self):
+        """ Chips to combine: those of the MEF inputs, [0] if all the files
+        are single images """
+        nchip = [src.nchip() for (kind, src, args) in self.inputs if src.nchip() is not None]
+        nmax = max(nchip) if nchip else 1
+        for n in nchip:
+            if n not in (1, nmax):
+                raise ValueError("mask_lib: inputs with %i and %i chips" % (n, nmax))
+        return [0] if nmax == 1 else list(range(1, nmax + 1))
+
+    def combine(self, ext):
+        """ (mask, flags) of chip ext: mask is uint8, 1 where all the inputs
+        are good, flags the OR of the output flags of the rejected pixels """
+        good = None
+        flags = None
+        for (kind, src, args) in self.inputs:
+            data = src.data(ext)
+            if kind == 'weight':
+                with numpy.errstate(invalid='ignore'):
+                    bad = ~((data >= args[0]) & (data <= args[1]))
+                fbad = bad
+                fval = args[2]
+            else:
+                data = data.astype(numpy.int64, copy=False)
+                bad = (data & args[0]) != 0
+                fbad = (data & args[1]) != 0
+                fval = args[2]
+            if good is None:
+                good = ~bad
+                flags = numpy.zeros(bad.shape, dtype=numpy.int32)
+            else:
+                good &= ~bad
+            if fval:
+                flags[fbad] |= fval
+        return good.view(numpy.uint8), flags
+
+    def header(self, ext):
+        """ Header of the output chip: that of the first input file """
+        for (kind, src, args) in self.inputs:
+            if src.header(ext) is not None:
+                return src.header(ext)
+        return None
+
+    def write(self, outweight, outflag=None, cards={}):
+        """ Write the mask (and the flags if outflag is given), chip by chip;
+        cards[ext] are cards to add to the header of chip ext (e.g. the
+        astrometry of the image) """
+        from subsky_sub import mef_writer
+        exts = self.exts()
+        if exts == [0]:
+            mask, flags = self.combine(0)
+            hd = pyfits.Header()
+            if self.header(0) is not None:
+                for card in self.header(0).cards:
+                    if card.keyword not in mef_writer.struct_keys and not card.keyword.startswith('NAXIS'):
+                        hd.append(card)
+            for card in cards.get(0, []):
+                hd[card.keyword] = (card.value, card.comment)
+            pyfits.PrimaryHDU(mask, header=hd).writeto(outweight, overwrite=True)
+            if outflag:
+                pyfits.PrimaryHDU(flags, header=hd).writeto(outflag, overwrite=True)
+        else:
+            fout = mef_writer(outflag) if outflag else None
+            with mef_writer(outweight) as mout:
+                for ext in exts:
+                    mask, flags = self.combine(ext)
+                    mout.add(mask, self.header(ext), cards.get(ext, []))
+                    if fout is not None:
+                        fout.add(flags, self.header(ext), cards.get(ext, []))
+            if fout is not None:
+                fout.close()
+        self.close()
+
+    def close(self):
+        for (kind, src, args) in self.inputs:
+            src.close()
+
+
+def ww_mask(par, cards={}):
+    """ Run of ww with the parameters par (WEIGHT_*, FLAG_*, OUTWEIGHT_NAME,
+    OUTFLAG_NAME), in process """
+    outflag = str(par.get('OUTFLAG_NAME', '')).strip()
+    mask_combiner.from_wwpar(par).write(par['OUTWEIGHT_NAME'],
+                                        None if outflag in NOT_SET else outflag, cards)
+
+
+def compare_masks(ref, new):
+    """ Number of pixels of each chip that are good (> 0) in one of the masks
+    ref (e.g. made by ww) and new but not in the other; prints them and
+    returns the total """
+    ndiff = []
+    with pyfits.open(ref) as pref:
+        with pyfits.open(new) as pnew:
+            exts = [0] if len(pref) == 1 else range(1, len(pref))
+            for ext in exts:
+                ndiff.append(int(((pref[ext].data > 0) != (pnew[ext].data > 0)).sum()))
+    print(" >> check %s: %i pixels differ from %s %s" % (new, sum(ndiff), ref,
+          '' if sum(ndiff) == 0 else '(per chip: %s)' % ' '.join(str(n) for n in ndiff)))
+    return sum(ndiff)
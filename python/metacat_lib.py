@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""
+Persistent catalogue of FITS header keywords.
+
+The headers of the images are read once and kept in an SQLite database,
+keyed by the absolute path of the file; the entries of a file are dropped
+and read again when its modification time or size changes.  Scripts that
+need a few keywords of many images (read_header in subsky_sub.py, the stack
+keywords in convert_images.py, ...) query the catalogue instead of opening
+every file at each run.
+
+Only the headers that have been asked for are stored (e.g. only the primary
+header of the images for read_header), each as the list of its (keyword,
+value) cards, COMMENT/HISTORY excluded, compressed.
+
+NB. SQLite locking is not reliable over NFS: keep the catalogue on a local
+disk, or fill it (see the command line below) before starting parallel jobs
+that will only read it.
+
+Command line: fill the catalogue for a list of files and print keywords,
+fitsort-like:
+   metacat_lib.py -c headers.db -x 1 -k OBJECT,FILTER file1.fits file2.fits ...
+"""
+
+import os, sys
+import json, zlib, sqlite3
+import optparse
+from collections import OrderedDict
+from fitshead_lib import norm_key, scan_file, get_key, has_key
+
+
+class header_cat:
+    """ Catalogue of the headers of a set of FITS files, stored in an SQLite
+    database.  Headers are read from the files on first use, and whenever the
+    file has changed since (mtime or size differ); with check=False the
+    stored entries are trusted without looking at the files. """
+
+    def __init__(self, dbname, check=True):
+        self.dbname = dbname
+        self.check = check
+        self.db = sqlite3.connect(dbname, timeout=120)
+        self.db.execute('CREATE TABLE IF NOT EXISTS files '
+                        '(path TEXT PRIMARY KEY, mtime REAL, size INTEGER, nhdu INTEGER)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS headers '
+                        '(path TEXT, ext INTEGER, cards BLOB, PRIMARY KEY (path, ext))')
+        self.db.commit()
+        self.fresh = set()   # paths already checked in this session
+        self.cache = {}      # (path, ext) -> OrderedDict of cards
+        self.nread = 0       # number of files opened
+
+    def refresh(self, path):
+        """ Check the entries of path against the file, and drop them if it
+        has changed.  Returns the key of the file in the catalogue. """
+        key = os.path.abspath(path)
+        if key in self.fresh:
+            return key
+        row = self.db.execute('SELECT mtime, size FROM files WHERE path=?', (key,)).fetchone()
+        if row is None or self.check:
+            st = os.stat(path)
+            if row is None or row[0] != st.st_mtime or row[1] != st.st_size:
+                self.db.execute('DELETE FROM headers WHERE path=?', (key,))
+                self.db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?)',
+                                (key, st.st_mtime, st.st_size, None))
+                for k in [k for k in self.cache if k[0] == key]:
+                    del self.cache[k]
+        self.fresh.add(key)
+        return key
+
+    def store(self, key, ext, header):
+        """ Store one header, without its COMMENT/HISTORY cards """
+        cards = [(k, v) for (k, v) in header.items() if k not in ('COMMENT', 'HISTORY')]
+        blob = zlib.compress(json.dumps(cards).encode('ascii'))
+        self.db.execute('INSERT OR REPLACE INTO headers VALUES (?,?,?)',
+                        (key, ext, sqlite3.Binary(blob)))
+
+    def read_file(self, key, path, exts=None):
+        """ Read headers exts of the file (None: all of them) into the catalogue """
+        headers = scan_file(path, exts)
+        if exts is None:
+            exts = range(len(headers))
+            self.db.execute('UPDATE files SET nhdu=? WHERE path=?', (len(headers), key))
+        for ext, hd in zip(exts, headers):
+            self.store(key, ext, hd)
+        self.nread += 1
+
+    def load(self, key, ext):
+        """ Stored header, as an OrderedDict, or None """
+        if (key, ext) in self.cache:
+            return self.cache[(key, ext)]
+        row = self.db.execute('SELECT cards FROM headers WHERE path=? AND ext=?', (key, ext)).fetchone()
+        if row is None:
+            return None
+        hd = OrderedDict(json.loads(zlib.decompress(bytes(row[0])).decode('ascii')))
+        self.cache[(key, ext)] = hd
+        return hd
+
+    def header(self, path, ext=0):
+        """ Header ext of a file, as an OrderedDict keyword -> value """
+        key = self.refresh(path)
+        hd = self.load(key, ext)
+        if hd is None:
+            self.read_file(key, path, [ext])
+            hd = self.load(key, ext)
+        return hd
+
+    def headers(self, path):
+        """ All the headers of a file """
+        key = self.refresh(path)
+        nhdu = self.db.execute('SELECT nhdu FROM files WHERE path=?', (key,)).fetchone()[0]
+        hds = [] if nhdu is None else [self.load(key, ext) for ext in range(nhdu)]
+        if nhdu is None or None in hds:
+            self.read_file(key, path)
+            nhdu = self.db.execute('SELECT nhdu FROM files WHERE path=?', (key,)).fetchone()[0]
+            hds = [self.load(key, ext) for ext in range(nhdu)]
+        return hds
+
+    def read_keys(self, files, keys, ext=0, missing='Nada'):
+        """ Values of keywords in a list of files, as a dictionary of lists
+        (same as read_header in subsky_sub.py) """
+        nkeys = [norm_key(k) for k in keys]
+        data = {}
+        for k in keys:
+            data[k] = []
+        for f in files:
+            hd = self.header(f, ext)
+            for k, nk in zip(keys, nkeys):
+                data[k].append(hd.get(nk, missing))
+        self.commit()
+        return data
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+# Command line running
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(usage="%prog -c catalogue [-x ext] [-k keys] files")
+    parser.add_option('-c', '--cat',  dest='cat',  help='Catalogue file', type='string', default='headers.db')
+    parser.add_option('-x', '--ext',  dest='ext',  help='Extension (def: 0)', type='int', default=0)
+    parser.add_option('-k', '--keys', dest='keys', help='Comma separated keywords to print', type='string', default='')
+    parser.add_option('-l', '--list', dest='flist', help='File with the list of files', type='string', default='')
+    (options, args) = parser.parse_args()
+
+    files = list(args)
+    if options.flist != '':
+        files += [line.split()[0] for line in open(options.flist) if line.strip()]
+
+    cat = header_cat(options.cat)
+    keys = [k for k in options.keys.split(',') if k != '']
+    data = cat.read_keys(files, keys, options.ext, missing='')
+    cat.close()
+
+    if len(keys) > 0:
+        print('\t'.join(['FILE'] + keys))
+        for i, f in enumerate(files):
+            print('\t'.join([f] + [str(data[k][i]) for k in keys]))
+    sys.stderr.write("%i files, %i read from disk\n" % (len(files), cat.nread))
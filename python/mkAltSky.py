@@ -22,6 +22,37 @@
 #   replaced by a pure python method decribed above.
 # Aug.23, AMo:
 #   added check of unequal jitter_I kwd
+# Oct.26:
+# - streaming mode: loop on the extensions, and for each walk the targets in
+#   time order, keeping the masked sky chips in a ring buffer (see
+#   sky_frame_buffer in subsky_sub.py) so that each frame is read only once
+# - the buffered frames are normalised by their own sky level, so their stack
+#   median depends only on the sky list and is reused by targets sharing it;
+#   the sky of a target is then sky0 * median - sky0
+# - the median is updated incrementally from one target to the next: only the
+#   frames that enter or leave the sky list are inserted in / deleted from
+#   the sorted pixel values (see sliding_median in subsky_sub.py)
+# - the sky stack is float32 and frame-major; with --mem-max it is built by
+#   row tiles within the given memory (see combine_frames in subsky_sub.py)
+# - the -T/--n-thread option is used: the median is computed by that number
+#   of threads, or, with --par-ext, the chips are built in parallel
+# - with --meta-cat the keywords of the images are read from a persistent
+#   header catalogue (see metacat_lib.py) instead of opening every image
+# - with --sky-levels the median sky levels of the chips are read from /
+#   written to sidecar files (see skylevel_lib.py), which can be filled
+#   beforehand in parallel with skylevel_lib.py -l list -T n
+# - --rms and --var (formerly the doRMS / doVAR switches): the rms and
+#   variance maps come with the median from a single pass on the sorted
+#   values (see sorted_stats in subsky_sub.py)
+# - with --level-approx the sky levels are medians of a subsample of the
+#   chips, replaced by the exact median when uncertain by more than --level-tol
+# - with --prefetch the frames of the next target are read ahead in a
+#   background thread while the sky of a target is built (within the
+#   --n-buffer frames of the buffer), and the chips of the skies are written
+#   in the background
+# - the chips of the maps are written to single extension files (one writer
+#   per file, also with --par-ext), and merged in the _alt, _cnt, _rms and _var
+#   MEFs at the end, in place of updating copies of the image and mask
 #-----------------------------------------------------------------------------
 
 import math
@@ -30,8 +61,11 @@ import sys, re, os
 import astropy.io.fits as pyfits
 import numpy as np
 from subsky_sub import *
+from metacat_lib import header_cat
 import time
 import datetime
+from multiprocessing import Pool
+from parallel_lib import async_writer
 
 parser = OptionParser()
 
@@ -51,6 +85,8 @@ parser.add_option('-s', '--n-skies',  dest='nskies', help='Min num of images to
 parser.add_option('-t', '--time', dest='dtime', help='maximum time between source and sky image in mn (def: 30)', type='float', default="30.")
 parser.add_option('-d', '--dist', dest='dist',  help='maximum dist between source and sky image in arcmin (def: 1000)', type='float', default="1000.")
 parser.add_option('--pass2', dest='spass', help='Double pass skysub ?', action='store_true', default=False)
+parser.add_option('--mem-max', dest='mem_max', help='Max memory (MB) for the sky stack of one chip (def: 0 = no limit)', type='int', default="0")
+parser.add_option('--n-buffer', dest='nbuf', help='Number of sky frames kept in memory (def: 0 = 2 x n-images)', type='int', default="0")
 
 # not used by must leave in foc ompatibilty sith routines in subsky_sub.py
 parser.add_option('--n-cubes', dest='numcube', help='Number of cubes to build the sky (def: 5) ', type='int', default="0")
@@ -63,10 +99,19 @@ parser.add_option('--script-path', dest='spath', help='path for script files', t
 # Other
 parser.add_option('-v', '--verbose', dest='verbose', help='Verbose ...', action='store_true', default=False)
 parser.add_option('-T', '--n-thread', dest='nproc', help='Number of threads', type='int', default="1")
+parser.add_option('--prefetch', dest='nprefetch', help='Read the frames of the next target ahead (within --n-buffer), and write up to that number of chips, in the background (def: 0 = no)', type='int', default="0")
+parser.add_option('--par-ext', dest='par_ext', help='Build the extensions concurrently, one process each', action='store_true', default=False)
+parser.add_option('--sky-levels', dest='sky_levels', help='Keep the sky levels of the chips in sidecar files (see skylevel_lib.py)', action='store_true', default=False)
+parser.add_option('--level-dir', dest='level_dir', help='Directory of the sky level sidecars (def: with the images)', type='string', default="")
+parser.add_option('--level-approx', dest='level_approx', help='Approximate sky levels, on a subsample of the chips', action='store_true', default=False)
+parser.add_option('--level-tol', dest='level_tol', help='Max uncertainty (ADU) of the approximate levels, else exact (def: 0.5)', type='float', default=0.5)
+parser.add_option('--meta-cat', dest='metacat', help='Header catalogue file (def: none, read the images)', type='string', default="")
 parser.add_option('-D', '--dry',   dest='dry', help='Dry mode; list what is to be done', action='store_true', default=False)
 parser.add_option('-B', '--debug', dest='debug', help='Debuging mode ..', action='store_true', default=False)
 
 # Log
+parser.add_option('--rms',   dest='doRMS', help='Build the rms map of the sky stack (_rms.fits)', action='store_true', default=False)
+parser.add_option('--var',   dest='doVAR', help='Build the variance map of the sky stack (_var.fits)', action='store_true', default=False)
 parser.add_option('--npix',  dest='npix',  help='Compute hit count (def: no)', action='store_true', default=False)
 parser.add_option('--log',   dest='flog',  help='Log filename (def: subsky.log)', type='string', default="subsky.log")
 
@@ -74,8 +119,6 @@ parser.add_option('--log',   dest='flog',  help='Log filename (def: subsky.log)'
 print "#---------------------------------------------------------------------"
 #method = "subtract"
 method = "rescale"
-doRMS = False
-doVAR = False
 
 print "#####  Begin run of mkAltSky.py  ##### "
 
@@ -155,18 +198,22 @@ print "#### 1. Check images for number of available skies ..."
 print "#-----------------------------------------------------------------------------"
 
 newimlist=[]   
+skylists = {}      # sky list of each target
+mjdates  = {}      # and its date, to walk the targets in time order
 
 # Read some keywords
 keys = ['FILTER', 'MJDATE', 'RA_DEG', 'DEC_DEG', 'OBJECT', 'EXPTIME', 'SATURATE', 'FILENAME', 'SKYLEVEL', 'JITTER_I']
-data_sublist = read_header(sublist, keys)
-data_imlist  = read_header(imlist, keys)
+hcat         = header_cat(options.metacat) if options.metacat != "" else None
+data_sublist = read_header(sublist, keys, hcat)
+data_imlist  = read_header(imlist, keys, hcat)
 bertin_par   = bertin_param()
+sky_idx      = sky_index(sublist, data_sublist)    # to find the skies of each image
 
 # loop on the images of the list
 for (im, ind) in zip(imlist, range(len(imlist))):
 
     imroot = im.split(fitsext)[0]
-    skylist = get_skylist_dr6(im, ind, sublist, data_imlist, data_sublist, options)
+    skylist = get_skylist_dr6(im, ind, sublist, data_imlist, data_sublist, options, sky_idx)
 
     # check that sky list contains at least nskymin images
     if len(skylist) < options.nskies:
@@ -175,6 +222,8 @@ for (im, ind) in zip(imlist, range(len(imlist))):
 
     print(">> CHECK: {:}: found {:-2n} files to build sky".format(im, len(skylist)))
     newimlist.append(im)
+    skylists[im] = sorted(skylist)
+    mjdates[im]  = data_imlist['MJDATE'][ind]
 
 if (len(newimlist) == 0):
     print " ##"
@@ -188,138 +237,193 @@ if options.dry:
     print options
     print ""
     print " =====================   Finished dry mode check exiting   ===================== "                      
+    sys.exit(0)
+
+targets = sorted(newimlist, key=lambda x: mjdates[x])    # time order
+nbuf = options.nbuf
+if nbuf <= 0:
+    nbuf = 2 * options.numim
 
+tini = time.time()
 
 print "#-----------------------------------------------------------------------------"
-print "#### 2. Loop on images to build individual skies ...   "
+print "#### 2. Loop on extensions; build the skies of the targets in time order ...   "
 print "#-----------------------------------------------------------------------------"
-
-data_imlist = read_header(newimlist, keys)    # data of list with enough skies only
-for (im, ind) in zip(newimlist, range(len(newimlist))):
-
-    tini = time.time()
-    pima = pyfits.open(im) 
-
-    imroot = im.split(fitsext)[0]
-    imhead = imroot + headext
-    skylist = get_skylist_dr6(im, ind, sublist, data_imlist, data_sublist, options)
-    skylist = sorted(skylist)
-
-    print(" -- Begin working on {:} ... found {:} images to build sky:".format(im, len(skylist)))
-    altsky = im.split('.')[0] + '_alt.fits'   # name of alternative sky
-    mask   = im.split('.')[0] + '_mask.fits'  # name of input mask
-    count  = im.split('.')[0] + '_cnt.fits'   # name of counts map
-
-    print " -- initialize altsky map ", altsky
-    cmd="cp %s %s ; chmod 644 %s "%(im,altsky,altsky)  ; os.system(cmd)
-    palt = pyfits.open(altsky, mode="update")
-
-    if doRMS == True:
-        rms  = im.split('.')[0] + '_rms.fits'   # name of std dev map
-        print " -- initialize rms map    ", rms
-        cmd="cp %s %s ; chmod 644 %s "%(im,rms,rms)    ; os.system(cmd)
-        prms = pyfits.open(rms, mode="update")
-    if doVAR == True:
-        var  = im.split('.')[0] + '_var.fits'   # name of variance map
-        print " -- initialize rms map    ", var
-        cmd="cp %s %s ; chmod 644 %s "%(im,var,var)    ; os.system(cmd)
-        pvar = pyfits.open(var, mode="update")
-
-    print " -- initialize counts map ", count
-    cmd="cp %s %s ; chmod 644 %s "%(mask,count,count)  ; os.system(cmd)
-    pcnt = pyfits.open(count , mode="update")
-
-    print " -- open mask file        ", mask
-    pmsk = pyfits.open(mask)
-
-    print("#---------  Begin loop on the extensions ---------")
-    # ---------  Loop on the extensions ---------
-    for ext in exts:
-        sext = str(ext)
+print " -- INFO: keep up to %i sky frames in the buffer"%nbuf
+
+def ext_file(imroot, suf, ext):
+    """ Single extension file of chip ext of the map suf (_alt, _cnt, _rms,
+    _var) of a target """
+    return imroot + suf + '.%i.fits'%ext
+
+def write_ext(imroot, ext, maps):
+    """ Write chip ext of the maps (suf, data) of a target, each to its own
+    single extension file: the process building ext is the only one to
+    write them.  They are merged in the MEFs once all the chips are built
+    (merge_maps). """
+    for (suf, data) in maps:
+        pyfits.PrimaryHDU(data).writeto(ext_file(imroot, suf, ext), overwrite=True)
+
+def merge_maps(imroot, suf, src, header=None):
+    """ Merge the single extension files of the map suf of a target into
+    imroot + suf + '.fits', with the extension headers of src and its primary
+    header (or header), and remove them """
+    parts = [ext_file(imroot, suf, ext) for ext in exts]
+    with pyfits.open(src) as psrc:
+        if header is None:
+            header = psrc[0].header
+        with mef_writer(imroot + suf + '.fits', header) as mef:
+            for (ext, part) in zip(exts, parts):
+                with pyfits.open(part) as pi:
+                    mef.add(pi[0].data, psrc[ext].header)
+    for part in parts:
+        os.remove(part)
+
+def build_ext(ext):
+    """ Build extension ext of the skies of all the targets """
+    text = time.time()
+    levels = None
+    if options.sky_levels or options.level_approx:
+        levels = level_cache_opt(options)
+        levels.store = options.sky_levels
+    buf  = sky_frame_buffer(ext, nbuf, inmask_suf, method, levels)   # normalised sky frames
+    memo = sky_set_memo()                                    # their medians by sky list
+    slide = sliding_median(options.numim, nproc=nthread)     # sorted pixel values of current sky list
+
+    # the sorted values take 4 bytes per pixel per frame: if that exceeds the 
+    # memory limit build each median by row tiles instead
+    npix  = buf.get(targets[0])[0].size
+    tiled = options.mem_max > 0 and 4. * options.numim * npix > options.mem_max * 1024. * 1024.
+
+    writer = async_writer(options.nprefetch)
+    for (i, im) in enumerate(targets):
+        imroot  = im.split(fitsext)[0]
+        skylist = skylists[im]
+
+        # read the frames of the next target in the background
+        if options.nprefetch > 0 and i+1 < len(targets):
+            nxt = targets[i+1]
+            buf.prefetch([nxt] + skylists[nxt], [im] + skylist)
 
         # median sky level of source file
-        sky0 = pima[ext].data                       # the source file
-        sky0[pmsk[ext].data == 0] = np.nan
-        sky0 = np.nanmedian(sky0)                   # determine the median
-        print(" - ext {:-2n}: source sky level: {:0.0f} ".format(ext, sky0))
-        if options.dry:
-            print " >>>> Dry mode: swarp params to build 1st sky ext <<<<< "
-            print args 
-            print " =====================   Finished dry mode check exiting   ===================== "   
-            sys.exit(0)
-
-#        print("## Build alt-sky for {:}; sky level: {:0.0f} ".format(im, sky0))
-        cube = np.zeros((2048,2048,len(skylist)) )
-        xx0 = 624; yy0 = 1028
-        for n in range(len(skylist)):
-            rr = skylist[n].split('.')[0]
-            ss = pyfits.open(skylist[n])             # sky file
-            mm = pyfits.open(rr + '_mask.fits')      # sky mask file
-
-            data = ss[ext].data                      # the sky data
-            data[mm[ext].data == 0] = np.nan         # apply the mask: masked regions set to NaN
-            medi = np.nanmedian(data.flatten())      # internal estimate of sky level
-
-            # sky data cube 
-            if (method == 'subtract'):
-                cube[:,:,n] = data - medi      # simple sky subtraction
-                print("  . sky # {:-2n}: {:}, level {:0.0f} ".format(n+1,skylist[n], medi))
-            else:
-                gain = sky0/medi                # gain factor
-                cube[:,:,n] = gain*data - sky0  # ..to normalise sky level to that of source file
-                print("  . sky # {:-2n}: {:}, level {:0.0f} ==> gain {:0.2f}".format( n+1,skylist[n], medi, gain))
-            # counts map: coadd the mask frames
-            if n == 0:
-                counts = mm[ext].data
+        sky0 = buf.get(im)[2]
+        if options.verbose:
+            print(" - {:} ext {:-2n}: source sky level: {:0.0f} ".format(im, ext, sky0))
+
+        # The normalised frames do not depend on the target, so neither does 
+        # their stack median: build it once per sky list
+        prods = memo.get(skylist)
+        if prods is None:
+            if options.verbose:
+                for n in range(len(skylist)):
+                    print("  . sky # {:-2n}: {:}, level {:0.0f} ".format(n+1,skylist[n], buf.get(skylist[n])[2]))
+
+            nrms = nvar = None
+            if tiled:
+                # combine the frames by row tiles within mem_max
+                frames = [buf.get(x) for x in skylist]
+                if doRMS == True or doVAR == True:
+                    st = frame_stats([f[0] for f in frames], options.mem_max, nthread)
+                    nmed, nval, nrms, nvar = st['median'], st['count'], st['std'], st['var']
+                else:
+                    nmed, nval = combine_frames([f[0] for f in frames], 'median', options.mem_max, nthread)
+                # counts map: the masked pixels are the NaNs, so the number of
+                # valid values is the coadd of the mask frames
+                counts = nval.astype(frames[0][1].dtype)
+                del frames
             else:
-                counts += mm[ext].data
-            mm.close(); ss.close()
-
-        ## Build median  ... ATTN: some pixels could be NaN everywhere (gives python warning)
-        medi = np.float32(np.nanmedian(cube, axis=2))     # stack median of cube
-        if doRMS == True:
-            srms = np.nanstd(cube, axis=2)        # stack rms of cube
-        if doVAR == True:
-            svar = np.nanvar(cube, axis=2)        # stack var of cube
+                # update the sorted pixel values for the frames dropped / added
+                slide.update(skylist, lambda x: buf.get(x)[:2])
+
+                ## Build median  ... ATTN: some pixels could be NaN everywhere
+                counts = slide.counts.copy()              # counts map: coadd of the mask frames
+                if doRMS == True or doVAR == True:
+                    st = slide.stats(mem_max=options.mem_max or 256)   # median, rms and var from the sorted values
+                    nmed, nrms, nvar = st['median'], st['std'], st['var']
+                else:
+                    nmed = slide.median()                 # stack median of the frames
+            prods = (nmed, counts, nrms, nvar)
+            memo.put(skylist, prods)
+        (nmed, counts, nrms, nvar) = prods
+
+        # sky of the target
+        if (method == 'subtract'):
+            medi = nmed                         # simple sky subtraction
+            srms = nrms
+            svar = nvar
+        else:
+            medi = sky0 * nmed - sky0           # ..to normalise sky level to that of source file
+            if doRMS == True:
+                srms = abs(sky0) * nrms
+            if doVAR == True:
+                svar = sky0 * sky0 * nvar
         mmedi = np.nanmedian(medi)            # median value of medi (should be near zero)
         nloc = len(medi[np.isnan(medi)])      # Number of NaNs in sky
-        nzz = len(counts[counts == 0])        # number of zeros in counts
 
-        print(" ==> on ext {:-2n}: {:-2n} skies: median: {:0.2f}; masked {:0n} or {:0.2f}%".format(ext, len(skylist), mmedi, nloc, nloc/2048/20.48))
+        print(" ==> {:} ext {:-2n}: {:-2n} skies: median: {:0.2f}; masked {:0n} or {:0.2f}%".format(im, ext, len(skylist), mmedi, nloc, nloc/2048/20.48))
 
-        palt[ext].data = medi                     # fill in sky map
         ## if all NaNs, then count=0 (at least in this version of python)
-        pcnt[ext].data = counts                   # fill count map
+        maps = [('_alt', medi), ('_cnt', counts)]   # sky map, count map
         if doRMS == True:
-            prms[ext].data = srms.astype("float32")   # fill rms map, maybe
+            maps.append(('_rms', srms.astype("float32")))   # rms map, maybe
         if doVAR == True:
-            pvar[ext].data = svar.astype("float32")   # fill var map, maybe
+            maps.append(('_var', svar.astype("float32")))   # var map, maybe
+        writer.submit(write_ext, imroot, ext, maps)
+
+    writer.close()
+    buf.close()
+    print("#-----  Done ext {:-2n}: read {:} frames, {:} reused sky medians, {:} incremental updates for {:} targets;  exec time: {:0.2f} min".format(ext, buf.nread, memo.nhit, slide.nupdate, len(targets), (time.time() - text)/60))
+    if options.level_approx:
+        print("#-----  ext {:-2n}: sky levels uncertain by < {:0.2f} ADU, {:} exact".format(ext, levels.errmax, levels.nexact))
+
+# the chips are built either one after the other, each using nproc threads,
+# or concurrently by nproc processes
+if options.par_ext and options.nproc > 1:
+    nthread = 1
+    print " -- INFO: build the %i extensions with %i processes"%(len(exts), options.nproc)
+    pool = Pool(processes=min(options.nproc, len(exts)))
+    pool.map(build_ext, exts)
+    pool.close()
+    pool.join()
+else:
+    nthread = options.nproc
+    print " -- INFO: build the extensions with %i threads"%nthread
+    for ext in exts:
+        build_ext(ext)
 
-    
-    print '#------  Finished loop over extensions; close files  ------------------'
-    palt.close() ; print(" >> Built alternate sky image: {:}".format(altsky))
-    pcnt.close() ; print(" >> Built alt sky counts map:  {:}".format(count))
-    if doRMS == True:
-        prms.close() ; print(" >> Built std deviation map:   {:}".format(rms))
-    if doVAR == True:
-        pvar.close() ; print(" >> Built variance map:        {:}".format(var))
-    pmsk.close() 
+print '#------  Finished loop over extensions  ------------------'
+print "#-----------------------------------------------------------------------------"
+print "#### 3. Merge the chips of the maps of the targets ...   "
+print "#-----------------------------------------------------------------------------"
+
+for im in targets:
+    imroot  = im.split(fitsext)[0]
+    skylist = skylists[im]
+    altsky  = imroot + '_alt.fits'
+    mask    = imroot + inmask_suf       # name of input mask
 
-    # Finish alt sky and count map
-    print "# Add kwd with names of images used for building sky"
+    # Finish alt sky and count map: merge the chips, with the headers of the
+    # image (the mask for the counts map)
+    print "# Merge the maps of %s; add kwd with names of images used for building sky to %s"%(im, altsky)
     now = datetime.datetime.now()
     hist = '%s, on %s'%(now.strftime("%Y-%m-%d %H:%M"), os.getenv('PWD'))
 
-    with pyfits.open(imroot + '_alt.fits', mode='update') as psub:
-        hd1 = psub[0].header
-        for (imm, index) in zip(skylist, range(len(skylist))):
-            hd1['SKYIM' + str(index)] = imm
-        hd1['history'] = '# mkSky finished on %s on Candide node %s'%(now.strftime("%Y-%m-%d %H:%M"),os.uname()[1])
-        hd1['history'] = '# List of sky files used: %s '%flist
+    hd1 = pyfits.getheader(im, 0)
+    for (imm, index) in zip(skylist, range(len(skylist))):
+        hd1['SKYIM' + str(index)] = imm
+    hd1['history'] = '# mkSky finished on %s on Candide node %s'%(now.strftime("%Y-%m-%d %H:%M"),os.uname()[1])
+    hd1['history'] = '# List of sky files used: %s '%flist
+
+    merge_maps(imroot, '_alt', im, hd1)
+    merge_maps(imroot, '_cnt', mask)
+    if doRMS == True:
+        merge_maps(imroot, '_rms', im)
+    if doVAR == True:
+        merge_maps(imroot, '_var', im)
 
-    print("#-----------------------------------------------------------------------------")
-    print("##  DONE {:} with {:-2n} skies;  exec time: {:0.2f} min".format(altsky, len(skylist), (time.time() - tini)/60))
-    print("#-----------------------------------------------------------------------------")
+print("#-----------------------------------------------------------------------------")
+print("##  DONE {:} alt skies;  exec time: {:0.2f} min".format(len(targets), (time.time() - tini)/60))
+print("#-----------------------------------------------------------------------------")
 
 sys.exit()
 #-----------------------------------------------------------------------------
@@ -29,7 +29,13 @@ def get_parser():
     parser.add_argument('-M', '--mask', dest='mask_file', help='bad pixel mask (def = zeroes.fits)', type=str, default="zeroes.fits")
     parser.add_argument('--threshold', dest='thresh', help='detection threshold in building masks (def = 1)', type=float, default="1.5")
     parser.add_argument('--double_mask', dest='double_mask', help='Mask from stack AND single image', action='store_true', default=True)
-    parser.add_argument('-T', '--n-thread', dest='nproc', help='Number of threads', type=int, default="1")
+    parser.add_argument('-T', '--n-thread', dest='nproc', help='Number of threads (and of concurrent swarp projections)', type=int, default="1")
+    parser.add_argument('--proj', dest='proj', help='Projection of the stack mask: swarp or native (def = swarp)', type=str, choices=['native', 'swarp'], default="swarp")
+    parser.add_argument('--map-cache', dest='map_cache', help='Directory to keep the pixel maps of the native projection (def = none)', type=str, default="")
+    parser.add_argument('--map-quantum', dest='map_quantum', help='Chips whose projections agree to that many pixels share pixel maps (def = 0.01; 0 = exact)', type=float, default=0.01)
+    parser.add_argument('--n-window', dest='nwin', help='Number of windows of the stack mask kept in memory (def = 2)', type=int, default=2)
+    parser.add_argument('--mask-engine', dest='mask_engine', help='Combination of the masks: ww, native (in python), or check (ww, compared to native) (def = ww)', type=str, choices=['native', 'ww', 'check'], default="ww")
+    parser.add_argument('--scratch', dest='scratch', help='Directory for temporary files (local disk or tmpfs; def = current dir)', type=str, default="")
     parser.add_argument('--conf-path', dest='cpath', help='path for configuration files', type=str, default="")
     parser.add_argument('--pass2', dest='spass', help='Double pass skysub?', action='store_true', default=True)
 
@@ -66,8 +72,8 @@ def main(args):
         #print "## DEBUG:  "
         print "## copy source images and apply to it the external header file"
         #wim = im.split(".fits")[0] + args.inweight_suf
-        print "missfits " + im + " -c missfits.conf -SAVE_TYPE NEW -NEW_SUFFIX .temp -VERBOSE_TYPE QUIET "
-        os.system( "missfits " + im + " -c missfits.conf -SAVE_TYPE NEW -NEW_SUFFIX .temp -VERBOSE_TYPE QUIET ")
+        misspar = {'c': 'missfits.conf', 'SAVE_TYPE': 'NEW', 'NEW_SUFFIX': '.temp', 'VERBOSE_TYPE': 'QUIET'}
+        tool_runner().run("missfits", im, misspar, check=True)
         
         # Project the mask
 #        maskin = args.stack.split('.fits')[0] + '_obFlag.fits'  # here images is the input stack
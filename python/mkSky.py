@@ -11,6 +11,15 @@
 #   introduced timing info
 # Sep.23, AMo:
 #   added check of unequal jitter_I kwd
+# Oct.26:
+#   --engine native: median combine of the masked sky frames done in python
+#   (see median_sky_exts in subsky_sub.py), writing the _sky.fits MEF
+#   directly, without the swarp and missfits runs; --engine check to compare
+#   it with swarp.  swarp remains the default until check has been run on
+#   real data
+#   the swarp extensions are merged with mef_writer instead of missfits
+#   with --meta-cat, read the keywords from a persistent header catalogue
+#   (see metacat_lib.py); the keywords are read only once
 #-----------------------------------------------------------------------------
 
 import math
@@ -19,6 +28,7 @@ import sys, re, os
 import astropy.io.fits as pyfits
 import numpy as np
 from subsky_sub import *
+from metacat_lib import header_cat
 from time import ctime
 import datetime
 import time
@@ -40,6 +50,7 @@ parser.add_option('-n', '--n-images', dest='numim', help='Number of images to bu
 parser.add_option('-s', '--n-skies',  dest='nskies', help='Min num of images to build the sky (def: 4)', type='int', default="4")
 parser.add_option('-t', '--time', dest='dtime', help='maximum time between source and sky image in mn (def: 30)', type='float', default="30.")
 parser.add_option('-d', '--dist', dest='dist',  help='maximum dist between source and sky image in arcmin (def: 10)', type='float', default="10.")
+parser.add_option('--engine', dest='engine', help='Sky combine: swarp, native, or check (swarp, compared to native) (def: swarp)', type='choice', choices=['native', 'swarp', 'check'], default='swarp')
 parser.add_option('--pass2', dest='spass', help='Double pass skysub ?', action='store_true', default=False)
 
 # not used by must leave in foc ompatibilty sith routines in subsky_sub.py
@@ -53,6 +64,7 @@ parser.add_option('--script-path', dest='spath', help='path for script files', t
 # Other
 parser.add_option('-v', '--verbose', dest='verbose', help='Verbose ...', action='store_true', default=False)
 parser.add_option('-T', '--n-thread', dest='nproc', help='Number of threads', type='int', default="1")
+parser.add_option('--meta-cat', dest='metacat', help='Header catalogue file (def: none, read the images)', type='string', default="")
 parser.add_option('-D', '--dry',   dest='dry', help='Dry mode; list what is to be done', action='store_true', default=False)
 parser.add_option('-B', '--debug', dest='debug', help='Debuging mode ..', action='store_true', default=False)
 
@@ -144,15 +156,17 @@ newimlist=[]
 
 # Read some keywords
 keys = ['FILTER', 'MJDATE', 'RA_DEG', 'DEC_DEG', 'OBJECT', 'EXPTIME', 'SATURATE', 'FILENAME', 'SKYLEVEL', 'JITTER_I']
-data_sublist = read_header(sublist, keys)
-data_imlist = read_header(imlist, keys)
+hcat = header_cat(options.metacat) if options.metacat != "" else None
+data_sublist = read_header(sublist, keys, hcat)
+data_imlist = read_header(imlist, keys, hcat)
 bertin_par = bertin_param()
+sky_idx = sky_index(sublist, data_sublist)    # to find the skies of each image
 
 # loop on the images of the list
 for (im, ind) in zip(imlist, range(len(imlist))):
 
     imroot = im.split(fitsext)[0]
-    skylist = get_skylist_dr6(im, ind, sublist, data_imlist, data_sublist, options)
+    skylist = get_skylist_dr6(im, ind, sublist, data_imlist, data_sublist, options, sky_idx)
 
     # check that sky list contains at least nskymin images
     if len(skylist) < options.nskies:
@@ -180,78 +194,109 @@ print "# -------------------------------------------------------------"
 print "# Begin actual work on images that have enough nearby skies"
 print "# -------------------------------------------------------------"
 
-data_imlist = read_header(newimlist, keys)    # data of list with enough skies only
+# data of list with enough skies only: subset of those already read
+sel = [imlist.index(im) for im in newimlist]
+data_imlist = dict((k, [data_imlist[k][i] for i in sel]) for k in keys)
 for (im, ind) in zip(newimlist, range(len(newimlist))):
 
     tini = time.time()
     print " >> Begin working on %s ... "%im
     imroot = im.split(fitsext)[0]
     imhead = imroot + headext
-    skylist = get_skylist_dr6(im, ind, sublist, data_imlist, data_sublist, options)
+    skylist = get_skylist_dr6(im, ind, sublist, data_imlist, data_sublist, options, sky_idx)
 
     print " >> Found %i images to build sky:"%(len(skylist))
-    print " >> Copy %s header to %s "%(im, imhead)
-    cp_head(im, imhead)
-
-    print " >> and link it to (pseudo) head files of skies .. links are"
-    for skyim in skylist:
-        os.symlink(imhead, skyim.split(fitsext)[0] + headext) 
-        print "   " + skyim.split(fitsext)[0]+headext + " -> " + os.readlink( skyim.split(fitsext)[0] + headext)
-
-    # Loop on the extensions
-    for ext in exts:
-        sext = str(ext)
-        print "#------------------- Begin working on extension %2i -------------------"%(ext)
-
-        # External header: .exp file used by missfits when recombining extensions  
-        expout = im.split('.fits')[0] + '_sky.' + str(ext) + '.exp'
-        file = open(expout, 'w')
-        file.write("EXPTIME =             %8.4f  / Integration time (seconds)\n" % (data_imlist['EXPTIME'][ind]))
-        file.write("SATURATE=             %8.4f  / Saturation value (ADU)\n" % (data_imlist['SATURATE'][ind]))
-        file.close()
-
-        ext_head = imroot + '_sky.' + sext + headext
-        print " >> Copy image header to %s and link it to the head of the sky files"%ext_head
-        exkeys = ["XTENSION", "PCOUNT", "GCOUNT"]
-        copy_header_MEF(imroot + fitsext, imroot + '_sky.' + sext + headext, ext, exkeys)
-
-        print " >> Build the sky image (swarp) ==> %s_sky.%i.fits"%(imroot,ext) 
-        imout = imroot + '_sky.' + sext + fitsext
-        args = ' -RESAMPLE Y  -RESAMPLING_TYPE NEAREST  -COMBINE_TYPE MEDIAN  -SUBTRACT_BACK Y  -BACK_SIZE 4096  -COPY_KEYWORDS OBJECT,FILTER  -WEIGHT_SUFFIX '+inmask_suf+'  -IMAGEOUT_NAME '+imout+'  -c swarp.conf  -VERBOSE_TYPE QUIET  -WRITE_XML N '
-        other = '-WEIGHTOUT_NAME sky.weight.fits  -WEIGHT_TYPE MAP_WEIGHT' # default param, should not be necessary for method median
-        # out weights not used - leave default name (coadd.weight.fits) and delete later
+    if options.engine != 'native':
+        print " >> Copy %s header to %s "%(im, imhead)
+        cp_head(im, imhead)
+
+        print " >> and link it to (pseudo) head files of skies .. links are"
+        for skyim in skylist:
+            os.symlink(imhead, skyim.split(fitsext)[0] + headext) 
+            print "   " + skyim.split(fitsext)[0]+headext + " -> " + os.readlink( skyim.split(fitsext)[0] + headext)
+
+        # Loop on the extensions
+        for ext in exts:
+            sext = str(ext)
+            print "#------------------- Begin working on extension %2i -------------------"%(ext)
+
+            # External header: .exp file used by missfits when recombining extensions  
+            expout = im.split('.fits')[0] + '_sky.' + str(ext) + '.exp'
+            file = open(expout, 'w')
+            file.write("EXPTIME =             %8.4f  / Integration time (seconds)\n" % (data_imlist['EXPTIME'][ind]))
+            file.write("SATURATE=             %8.4f  / Saturation value (ADU)\n" % (data_imlist['SATURATE'][ind]))
+            file.close()
+
+            ext_head = imroot + '_sky.' + sext + headext
+            print " >> Copy image header to %s and link it to the head of the sky files"%ext_head
+            exkeys = ["XTENSION", "PCOUNT", "GCOUNT"]
+            copy_header_MEF(imroot + fitsext, imroot + '_sky.' + sext + headext, ext, exkeys)
+
+            print " >> Build the sky image (swarp) ==> %s_sky.%i.fits"%(imroot,ext) 
+            imout = imroot + '_sky.' + sext + fitsext
+            args = ' -RESAMPLE Y  -RESAMPLING_TYPE NEAREST  -COMBINE_TYPE MEDIAN  -SUBTRACT_BACK Y  -BACK_SIZE 4096  -COPY_KEYWORDS OBJECT,FILTER  -WEIGHT_SUFFIX '+inmask_suf+'  -IMAGEOUT_NAME '+imout+'  -c swarp.conf  -VERBOSE_TYPE QUIET  -WRITE_XML N '
+            other = '-WEIGHTOUT_NAME sky.weight.fits  -WEIGHT_TYPE MAP_WEIGHT' # default param, should not be necessary for method median
+            # out weights not used - leave default name (coadd.weight.fits) and delete later
 
 #        if (ext == 1):  # write xml for first ext only, others are all the same
 #            args += '-WRITE_XML Y -XML_NAME '+imroot+'_sky.1.xml '
 #        else:
 #        args += '-WRITE_XML N'
 
+            if options.dry:
+                print " >>>> Dry mode: swarp params to build 1st sky ext <<<<< "
+                print args    # ex swarppar
+                print " =====================   Finished dry mode check exiting   ===================== "   
+                sys.exit(0)
+            else:
+                simlist = ','.join([x+"[%s]"%ext for x in skylist])
+                if (ext == 1): 
+                    print  " % swarp " +simlist+" "+ args
+                os.system("swarp " +simlist+" "+ args)
+            print " >> Built sky image: %s "%imout
+
+        print '#------------------  Finished loop over extensions  ------------------'
+        print '#---------------  Merge extensions into new MEF file  ----------------'
+
+        print "# Join the extentions for %s "%(imroot + '_sky.fits')
+        merge_mef(imroot + '_sky', exts, imroot + '_sky.fits', pyfits.getheader(im), exp_suffix='.exp')
+
+        print "# Clean up (rm v*.*.exp, coadd.*, head, temp files)"
+        os.remove('coadd.weight.fits')
+        os.remove(imhead)
+        for imm in skylist:
+            os.remove(imm.split(fitsext)[0] + headext)
+        for e in exts:
+            os.remove(imroot+'_sky.'+str(e)+'.exp')
+            os.remove(imroot+'_sky.'+str(e)+'.head')
+            os.remove(imroot+'_sky.'+str(e)+'.fits')
+
+
+    if options.engine != 'swarp':
         if options.dry:
-            print " >>>> Dry mode: swarp params to build 1st sky ext <<<<< "
-            print args    # ex swarppar
+            print " >>>> Dry mode: native median combine of %i skies <<<<< "%len(skylist)
             print " =====================   Finished dry mode check exiting   ===================== "   
             sys.exit(0)
+
+        print " >> Build the sky image (native median combine) ==> %s_sky.fits"%imroot
+        pyim = pyfits.open(im)
+        if options.engine == 'check':
+            pyref = pyfits.open(imroot + '_sky.fits')
+            for (ext, sky, nval) in median_sky_exts(skylist, exts, inmask_suf, options):
+                good = nval > 0
+                diff = sky[good] - pyref[ext].data[good]
+                print " >> check ext %2i: native - swarp: median %8.3f  rms %8.3f  max %8.3f  (%i pixels)"%(
+                    ext, np.median(diff), np.sqrt(np.mean(diff**2)), np.abs(diff).max(), good.sum())
+            pyref.close()
         else:
-            simlist = ','.join([x+"[%s]"%ext for x in skylist])
-            if (ext == 1): 
-                print  " % swarp " +simlist+" "+ args
-            os.system("swarp " +simlist+" "+ args)
-        print " >> Built sky image: %s "%imout
-
-    print '#------------------  Finished loop over extensions  ------------------'
-    print '#---------------  Merge extensions into new MEF file  ----------------'
-
-    print "# Join the extentions for %s "%(imroot + '_sky.fits')
-    os.system('missfits -c ' + cpath + '/missfits.conf ' + imroot + '_sky  -WRITE_XML N   -OUTFILE_TYPE MULTI -HEADER_SUFFIX none -SAVE_TYPE REPLACE -SPLIT_SUFFIX .%01d.fits')
-
-    print "# Clean up (rm v*.*.exp, coadd.*, head, temp files)"
-    os.remove('coadd.weight.fits')
-    os.remove(imhead)
-    for imm in skylist:
-        os.remove(imm.split(fitsext)[0] + headext)
-    for e in exts:
-        os.remove(imroot+'_sky.'+str(e)+'.exp')
-        os.remove(imroot+'_sky.'+str(e)+'.head')
+            with mef_writer(imroot + '_sky.fits', pyim[0].header) as mef:
+                for (ext, sky, nval) in median_sky_exts(skylist, exts, inmask_suf, options):
+                    cards = [pyfits.Card('EXPTIME', data_imlist['EXPTIME'][ind], 'Integration time (seconds)'),
+                             pyfits.Card('SATURATE', data_imlist['SATURATE'][ind], 'Saturation value (ADU)')]
+                    cards += [pyim[0].header.cards[key] for key in ['OBJECT', 'FILTER'] if key in pyim[0].header]
+                    mef.add(sky, pyim[ext].header, cards)
+                    print " >> Built sky ext %2i from %i frames"%(ext, len(skylist))
+        pyim.close()
 
     print "# Add kwd with names of images used for building sky"
     now = datetime.datetime.now()
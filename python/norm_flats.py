@@ -5,6 +5,7 @@
 #       : o, osuff    : output suffix
 #       : v, verbose_level : ERROR,WARNING,INFO,DEBUG
 #       : -, log      : logfile
+#       : T, n-thread : number of chips processed in parallel
 # --------------------------------------------------------
 
 
@@ -14,6 +15,7 @@ import astropy.io.fits as pyfits
 #import pylab
 from logger_lib import setup_logger
 import argparse
+from parallel_lib import chip_map
 
 
 def get_parser():
@@ -22,6 +24,7 @@ def get_parser():
     parser.add_argument('-l', '--list', dest='imlist', help='list of flats', type=str, default="")
     parser.add_argument('-o', '--osuff', dest='osuff', help='Output suffix (def = _norm.fits)', type=str, default="_norm.fits")
     parser.add_argument('-s', '--stat', dest='stat', help="Normalisation statistic MEAN,MEDIAN,MODE (def=MEDIAN)", type=str, default='MEDIAN')
+    parser.add_argument('-T', '--n-thread', dest='nproc', help='Number of chips processed in parallel (def: 1)', type=int, default=1)
 
     # verbose options
     parser.add_argument('-v', '--verbose_level', dest='verbose_level', help='Verbose level (ERROR,WARNING,INFO,DEBUG)', type=str, default='ERROR')
@@ -107,10 +110,11 @@ def main(args):
             normalize_val(pyim[0].data, args.stat)
         else:
     
-            for iext0 in range(next - 1):
-                iext = iext0 + 1
-                val = normalize_val(pyim[iext].data, args.stat)
-                print " - ext %0i : %0.2f"%( iext0 + 1, val)
+            exts = range(1, next)
+            norm = lambda data: normalize_val(data, args.stat)
+            vals = chip_map(norm, [pyim[iext].data for iext in exts], args.nproc)
+            for (iext, val) in zip(exts, vals):
+                print " - ext %0i : %0.2f"%( iext, val)
                 pyim[iext].data /= val
         pyim.writeto(outfile, output_verify="warn")
         pyim.close()
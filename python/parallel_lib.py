@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+Parallel execution of the loops over the chips (extensions) of an image.
+
+chip_map(func, items, nproc) returns [func(item) for item in items], the
+items (one per chip: its arrays and parameters) being processed by up to
+nproc threads, or processes with mode='process'; the results come back in
+the order of the items.  Threads suit the numpy work and the file I/O,
+which release the GIL; processes the pure Python work, at the cost of
+pickling the items and the results (func must then be a module function).
+chip_imap() is the same as an iterator, to write the results in order as
+they become available.
+
+With a memory budget mem_max (MB) and the memory used by one chip, nbytes,
+the number of chips processed at a time is reduced so that they fit in
+mem_max (n_workers).
+
+The astropy HDU lists are not thread-safe: the data of the chips are taken
+from them in the calling thread (e.g. [hdus[ext].data for ext in exts];
+with memory-mapped files the pixels are then only read by the workers), and
+the results stored back there too.
+
+The loops over the images overlap their I/O with the computation:
+prefetch(loader, items, depth) yields (item, loader(item)) in turn, the
+inputs of the next depth items being loaded by a background thread
+meanwhile (read_fits reads a whole file in memory for that); the writes of
+the outputs are queued to an async_writer, which runs them in turn in a
+background thread, at most depth of them pending.  An error in the loader
+or in a write is raised again in the calling thread, by the item or the
+write that follows it.
+"""
+
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+import astropy.io.fits as pyfits
+
+
+def n_workers(nproc, nitems, mem_max=0, nbytes=0):
+    """ Number of items processed at a time: nproc, at most nitems, and at
+    most what fits in mem_max MB at nbytes per item (at least 1) """
+    n = max(1, min(nproc, nitems))
+    if mem_max > 0 and nbytes > 0:
+        n = max(1, min(n, int(mem_max * 1024. * 1024. / nbytes)))
+    return n
+
+
+def make_pool(n, mode='thread'):
+    if mode == 'thread':
+        return ThreadPool(n)
+    if mode == 'process':
+        return Pool(n)
+    raise ValueError("parallel_lib: unknown mode %s" % mode)
+
+
+def chip_map(func, items, nproc=1, mode='thread', mem_max=0, nbytes=0):
+    """ [func(item) for item in items], computed by up to nproc workers
+    (threads or processes), in the order of items """
+    items = list(items)
+    n = n_workers(nproc, len(items), mem_max, nbytes)
+    if n == 1:
+        return [func(item) for item in items]
+    pool = make_pool(n, mode)
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def chip_imap(func, items, nproc=1, mode='thread', mem_max=0, nbytes=0):
+    """ Iterator over func(item) for item in items, computed by up to nproc
+    workers (threads or processes), in the order of items """
+    items = list(items)
+    n = n_workers(nproc, len(items), mem_max, nbytes)
+    if n == 1:
+        for item in items:
+            yield func(item)
+        return
+    pool = make_pool(n, mode)
+    try:
+        for res in pool.imap(func, items):
+            yield res
+    finally:
+        pool.close()
+        pool.join()
+
+
+def read_fits(filename):
+    """ Open a FITS file and read all its HDUs in memory (no memory map), so
+    that the file is not accessed any more afterwards """
+    pf = pyfits.open(filename, memmap=False)
+    for hdu in pf:
+        hdu.data
+    return pf
+
+
+def prefetch(loader, items, depth=1):
+    """ Iterator over (item, loader(item)) for item in items, in order; the
+    next depth items are loaded in a background thread while the current
+    one is used (depth=0: no prefetch) """
+    items = list(items)
+    if depth < 1:
+        for item in items:
+            yield item, loader(item)
+        return
+    pool = ThreadPool(1)
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, pool.apply_async(loader, (item,))))
+            if len(pending) > depth:
+                item, res = pending.popleft()
+                yield item, res.get()
+        while pending:
+            item, res = pending.popleft()
+            yield item, res.get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+class async_writer:
+    """ Queue of writes (any function and its arguments) run in turn by a
+    background thread, at most depth of them pending: submit() waits for
+    the oldest when the queue is full (depth=0: the writes are done at
+    once).  close() waits for all of them.
+
+    Usage:
+        with async_writer(depth) as writer:
+            for im in images:
+                writer.submit(write_image, out, data, header)
+    """
+
+    def __init__(self, depth=1):
+        self.depth = depth
+        self.pool = ThreadPool(1) if depth > 0 else None
+        self.pending = deque()
+
+    def submit(self, func, *args):
+        if self.pool is None:
+            func(*args)
+            return
+        self.pending.append(self.pool.apply_async(func, args))
+        while len(self.pending) > self.depth:
+            self.pending.popleft().get()
+
+    def wait(self):
+        """ Wait for all the pending writes """
+        while self.pending:
+            self.pending.popleft().get()
+
+    def close(self):
+        if self.pool is None:
+            return
+        try:
+            self.wait()
+        finally:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, tb):
+        self.close()
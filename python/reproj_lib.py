@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Nearest neighbour reprojection of the reference stack mask onto the chips
+of an image, in place of the swarp -RESAMPLING_TYPE NEAREST runs of
+project_combine (subsky_sub.py).
+
+For each chip the index of the stack pixel nearest to the centre of each
+chip pixel is computed from the two WCS (pixel_map), and the mask is then
+projected with a single fancy-indexing operation.  The pixel maps are
+cached, in memory and optionally on disk, so that chips with the same
+astrometry (same jitter position, re-runs) do not recompute them.
+
+The cache key is the position in the stack of a grid of control points of
+the chip, rounded to `quantum` pixel, with the shapes of the chip and of
+the stack: chips whose projections agree to that precision share the same
+map (quantum=0: only identical projections do).  Chip pixels that fall
+outside the stack get the value 0, as swarp gives them.
+
+The stack is not read as a whole: its data unit is memory mapped and only
+the window covering the footprint of the chip is read (stack_reader); the
+maps index that window.
+"""
+
+import os
+import hashlib
+import warnings
+from collections import OrderedDict
+import numpy
+import astropy.io.fits as pyfits
+from astropy import wcs as pywcs
+from fitshead_lib import read_hdu_header
+
+
+def chip_wcs(header):
+    """ WCS of a chip header, without the warnings about non-standard cards """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return pywcs.WCS(header)
+
+
+def control_points(shape, npt=5):
+    """ npt x npt grid of pixel positions (0-based) covering a chip """
+    yy, xx = numpy.meshgrid(numpy.linspace(0, shape[0] - 1, npt), numpy.linspace(0, shape[1] - 1, npt), indexing='ij')
+    return xx.ravel(), yy.ravel()
+
+
+def stack_pixels(cwcs, swcs, xx, yy):
+    """ Position (0-based) in the stack of chip pixels xx, yy """
+    ra, dec = cwcs.all_pix2world(xx, yy, 0)
+    return swcs.all_world2pix(ra, dec, 0)
+
+
+def map_key(cwcs, swcs, shape, sshape, quantum=0.01):
+    """ Cache key of the pixel map of a chip: digest of the positions in the
+    stack of its control points, in units of quantum pixel, and of the shapes
+    of the chip and of the stack (which clips the map) """
+    sx, sy = stack_pixels(cwcs, swcs, *control_points(shape))
+    pos = numpy.concatenate([sx, sy, numpy.array(shape, dtype=float), numpy.array(sshape, dtype=float)])
+    if quantum > 0:
+        pos = numpy.round(pos / quantum).astype(numpy.int64)
+    return hashlib.sha1(pos.tobytes()).hexdigest()
+
+
+def pixel_map(cwcs, swcs, shape, sshape, nrow=256):
+    """ Pixels of the stack (of shape sshape) nearest to the centres of the
+    pixels of a chip of the given shape, computed by blocks of nrow rows.
+    Returns (idx, bbox): bbox = (y0, y1, x0, x1) is the window of the stack
+    covered by the chip, and idx the flat index in that window of the pixel
+    nearest to each chip pixel, -1 outside the stack. """
+    iy = numpy.empty(shape, dtype=numpy.int64)
+    ix = numpy.empty(shape, dtype=numpy.int64)
+    xx = numpy.arange(shape[1], dtype=numpy.float64)
+    for y0 in range(0, shape[0], nrow):
+        y1 = min(y0 + nrow, shape[0])
+        gx, gy = numpy.meshgrid(xx, numpy.arange(y0, y1, dtype=numpy.float64))
+        sx, sy = stack_pixels(cwcs, swcs, gx, gy)
+        ix[y0:y1] = numpy.floor(sx + 0.5)
+        iy[y0:y1] = numpy.floor(sy + 0.5)
+    good = (ix >= 0) & (ix < sshape[1]) & (iy >= 0) & (iy < sshape[0])
+    if not good.any():
+        return numpy.full(shape, -1, dtype=numpy.int32), (0, 0, 0, 0)
+
+    bbox = (int(iy[good].min()), int(iy[good].max()) + 1, int(ix[good].min()), int(ix[good].max()) + 1)
+    dtype = numpy.int32 if (bbox[1] - bbox[0]) * (bbox[3] - bbox[2]) < 2**31 else numpy.int64
+    idx = ((iy - bbox[0]) * (bbox[3] - bbox[2]) + (ix - bbox[2])).astype(dtype)
+    idx[~good] = -1
+    return idx, bbox
+
+
+class stack_reader:
+    """ Windows of a (large) 2D image, read through a memory map of its data
+    unit, so that only the part of the file that is needed is read.
+
+    The data unit is located by scanning the headers (fitshead_lib); the
+    windows are returned in native byte order, scaled by BSCALE/BZERO if
+    given.  The nwin windows last read are kept, as chips at the same
+    jitter position cover the same window. """
+
+    dtypes = {8: '>u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+    def __init__(self, filename, nwin=2):
+        self.filename = filename
+        self.nwin = nwin
+        self.windows = OrderedDict()
+        self.nread = 0
+        keys = set(['NAXIS', 'NAXIS1', 'NAXIS2', 'BITPIX', 'BZERO', 'BSCALE'])
+        with open(filename, 'rb') as fobj:
+            ext = 0
+            while True:
+                cards, size = read_hdu_header(fobj, keys)
+                if cards.get('NAXIS', 0) == 2:
+                    break
+                fobj.seek(size, 1)
+                ext += 1
+            offset = fobj.tell()
+        self.ext = ext
+        self.shape = (cards['NAXIS2'], cards['NAXIS1'])
+        self.bzero = cards.get('BZERO', 0)
+        self.bscale = cards.get('BSCALE', 1)
+        self.data = numpy.memmap(filename, dtype=self.dtypes[cards['BITPIX']], mode='r',
+                                 offset=offset, shape=self.shape)
+        self.header = pyfits.getheader(filename, ext)
+
+    def window(self, bbox):
+        """ The window bbox = (y0, y1, x0, x1) of the image """
+        if bbox in self.windows:
+            self.windows[bbox] = self.windows.pop(bbox)
+            return self.windows[bbox]
+        (y0, y1, x0, x1) = bbox
+        win = self.data[y0:y1, x0:x1]
+        win = win.astype(win.dtype.newbyteorder('='))
+        if self.bscale != 1 or self.bzero != 0:
+            win = win * numpy.float32(self.bscale) + numpy.float32(self.bzero)
+        self.nread += 1
+        if self.nwin > 0:
+            self.windows[bbox] = win
+            while len(self.windows) > self.nwin:
+                self.windows.popitem(last=False)
+        return win
+
+    def close(self):
+        self.windows.clear()
+        del self.data
+
+
+class map_cache:
+    """ LRU cache of pixel maps: nmax maps in memory and, if cache_dir is
+    given, all of them as .npz files in that directory """
+
+    def __init__(self, nmax=16, cache_dir=None):
+        self.nmax = nmax
+        self.cache_dir = cache_dir
+        self.maps = OrderedDict()
+        self.nhit = 0
+        self.nmiss = 0
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, 'pmap_' + key + '.npz')
+
+    def get(self, key):
+        """ (idx, bbox) of the pixel map key, or None """
+        if key in self.maps:
+            self.maps[key] = self.maps.pop(key)
+            self.nhit += 1
+            return self.maps[key]
+        if self.cache_dir and os.path.isfile(self.path(key)):
+            self.nhit += 1
+            with numpy.load(self.path(key)) as npz:
+                val = (npz['idx'], tuple(int(b) for b in npz['bbox']))
+            return self.put(key, val, save=False)
+        self.nmiss += 1
+        return None
+
+    def put(self, key, val, save=True):
+        self.maps[key] = val
+        while len(self.maps) > self.nmax:
+            self.maps.popitem(last=False)
+        if save and self.cache_dir:
+            # write under a temporary name: other processes may share the directory
+            tmp = self.path(key) + '.%i.tmp' % os.getpid()
+            with open(tmp, 'wb') as f:
+                numpy.savez(f, idx=val[0], bbox=numpy.array(val[1]))
+            os.rename(tmp, self.path(key))
+        return val
+
+
+class mask_projector:
+    """ Projection of a reference stack mask onto chips, by nearest neighbour.
+
+    The stack (its first 2D data unit) is read by windows (stack_reader);
+    project(header) returns the mask on the grid of the chip described by
+    header. """
+
+    def __init__(self, stack, quantum=0.01, nmax=16, cache_dir=None, nwin=2):
+        self.stack = stack
+        self.quantum = quantum
+        self.cache = map_cache(nmax, cache_dir)
+        self.reader = stack_reader(stack, nwin)
+        self.swcs = chip_wcs(self.reader.header)
+        self.sshape = self.reader.shape
+
+    def get_map(self, header):
+        shape = (header['NAXIS2'], header['NAXIS1'])
+        cwcs = chip_wcs(header)
+        key = map_key(cwcs, self.swcs, shape, self.sshape, self.quantum)
+        val = self.cache.get(key)
+        if val is None:
+            val = self.cache.put(key, pixel_map(cwcs, self.swcs, shape, self.sshape))
+        return val
+
+    def project(self, header, dtype=numpy.float32):
+        """ Stack mask on the grid of the chip of header; 0 outside the stack """
+        idx, bbox = self.get_map(header)
+        good = idx >= 0
+        out = numpy.zeros(idx.shape, dtype=dtype)
+        if good.any():
+            out[good] = self.reader.window(bbox).ravel()[idx[good]]
+        return out
+
+    def close(self):
+        self.reader.close()
+
+
+# Projectors opened in this process, by stack and cache parameters
+projectors = {}
+
+def get_projector(stack, quantum=0.01, nmax=16, cache_dir=None, nwin=2):
+    """ mask_projector of a stack, shared by all the calls of the process """
+    key = (os.path.abspath(stack), quantum, nmax, cache_dir, nwin)
+    if key not in projectors:
+        projectors[key] = mask_projector(stack, quantum, nmax, cache_dir, nwin)
+    return projectors[key]
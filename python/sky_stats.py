@@ -21,6 +21,7 @@ import os,sys
 import numpy as np
 import astropy.io.fits as fits
 from scipy.stats import sigmaclip
+from parallel_lib import chip_map
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
@@ -34,6 +35,7 @@ mpl.rcParams['xtick.minor.visible'] = True
 
 doPlot  = True  # to do (or not) the png plot
 verbose = False  # print a 1-line "Done" message if False, the stats table if True
+nthread = 8      # chips processed in parallel
 
 #-----------------------------------------------------------------------------
 
@@ -43,6 +45,32 @@ print(">> found {:} files to process".format(len(sys.argv)-1))
 # general params
 #-----------------------------------------------------------------------------
 kappa = 4                 # why not ....
+
+#-----------------------------------------------------------------------------
+# stats of a chip (and its histogram for the plot)
+#-----------------------------------------------------------------------------
+def chip_stats(item):
+    (arr, slev, plot) = item
+    # compute chip * weight and get min, max, and "mode"
+    arr = arr.flatten()
+    if (slev != 1.0): 
+        anorm = 1000.
+    else:
+        anorm = 1.
+
+    arr = arr/anorm 
+    slev = slev/anorm
+    xlims = np.sort([0.5*slev, 2*slev])   # in some rare cases slev is negative!! Use this to avoid crash
+
+    sky,low,upp = sigmaclip(arr[arr > 0], low=kappa, high=kappa)  # try to determine sky level
+    msky = np.mean(sky) ; medi = np.median(sky) ; mstd = np.std(sky)    # mean, median, rms
+    mini = np.min(sky)  ; maxi = np.max(sky)     # mini, maxi
+    fout = 100 - 100*len(sky)/2048/2048
+
+    hist = edges = None
+    if plot == True:
+        hist, edges = np.histogram(arr, bins=80, range=(xlims))
+    return mini, maxi, msky, mstd, medi, slev, fout, xlims, hist, edges
 #-----------------------------------------------------------------------------
 # Begin loop over input ldac files
 #-----------------------------------------------------------------------------
@@ -100,32 +128,22 @@ for n in range(1, len(sys.argv)):
     ff = []                    # fraction of pixels outside of kappa-sigma cuts
 
     ## print("chip    mini     maxi    mean   std   medi    casu [k]")
+    # the stats of the chips are computed in parallel, then plotted in turn
+    items = []
     for e in range(1,17):
         try:
             slev = ima[e].header['SKYLEVEL']             # casu sky level
         except:
             slev = 1.0
+        items.append((ima[e].data, slev, doPlot))
 
-        # compute chip * weight and get min, max, and "mode"
-        arr = ima[e].data 
-        arr = arr.flatten()
-        if (slev != 1.0): 
-            anorm = 1000.
-        else:
-            anorm = 1.
-
-        arr = arr/anorm 
-        slev = slev/anorm
-        xlims = np.sort([0.5*slev, 2*slev])   # in some rare cases slev is negative!! Use this to avoid crash
+    for e, res in zip(range(1,17), chip_map(chip_stats, items, nthread)):
+        (mini, maxi, msky, mstd, medi, slev, fout, xlims, hist, edges) = res
         ylims = [0.7,1e7]
-
-        sky,low,upp = sigmaclip(arr[arr > 0], low=kappa, high=kappa)  # try to determine sky level
-        msky = np.mean(sky) ; medi = np.median(sky) ; mstd = np.std(sky)    # mean, median, rms
-        mini = np.min(sky)  ; maxi = np.max(sky)     # mini, maxi
         
         ss.append(mini); bb.append(maxi)
         ms.append(msky); sd.append(mstd); me.append(medi)
-        lv.append(slev); ff.append(100 - 100*len(sky)/2048/2048)
+        lv.append(slev); ff.append(fout)
 
        # fmt=" {:2.0f} {:8.2f} {:8.2f}  {:6.2f} {:6.2f}  {:6.2f}  {:6.2f}"
        # print(fmt.format(e, mini, low, msky, mstd, medi, slev))
@@ -133,7 +151,7 @@ for n in range(1, len(sys.argv)):
         if doPlot == True:
             nn = e-1 ; nnx = nn%4; nny = 3-int(nn/4)   # select plot panel
 #            hist, edges, pats = axs[nny, nnx].hist(arr, bins=80, range=(-30.,50), log=True, histtype="step")
-            hist, edges, pats = axs[nny, nnx].hist(arr, bins=80, range=(xlims), log=True, histtype="step", label="tt")
+            hist, edges, pats = axs[nny, nnx].hist(edges[:-1], bins=edges, weights=hist, log=True, histtype="step", label="tt")
             hist[hist < 0.5] = 0.1                # to avoid plotting issues
             bins = (edges[1:] + edges[:-1])/2.    #; print(edges); print(bins)
             axs[nny, nnx].annotate('[%0i]'%e, (0.05,0.85), xycoords='axes fraction', ha='left', size=10)
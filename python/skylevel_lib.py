@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+"""
+Masked sky levels of the chips of the images, kept in sidecar files.
+
+The sky level of a chip is the median of its unmasked pixels (mask != 0),
+as in the sky frame buffer of mkAltSky.py and in get_median_fits /
+create_skyim_SCALELVL (subsky_sub.py).  It is computed once and written to
+a small text file next to the image, or in a cache directory:
+
+   <root>.skylvl    one line per chip:
+                    ext level method image_mtime image_size mask mask_mtime mask_size
+
+A line is valid only while the image and its mask keep the modification
+time and size they had when the level was computed; later lines supersede
+earlier ones.  Each line is appended with a single write on an O_APPEND
+descriptor, so that the processes building different chips of an image
+(mkAltSky.py --par-ext) can share the file.
+
+With method 'approx' the level is the median of a deterministic strided
+subsample of the chip (approx_level), with an uncertainty taken from the
+ranks of the order statistics around the median; the exact median is
+computed instead when that uncertainty exceeds the tolerance.  Exact
+levels already in the sidecars are used in either mode.
+
+Command line (pre-stage, in parallel over the images):
+   skylevel_lib.py -l list [-s _mask.fits] [-c cachedir] [-T nproc] [-a [-t tol]]
+"""
+
+import os, sys
+import math
+import time
+import optparse
+import numpy
+import astropy.io.fits as pyfits
+from multiprocessing import Pool
+
+
+def masked_level(data, mask):
+    """ Median of the pixels of data where mask != 0 (NaN if none) """
+    data = numpy.array(data, dtype=numpy.float32)
+    data[numpy.asarray(mask) == 0] = numpy.nan
+    return float(numpy.nanmedian(data))
+
+
+def approx_level(data, mask=None, nsamp=65536, tol=None):
+    """ Median of the unmasked, finite pixels of data estimated on a strided
+    subsample of about nsamp pixels.  Returns (level, err): err is half the
+    distance between the order statistics at +-1 sigma in rank around the
+    median (i.e. about its standard error).  If tol is given and err > tol,
+    or the chip is not larger than the subsample, the exact median is
+    returned, with err = None. """
+    data = numpy.asarray(data).ravel()
+    stride = max(1, data.size // nsamp)
+    vals = data[::stride].astype(numpy.float32)
+    if mask is not None:
+        vals = vals[numpy.asarray(mask).ravel()[::stride] != 0]
+    vals = vals[numpy.isfinite(vals)]
+    n = len(vals)
+    if n == 0:
+        err = numpy.inf
+    else:
+        half = 0.5 * numpy.sqrt(n)
+        lo = max(0, int(math.floor((n - 1) / 2. - half)))
+        hi = min(n - 1, int(math.ceil((n - 1) / 2. + half)))
+        part = numpy.partition(vals, [lo, (n - 1) // 2, n // 2, hi])
+        level = 0.5 * (part[(n - 1) // 2] + part[n // 2])
+        err = 0.5 * (part[hi] - part[lo])
+    if stride == 1 or (tol is not None and err > tol):
+        if mask is None:
+            return float(numpy.nanmedian(data.astype(numpy.float32))), None
+        return masked_level(data, numpy.asarray(mask).ravel()), None
+    return float(level), float(err)
+
+
+def file_key(path):
+    """ (mtime, size) of a file, as stored in the sidecars """
+    st = os.stat(path)
+    return ('%.6f' % st.st_mtime, str(st.st_size))
+
+
+class level_cache:
+    """ Sky levels of the chips of images, read from and written to their
+    sidecar files (in cache_dir if given, else next to the images; with
+    store=False they are only kept in memory).  method is 'median' or
+    'approx' (within tol ADU, see approx_level). """
+
+    def __init__(self, cache_dir=None, mask_suf='_mask.fits', method='median', tol=0.5, store=True):
+        self.cache_dir = cache_dir
+        self.mask_suf = mask_suf
+        self.method = method
+        self.tol = tol
+        self.store = store
+        self.levels = {}     # im -> {ext: level} of the valid lines
+        self.nhit = 0
+        self.nmiss = 0
+        self.nexact = 0      # approx levels replaced by the exact median
+        self.errmax = 0.     # largest uncertainty of the approx levels
+
+    def path(self, im):
+        root = im.split('.fits')[0]
+        if self.cache_dir:
+            root = os.path.join(self.cache_dir, os.path.basename(root))
+        return root + '.skylvl'
+
+    def mask(self, im):
+        return im.split('.fits')[0] + self.mask_suf
+
+    def keys(self, im):
+        return file_key(im) + (os.path.basename(self.mask(im)),) + file_key(self.mask(im))
+
+    def read(self, im):
+        """ Valid levels of the sidecar of im, as a dictionary ext -> level """
+        if im in self.levels:
+            return self.levels[im]
+        levels = {}
+        exact = {}
+        if self.store and os.path.isfile(self.path(im)):
+            keys = self.keys(im)
+            for line in open(self.path(im)):
+                fld = line.split()
+                if len(fld) != 8 or tuple(fld[3:]) != keys:
+                    continue
+                if fld[2] == 'median':
+                    exact[int(fld[0])] = float(fld[1])
+                elif fld[2] == self.method:
+                    levels[int(fld[0])] = float(fld[1])
+        levels.update(exact)
+        self.levels[im] = levels
+        return levels
+
+    def put(self, im, ext, level, method=None):
+        if self.store:
+            line = ' '.join([str(ext), repr(level), method or self.method] + list(self.keys(im))) + '\n'
+            # one write(2) on an O_APPEND descriptor: the lines of concurrent
+            # processes are never interleaved
+            fd = os.open(self.path(im), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+            try:
+                os.write(fd, line.encode('ascii'))
+            finally:
+                os.close(fd)
+        self.read(im)[ext] = level
+
+    def estimate(self, data, mask=None):
+        """ (level, method) of a chip: method is that of the cache, or
+        'median' when the approximation was not within tol """
+        if self.method != 'approx':
+            if mask is None:
+                return float(numpy.nanmedian(data)), 'median'
+            return masked_level(data, mask), 'median'
+        level, err = approx_level(data, mask, tol=self.tol)
+        if err is None:
+            self.nexact += 1
+            return level, 'median'
+        self.errmax = max(self.errmax, err)
+        return level, 'approx'
+
+    def get(self, im, ext, data=None, mask=None):
+        """ Level of chip ext of im; if not in the sidecar it is computed, from
+        data (with the masked pixels NaN, or masked by mask) if given, else
+        from the image and its mask, and stored """
+        levels = self.read(im)
+        if ext in levels:
+            self.nhit += 1
+            return levels[ext]
+        self.nmiss += 1
+        if data is None:
+            with pyfits.open(im) as pim, pyfits.open(self.mask(im)) as pmsk:
+                level, method = self.estimate(pim[ext].data, pmsk[ext].data)
+        else:
+            level, method = self.estimate(data, mask)
+        self.put(im, ext, level, method)
+        return level
+
+    def get_all(self, im, exts):
+        """ Levels of chips exts of im, reading the image only once for the
+        chips that are missing """
+        levels = self.read(im)
+        missing = [ext for ext in exts if ext not in levels]
+        self.nhit += len(exts) - len(missing)
+        if missing:
+            self.nmiss += len(missing)
+            with pyfits.open(im) as pim, pyfits.open(self.mask(im)) as pmsk:
+                for ext in missing:
+                    level, method = self.estimate(pim[ext].data, pmsk[ext].data)
+                    self.put(im, ext, level, method)
+        return [levels[ext] for ext in exts]
+
+
+class level_table:
+    """ Lazy table of the sky levels of images: table[im][ext - 1] is the
+    level of chip ext of im, as the SKY_median dictionaries of
+    create_skyim_SCALELVL (subsky_sub.py) """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __getitem__(self, im):
+        return level_row(self.cache, im)
+
+
+class level_row:
+    def __init__(self, cache, im):
+        self.cache = cache
+        self.im = im
+
+    def __getitem__(self, i):
+        return self.cache.get(self.im, i + 1)
+
+
+def image_exts(im):
+    """ Image extensions of a file: 1..n for a MEF, [0] for a single image """
+    with pyfits.open(im) as pim:
+        return [0] if len(pim) == 1 else list(range(1, len(pim)))
+
+
+def fill_levels(arg):
+    """ Compute the missing levels of an image (pre-stage) """
+    (im, cache_dir, mask_suf, method, tol) = arg
+    cache = level_cache(cache_dir, mask_suf, method, tol)
+    t0 = time.time()
+    levels = cache.get_all(im, image_exts(im))
+    return (im, cache.nmiss, levels, cache.errmax, time.time() - t0)
+
+
+# Command line running
+if __name__ == '__main__':
+
+    parser = optparse.OptionParser(usage="%prog -l list [-s mask_suffix] [-c cache_dir] [-T nproc]")
+    parser.add_option('-l', '--list', dest='flist', help='List of images', type='string', default='')
+    parser.add_option('-s', '--mask-suffix', dest='mask_suf', help='Mask suffix (def: _mask.fits)', type='string', default='_mask.fits')
+    parser.add_option('-c', '--cache-dir', dest='cache_dir', help='Directory of the sidecars (def: with the images)', type='string', default='')
+    parser.add_option('-T', '--n-proc', dest='nproc', help='Number of processes (def: 1)', type='int', default=1)
+    parser.add_option('-a', '--approx', dest='approx', help='Approximate levels (on a subsample)', action='store_true', default=False)
+    parser.add_option('-t', '--tol', dest='tol', help='Max uncertainty (ADU) of the approximate levels (def: 0.5)', type='float', default=0.5)
+    (options, args) = parser.parse_args()
+
+    files = list(args)
+    if options.flist != '':
+        files += [line.split()[0] for line in open(options.flist) if line.strip()]
+
+    method = 'approx' if options.approx else 'median'
+    jobs = [(im, options.cache_dir or None, options.mask_suf, method, options.tol) for im in files]
+    if options.nproc > 1:
+        pool = Pool(processes=options.nproc)
+        res = pool.imap(fill_levels, jobs)
+    else:
+        res = map(fill_levels, jobs)
+    for (im, nnew, levels, err, dt) in res:
+        print('%-24s %2i new  %s  (err < %0.2f; %0.1f s)' % (im, nnew, ' '.join(['%0.1f' % x for x in levels]), err, dt))
+    if options.nproc > 1:
+        pool.close()
+        pool.join()
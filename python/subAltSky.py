@@ -19,6 +19,22 @@ For DR6:
   NB. the CASU files have had the sky shape removed, but contain a sky level
       that is given in the SKYLEVEL keywork (one value per chip)
 
+Oct.18: 
+- fused single pass: the original, the CASU sky, the new sky, its counts and
+  the mask are read once, the subtraction and the destriping are done in
+  memory, and the _cln file is written once (with the SKYIM and history
+  cards), without the cp / reopen of the _sub and _cln files.
+- large-scale background computed by SExtractor on a scratch copy of the
+  chips (scratch directory: 2nd argument, def. .), or, with bg_engine =
+  'native', in process as SExtractor does it (background_lib), on nthread
+  chips at a time, without any temporary file.  SExtractor remains the
+  default until the native engine is validated (background_lib.py -c).
+- destriping by destripe_lib (NaN-aware medians), nthread chips at a time.
+- the sky subtraction too is done on nthread chips at a time (parallel_lib).
+- the inputs of the next nprefetch images are read in the background while
+  an image is processed, and the _cln files are written in the background
+  (at most nwrite pending).
+
 Inputs:
 - input file      root.fits          # the CASU image file:
   The associated CASU sky filename and bpm filename are written in
@@ -37,16 +53,19 @@ Outputs
 import sys, re, os
 import math
 import numpy as np
-import numpy.ma as ma
 import astropy.io.fits as fits
 import time
-from subsky_sub import cp_skykeys
+from subsky_sub import sky_keys, mef_writer
+from background_lib import subtract_backgrounds, sex_backgrounds
+from destripe_lib import destripe_chips
+from parallel_lib import chip_map, prefetch, async_writer, read_fits
 
 #-----------------------------------------------------------------------------
 # Read the list of images 
 #-----------------------------------------------------------------------------
 
 flist = sys.argv[1]
+scratch = sys.argv[2] if len(sys.argv) > 2 else '.'
 
 try:
     file = open(flist, 'r')
@@ -77,29 +96,69 @@ exts = range(1, n_ext+1)
 
 bsize = 256     # ==> back_size
 bfilt = 3       # ==> backfilter_size
+bg_engine = 'sex'   # large-scale background: 'sex' (SExtractor) or 'native' (background_lib)
+nthread = 8     # chips processed in parallel
+mem_max = 0     # max memory (MB) for the chips processed in parallel (0 = no limit)
+nprefetch = 1   # images whose inputs are read ahead, in the background
+nwrite = 1      # _cln files written in the background
 
 verbose = False
 if verbose == True: print oriDir, calDir
 
 #-----------------------------------------------------------------------------
-# Begin work on individual files:
+# Work on a chip: add back casu sky, subtract the new sky, remove constant sky offsets
 #-----------------------------------------------------------------------------
-for line in lines:
-    tini = time.time()                # start time 
 
-    ima = line.split()[0]             # name of the CASU image file, in origs/
-    print "### Begin working on %s ... "%ima
-    root = ima.split('.fits')[0]
+def sub_chip(item):
+    (idata, ilevel, cdata, clevel, ndata, mdata) = item
 
-    #-----------------------------------------------------------------------------
-    # Set up the inputs and ancillary data
-    #-----------------------------------------------------------------------------
+    # now perform subtraction
+    idata = (idata - ilevel) + (cdata - clevel) - ndata
+
+    # check residual background level:
+    xxx = idata * mdata
+    sel = np.where((idata != 0) & np.isfinite(idata))
+    resBgd = np.mean(xxx[sel])        # residual background
+    stdBgd = np.std(xxx[sel])         # its st.dev.
 
+    idata[idata < -5. * stdBgd] = 0.       # remove large negative values
+    return idata.astype("float32"), mdata.astype("f4"), resBgd, stdBgd
+
+#-----------------------------------------------------------------------------
+# Read the inputs of an image: each is read once, the original is not copied.
+# Run in a background thread for the next images (prefetch)
+#-----------------------------------------------------------------------------
+
+def load_inputs(ima):
+    root = ima.split('.fits')[0]
     sky = root + '_alt.fits'          # name of file with the "new" sky to subtract 
     cnt = root + '_cnt.fits'          # name of gile with its counts 
     msk = root + '_mask.fits'         # input object mask used to select sky pixels
-    sub = root + '_sub.fits'          # name for output sky-subtracted image (SExtractor check image - temporary)
-    cln = root + '_cln.fits'          # name for clean (_cln) image
+
+    pori = read_fits(oriDir + ima)
+    pmsk = read_fits(mskDir + msk)      
+
+    # get the name of the CASU sky to add back in
+    casu_sky = pori[4].header["SKYSUB"]
+    casu_sky = casu_sky[10:].split('[')[0]+'s'        # name of casu sky to add
+    pcsky = read_fits(calDir + casu_sky)
+
+    ppsky = read_fits(altDir + sky)             # new (pipeline) sky
+    ppcnt = read_fits(altDir + cnt)             # its counts file
+    return (pori, pmsk, casu_sky, pcsky, ppsky, ppcnt, sky_keys(altDir + sky))
+
+def write_cln(cln, phead, chips, heads):
+    with mef_writer(cln, phead) as pcln:
+        for (data, head) in zip(chips, heads):
+            pcln.add(data, head)
+
+#-----------------------------------------------------------------------------
+# Begin work on individual files:
+#-----------------------------------------------------------------------------
+todo = []
+for line in lines:
+    ima = line.split()[0]             # name of the CASU image file, in origs/
+    cln = ima.split('.fits')[0] + '_cln.fits'
 
     ##### May not want to di this all the time ######
     # check if _cln file exists, if so nothing to do
@@ -107,131 +166,115 @@ for line in lines:
     if qq == True : 
         print("## ATTN: found cleaned/{:} ... skip it and continue".format(cln))
         continue        
-                       
+    todo.append(ima)
+
+writer = async_writer(nwrite)
+for (ima, inputs) in prefetch(load_inputs, todo, nprefetch):
+    tini = time.time()                # start time 
+
+    print "### Begin working on %s ... "%ima
+    root = ima.split('.fits')[0]
+
     #-----------------------------------------------------------------------------
-    # Set up the inputs
+    # Set up the inputs and ancillary data
     #-----------------------------------------------------------------------------
 
+    sky = root + '_alt.fits'          # name of file with the "new" sky to subtract 
+    cln = root + '_cln.fits'          # name for clean (_cln) image
+    (pori, pmsk, casu_sky, pcsky, ppsky, ppcnt, (skyims, skyhist)) = inputs
+    inputs = None
+
     print("- 1. subtract {:} from {:} ".format(sky,ima))
-    com = 'cp '+oriDir + ima +' '+ sub + '; chmod 644 ' + sub 
-    if verbose == True: print "# DEBUG:", com
-    os.system(com)
-    cp_skykeys(altDir + sky, sub)
 
-    pmsk = fits.open(mskDir + msk)      
-    psub = fits.open(sub, mode='update')     
+    # primary header of the output: that of the original, with the list of
+    # images used to build the sky and its history
+    phead = pori[0].header.copy()
+    for (ind, val) in enumerate(skyims):
+        phead['SKYIM' + str(ind)] = val
+    for h in skyhist:
+        phead['history'] = h
 
-    # get the name of the CASU sky to add back in
-    casu_sky = psub[4].header["SKYSUB"]
-    if verbose == True: print "# DEBUG: SKYSUB kwd:", casu_sky
-    casu_sky = casu_sky[10:].split('[')[0]+'s'        # name of casu sky to add
-    if verbose == True: print "# DEBUG: CASU sky file:", casu_sky
+    if verbose == True: print "# DEBUG: SKYSUB kwd:", pori[4].header["SKYSUB"]
     print "-    CASU sky file:", casu_sky
-    pcsky = fits.open(calDir + casu_sky)
-
-    ppsky = fits.open(altDir + sky)             # new (pipeline) sky
-    ppcnt = fits.open(altDir + cnt)             # its counts file
 
     #-----------------------------------------------------------------------------
     ## 1. add back casu sky, subtract the new sky, remove constant sky offsets
     #-----------------------------------------------------------------------------
+    items = []
+    heads = []
     for ext in exts:
-        idata  = psub[ext].data 
-        ilevel = psub[ext].header["SKYLEVEL"]
-        cdata  = pcsky[ext].data   
+        ilevel = pori[ext].header["SKYLEVEL"]
         # sometimes one, sometimes the other, sometines both ... va savoir!
         try: 
             clevel = pcsky[ext].header["SKYLEVEL"]
         except:
             clevel = pcsky[ext].header["MEDSKLEV"]
-
-        ndata = ppsky[ext].data   # nominally its mean is 0.0
-
-        # now perform subtraction
-        idata = (idata - ilevel) + (cdata - clevel) - ndata
-
-        # check residual background level:
-        xxx = idata * pmsk[ext].data
-        sel = np.where((idata != 0) & np.isfinite(idata))
-        resBgd = np.mean(xxx[sel])        # residual background
-        stdBgd = np.std(xxx[sel])         # its st.dev.
-
+        # ndata: the new sky, nominally its mean is 0.0
+        items.append((pori[ext].data, ilevel, pcsky[ext].data, clevel, ppsky[ext].data, pmsk[ext].data))
+        heads.append(pori[ext].header)
+
+    subs  = []
+    masks = []
+    for (ext, res) in zip(exts, chip_map(sub_chip, items, nthread, mem_max=mem_max, nbytes=24*items[0][0].size)):
+        (idata, mdata, resBgd, stdBgd) = res
         print "  >> ext %2i: res. bgd, st.dev:  %6.2f, %6.2f"%( ext, resBgd, stdBgd)
-        idata[idata < -5. * stdBgd] = 0.       # remove large negative values
-        psub[ext].data = idata.astype("float32")
+        subs.append(idata)
+        masks.append(mdata)
+    items = None
 
     # add some history to primary header:
-    psub[0].header['history'] = "# Subtracted local sky %s "%sky
+    phead['history'] = "# Subtracted local sky %s "%sky
 
+    pcsky.close()
     ppsky.close()
-    psub.close()
-
-    if verbose == True: print "#DEBUG  - output sky-subtracted image is %s "%(sub)
 
     #-----------------------------------------------------------------------------
-    # 2. rm large-scale background variations (SExtractor): ==> cln = _cln.fits
-    #    input files: _sub, _mask; output is _cln
+    # 2. rm large-scale background variations (SExtractor -BACKGROUND, or
+    #    computed as it does it: bg_engine)
+    #    input: the sky-subtracted chips, _mask as weight
     #-----------------------------------------------------------------------------
-    print("- 2. compute and remove large scale background")  # (SExtractor)" ==> {:}".format(cln))
-    print "## INFO:  SExtractor params: bs=%i, bf=%i"%(bsize,bfilt)
+    print("- 2. compute and remove large scale background")
+    print "## INFO:  background params: bs=%i, bf=%i; engine %s"%(bsize,bfilt,bg_engine)
 
-    chkims = " -CHECKIMAGE_TYPE -BACKGROUND  -CHECKIMAGE_NAME "+cln
-    bksize = " -BACK_SIZE %i  -BACK_FILTERSIZE %i "%(bsize, bfilt)
+    if bg_engine == 'sex':
+        subs = sex_backgrounds(subs, heads, mskDir + root + '_mask.fits', bsize, bfilt, scratch, root)
+    else:
+        subs = subtract_backgrounds(subs, masks, bsize, bfilt, nthread, mem_max)
+    phead['history'] = "# Removed large-scale background variations "
 
-    verb = " -CATALOG_TYPE NONE  -INTERP_TYPE NONE  -VERBOSE_TYPE QUIET"
-    args = " -c bgsub.conf " +chkims+bksize+ "  -WEIGHT_IMAGE "+mskDir+msk
-    pars = " -PARAMETERS_NAME bgsub.param  -FILTER_NAME gauss_3.0_7x7.conv  -WRITE_XML N"
-
-    com = "sex "+ sub + args + pars + verb
-    if verbose == True: print com  
-    os.system(com)
-    
-    # add some history to primary header:
-    pcln = fits.open(cln, mode="update")
-    pcln[0].header = psub[0].header    # copy header of input image
-    pcln[0].header['history'] = "# Removed large-scale background variations "
-    if verbose == True: print "  #DEBUG  - output image with large-scale bgd removed is %s"%(cln)      
-    
-    # clean up
-    os.system("rm "+sub)
     #-----------------------------------------------------------------------------
-    # 3. destripe along Y, then X: in place on cln = _clean file
+    # 3. destripe along Y, then X, and write cln = _cln file (in the background)
     #-----------------------------------------------------------------------------
-    print("- 3. Destripe along Y, then X ")  #==> in place on {:}".format(cln))
-
-    for ext in exts:
-        mask  = pmsk[ext].data.astype("f4")
-        data  = pcln[ext].data
-        # ATTN: SExtractor left "bad" pixels at -1E+30 ... add them to the mask
-        mask[data >  1E+5] = 0.
-        count = ppcnt[ext].data 
-
-        # along Y
-        marr = ma.array(data, mask=(1-mask))
-        mmx  = ma.median(marr, axis=0).astype("f4")
-        data -= mmx
-    
-        # along X
-        marr = ma.array(data, mask=(1-mask))
-        mmy  = ma.median(marr, axis=1)
-        mmy  = mmy.reshape(data.shape[0],1).astype("f4")
-        data -= mmy
+    print("- 3. Destripe along Y, then X ==> {:}".format(cln))
+    phead['history'] = "# Destriped along Y, then X "
+
+    for (i, ext) in enumerate(exts):
+        # ATTN: exclude the very high pixels from the medians
+        masks[i][subs[i] >  1E+5] = 0.
+    subs = destripe_chips(subs, masks, nthread, mem_max=mem_max)
+    masks = None
+
+    chips = []
+    for (i, ext) in enumerate(exts):
+        data, (mmx, mmy) = subs[i]
         print "  >> ext %2i, mean mmx, mmy:  %7.3f, %7.3f"%(ext, mmx.mean(), mmy.mean())
 
         # make NaNs the masked pixels
-        data[count == 0] = np.nan
-        data[data == -1E+30] = np.nan
-        pcln[ext].data = data
-
-    # add some history to primary header:
-    pcln[0].header['history'] = "# Destriped along Y, then X "
-    
-    pcln.close()  
+        data[ppcnt[ext].data == 0] = np.nan
+        data[data == -1E+30] = np.nan         # pixels blanked by the background (weight 0)
+        chips.append(data)
+    subs = None
+    writer.submit(write_cln, cln, phead, chips, heads)
+    chips = None
+
+    ppcnt.close()
     pmsk.close()
+    pori.close()
     print "#---------------------------------------------------------------------"
     print("##  DONE {:}; exec time: {:0.2f} min".format(cln, (time.time() - tini)/60))
     print "#---------------------------------------------------------------------"
 
+writer.close()
 print "###  Finished run of subSky.py"
 print "#---------------------------------------------------------------------"
 
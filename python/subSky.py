@@ -3,6 +3,13 @@
 '''
 New sky subtraction: does actual sky subtraction of sky already built, then
 destripes and finally remove large-scale background variation with SExtractor
+(or, with --bg-engine native, computed in process as SExtractor does it, see
+background_lib)
+Oct.18: single pass in memory: the image, its sky and its mask are read
+once, the intermediate _sss and _bgcln files are no longer written, and
+the _clean file is written once.  The inputs of the next --prefetch images
+are read in the background while an image is processed, and the _clean
+files are written in the background.
 Inputs
 Outputs
 '''
@@ -13,7 +20,10 @@ import math
 import numpy as np
 import numpy.ma as ma
 import astropy.io.fits as pyfits
-from subsky_sub import cp_skykeys
+from subsky_sub import sky_keys, mef_writer
+from background_lib import subtract_backgrounds, sex_backgrounds
+from destripe_lib import destripe_chips
+from parallel_lib import chip_map, prefetch, async_writer, read_fits
 from optparse import OptionParser
 #from time import ctime
 import time
@@ -34,7 +44,10 @@ parser.add_option('--script-path', dest='spath', help='path for script files', t
 
 # Other
 parser.add_option('-v', '--verbose', dest='verbose', help='Verbose ...', action='store_true', default=False)
-#parser.add_option('-T', '--n-thread', dest='nproc', help='Number of threads', type='int', default="1")
+parser.add_option('-T', '--n-thread', dest='nproc', help='Number of threads (chips processed in parallel)', type='int', default="1")
+parser.add_option('--mem-max', dest='mem_max', help='Max memory (MB) for the chips processed in parallel (def: 0 = no limit)', type='int', default="0")
+parser.add_option('--bg-engine', dest='bg_engine', help='Large-scale background: sex (SExtractor) or native (def: sex)', type='choice', choices=['sex', 'native'], default='sex')
+parser.add_option('--prefetch', dest='nprefetch', help='Number of images read ahead, and written, in the background (def: 1; 0 = none)', type='int', default="1")
 parser.add_option('-D', '--dry',   dest='dry', help='Dry mode; list what is to be done', action='store_true', default=False)
 
 
@@ -64,7 +77,7 @@ exts = range(1, n_ext+1)
 #-----------------------------------------------------------------------------
 bsize = 64     # ==> back_size
 bfilt = 3      # ==> backfilter_size
-print "# SExtractor params: bs=%i, bf=%i"%(bsize,bfilt)
+print "# Background params: bs=%i, bf=%i; engine %s"%(bsize,bfilt,opts.bg_engine)
 
 
 lines = file.readlines()
@@ -73,91 +86,91 @@ file.close()
 print "# list of images contains %i files"%len(lines)
 print "#-------------------------------------------------------------"
 
-for line in lines:
-    xx = line.split()[0]
+def sub_chip(item):
+    """ Subtract the sky, and the mean of the result over the unmasked pixels """
+    (data, sky, mask) = item
+    data = data - sky
+    marr = ma.array(data.astype("f4"), mask=(1-mask.astype("f4")))
+    data -= marr.mean()
+    return data
+
+def load_inputs(ima):
+    """ Read an image, its sky and its mask (run in the background by prefetch) """
+    root = ima.split('.fits')[0]
+    sky = root + '_sky.fits'          # sky to subtract
+    msk = root + '_mask.fits'         # input mask used in cleaning
+    return (read_fits(ima), read_fits(sky), sky_keys(sky), read_fits(msk))
+
+def write_des(des, phead, chips, heads):
+    with mef_writer(des, phead) as pdes:
+        for (data, head) in zip(chips, heads):
+            pdes.add(data, head)
+
+images = [line.split()[0] for line in lines]
+writer = async_writer(opts.nprefetch)
+for (xx, inputs) in prefetch(load_inputs, images, opts.nprefetch):
     tini = time.time()
     print "# Begin working on %s ... "%xx
     root = xx.split('.fits')[0]
     ima = xx
     sky = root + '_sky.fits'          # sky to subtract
-    msk = root + '_mask.fits'         # input mask used in cleaning
-    sub = root + '_sss.fits'          # output sky-subtracted image
-    cln = root + '_bgcln.fits'        # output destriped images
     des = root + '_clean.fits'        # output final cleaned image
+    (pima, psky, (skyims, skyhist), pmsk) = inputs
+    inputs = None
 
-    os.system('cp ' + ima +' '+ sub + '; chmod 644 ' + sub)
-    os.system('cp ' + ima +' '+ des + '; chmod 644 ' + des)
+    # primary header of the output: that of the image, with the sky kwds
+    phead = pima[0].header.copy()
+    for (ind, val) in enumerate(skyims):
+        phead['SKYIM' + str(ind)] = val
+    for h in skyhist:
+        phead['history'] = h
+    heads = [pima[ext].header for ext in exts]
 
-    psky = pyfits.open(sky)
-    pmsk = pyfits.open(msk)
-    psub = pyfits.open(sub, mode='update')     
-    
     #-----------------------------------------------------------------------------
     # 1. subtract the sky and a constant sky offse    
     #-----------------------------------------------------------------------------
-    for ext in exts:
-        psub[ext].data -= psky[ext].data
-        mask = pmsk[ext].data.astype("f4")
-        data = psub[ext].data.astype("f4")
-        marr = ma.array(data, mask=(1-mask))
-        psub[ext].data -= marr.mean()
+    items = [(pima[ext].data, psky[ext].data, pmsk[ext].data) for ext in exts]
+    chips = chip_map(sub_chip, items, opts.nproc, mem_max=opts.mem_max, nbytes=16*items[0][0].size)
+    del items
         
     psky.close()
-    psub.close()  
-    print " - sky-subtracted image is %s "%(sub)
-    # copy sky kwds from _sky images to _sub
-    print " - copy the _sky keywords in the _sub image"
-    cp_skykeys(sky, sub)
+    pima.close()
+    print " - sky subtracted from %s "%(ima)
 
     #-----------------------------------------------------------------------------
-    # 3. rm large-scale background variations (SExtractor)
+    # 3. rm large-scale background variations (SExtractor -BACKGROUND, or in
+    #    process: see background_lib)
     #-----------------------------------------------------------------------------
 
-    chkims = " -CHECKIMAGE_TYPE -BACKGROUND  -CHECKIMAGE_NAME "+cln
-    bksize = " -BACK_SIZE %i  -BACK_FILTERSIZE %i "%(bsize, bfilt)
-    verb = " -CATALOG_TYPE NONE  -INTERP_TYPE NONE  -VERBOSE_TYPE QUIET"
-    args = " -c bgsub.conf " +chkims+bksize+ "  -WEIGHT_IMAGE "+msk
-    pars = " -PARAMETERS_NAME bgsub.param  -FILTER_NAME gauss_3.0_7x7.conv  -WRITE_XML Y -XML_NAME bgsub.xml "
-    command = "sex "+ sub + args + pars + verb
-    print command
-    os.system(command)
-
-    print " - cleaned image is %s; copy sky kwds "%(cln)
-    cp_skykeys(sky, cln)
+    weights = [pmsk[ext].data for ext in exts]
+    if opts.bg_engine == 'sex':
+        chips = sex_backgrounds(chips, heads, root + '_mask.fits', bsize, bfilt, '.', root, 'bgsub.xml')
+    else:
+        chips = subtract_backgrounds(chips, weights, bsize, bfilt, opts.nproc, opts.mem_max)
+    print " - large-scale background removed"
 
     #-----------------------------------------------------------------------------
-    # 2. destripe
+    # 2. destripe, and write des (in the background)
     #-----------------------------------------------------------------------------
-    os.system('cp ' + cln +' '+ des)
-    pdes = pyfits.open(des, mode='update')     
-
     back=[]
-    for ext in exts:
-        mask = pmsk[ext].data.astype("f4")
-        data = pdes[ext].data
-        # along Y
-        marr = ma.array(data, mask=(1-mask))
-        mmx  = ma.median(marr, axis=0).astype("f4")
-        data -= mmx
+    des_chips = []
+    for (ext, (data, (mmx, mmy))) in zip(exts, destripe_chips(chips, weights, opts.nproc, mem_max=opts.mem_max)):
+        des_chips.append(data)
         back.append(mmx.mean())
-
-        # along X
-        marr = ma.array(data, mask=(1-mask))
-        mmy  = ma.median(marr, axis=1)
-        mmy  = mmy.reshape(data.shape[0],1).astype("f4")
-        data -= mmy
         #print " >> DEBUG: ext %-2i, mean mmx,mmy = %0.3f, %0.3f"%(ext, mmx.mean(), mmy.mean())
+    del chips, weights
 
-    pdes.close()  
     pmsk.close()
+    writer.submit(write_des, des, phead, des_chips, heads)
+    del des_chips
     print " - destriped image is %s"%(des)
-    cp_skykeys(sky, des)
-    os.remove(cln)  ;  os.remove(sub)
 
 
     print "#-----------------------------------------------"
     print("##  DONE {:}; exec time: {:0.2f} min".format(des, (time.time() - tini)/60))
     print "#-----------------------------------------------"
 
+writer.close()
+
 #-----------------------------------------------------------------------------
 
@@ -3,11 +3,23 @@
 import astropy.io.fits as pyfits
 import os
 import copy
+import time
+import subprocess
 import math
 from TMASS_lib import *
 import numpy
 import numpy.random
-from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+from fitshead_lib import scan_file, scan_files
+from reproj_lib import get_projector
+from mask_lib import mask_combiner, ww_mask, compare_masks, bitmask
+from skylevel_lib import level_cache, level_table, masked_level
+from background_lib import mesh_stats, BIG
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
 numpy.set_printoptions(precision=2)
 
 # General values / Configuration parameters ...
@@ -174,53 +186,138 @@ def get_next(image):
     return next
 
 
-# Sextractor wrapper
-def sextract(image, sexconf, cparam):
-    cstr = ""
+#-----------------------------------------------------------------------------
+# Running of the external tools (sex, ww, swarp, missfits)
+#-----------------------------------------------------------------------------
+
+def tool_argv(prog, image, cparam):
+    """ Argument list of a call to an astromatic tool: prog [image] -KEY value ...
+    from a parameter dictionary as given by bertin_param (the '""' values,
+    empty strings for the shell, are passed as empty arguments) """
+    argv = [prog]
+    if image:
+        argv += image.split()
     for k in cparam:
-	cstr += " -" + str(k) + " " + str(cparam[k]) + " "
+        val = str(cparam[k])
+        argv += ['-' + str(k), '' if val == '""' else val]
+    return argv
+
+
+class tool_runner:
+    """ Run external tools, up to nproc at a time.
+
+    submit() queues a call and returns at once; wait() waits for all the
+    queued calls and returns their (argv, return code, elapsed time) in the
+    order of submission.  A call that fails (non-zero return code) is
+    reported, and with check=True wait() then exits.
+    The parameters of the calls are dictionaries, as from bertin_param.
+
+    scratch, if given, is a (local, or tmpfs) directory where the callers
+    put the temporary products (see scratch_path).
+    """
+
+    def __init__(self, nproc=1, scratch=None, verbose=True):
+        self.nproc = max(1, nproc)
+        self.scratch = scratch
+        self.verbose = verbose
+        self.pool = ThreadPool(self.nproc) if self.nproc > 1 else None
+        self.jobs = []
+
+    def scratch_path(self, name):
+        """ Path of a temporary file name in the scratch directory """
+        if not self.scratch:
+            return name
+        return os.path.join(self.scratch, os.path.basename(name))
+
+    def call(self, argv):
+        if self.verbose:
+            print ' '.join(a if a != '' else '""' for a in argv)
+        t0 = time.time()
+        try:
+            rc = subprocess.call(argv)
+        except OSError as err:
+            print "ERROR: could not run %s: %s" % (argv[0], err)
+            rc = -1
+        return (argv, rc, time.time() - t0)
+
+    def submit(self, prog, image, cparam):
+        argv = tool_argv(prog, image, cparam)
+        if self.pool is None:
+            self.jobs.append(self.call(argv))
+        else:
+            self.jobs.append(self.pool.apply_async(self.call, (argv,)))
+
+    def run(self, prog, image, cparam, check=False):
+        """ Run a call and wait for it to finish """
+        self.submit(prog, image, cparam)
+        return self.wait(check)[-1]
+
+    def wait(self, check=False):
+        res = [j if isinstance(j, tuple) else j.get() for j in self.jobs]
+        self.jobs = []
+        for (argv, rc, dt) in res:
+            if rc != 0:
+                print "ERROR: %s returned %i after %0.1f s" % (argv[0], rc, dt)
+                if check:
+                    sys.exit(1)
+        return res
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
-    print "sex %s -c %s %s" % (image, sexconf, cstr)
-    os.system("sex %s -c %s %s" % (image, sexconf, cstr));
+
+# Sextractor wrapper
+def sextract(image, sexconf, cparam):
+    cparam = copy.copy(cparam)
+    cparam['c'] = sexconf
+    return tool_runner().run("sex", image, cparam)[1]
 
 
 # weightwatcher wrapper
 def ww(wwconf, cparam):
-    cstr = ""
-    for k in cparam:
-	cstr += " -" + str(k) + " " + str(cparam[k]) + " "
-
-    print "ww -c %s %s \n" % (wwconf, cstr)
-    os.system("ww -c %s %s" % (wwconf, cstr));
+    cparam = copy.copy(cparam)
+    cparam['c'] = wwconf
+    return tool_runner().run("ww", "", cparam)[1]
 
 
 # Sextractor wrapper
 def sextract2(image, cparam):
-    cstr = ""
-    for k in cparam:
-	cstr += " -" + str(k) + " " + str(cparam[k]) + " "
-
-    print "sex %s  %s " % (image, cstr)
-    os.system("sex %s  %s " % (image, cstr));
+    return tool_runner().run("sex", image, cparam)[1]
 
 
 # weightwatcher wrapper
 def ww2(cparam):
-    cstr = ""
-    for k in cparam:
-	cstr += " -" + str(k) + " " + str(cparam[k]) + " "
-
-    print "ww  %s \n" % (cstr)
-    os.system("ww  %s" % (cstr));
+    return tool_runner().run("ww", "", cparam)[1]
+
+# weightwatcher, run in process (mask_lib) if options.mask_engine is 'native';
+# with 'check' run by ww, and compared with the mask built in process
+def ww_run(cparam, options, cards={}):
+    engine = getattr(options, 'mask_engine', 'ww')
+    if engine == 'native':
+        t0 = time.time()
+        ww_mask(cparam, cards)
+        print " >> %s built in %0.1f s" % (cparam['OUTWEIGHT_NAME'], time.time() - t0)
+        return 0
+    rc = ww2(cparam)
+    if engine == 'check':
+        check_mask(cparam, cparam['OUTWEIGHT_NAME'])
+    return rc
+
+
+# Build with mask_lib the mask of the ww parameters cparam, and compare it
+# with the mask ref made by ww (--mask-engine check)
+def check_mask(cparam, ref):
+    native = cparam['OUTWEIGHT_NAME'] + '.native'
+    mask_combiner.from_wwpar(cparam).write(native)
+    compare_masks(ref, native)
+    os.remove(native)
 
 # swarp wrapper
 def swarp(image, cparam):
-    cstr = ""
-    for k in cparam:
-	cstr += " -" + str(k) + " " + str(cparam[k]) + " "
-
-    print "swarp %s %s " % (image, cstr)
-    os.system("swarp %s %s " % (image, cstr));
+    return tool_runner().run("swarp", image, cparam)[1]
 
 
 # Add value (concatenate with coma)
@@ -256,7 +353,7 @@ def create_mask_pass1(file2, bertin_par, options):
 	add_val(wwpar, 'WEIGHT_MIN', '0.5')
 	add_val(wwpar, 'WEIGHT_MAX', '1.5')
 	add_val(wwpar, 'WEIGHT_OUTFLAGS', '1')
-    ww2(wwpar)
+    ww_run(wwpar, options)
     
 
 # Copy the entire header but the keywords in the exclude list
@@ -346,7 +443,7 @@ def project(maskin, maskout, im, next, options):
 
 	# join the extensions
 	os.remove(im.split('.fits')[0] + '.temp.fits')
-	os.system("missfits -c " + options.cpath + "/missfits.conf " + im.split('.fits')[0] + '.flag -OUTFILE_TYPE MULTI -SAVE_TYPE NEW -SPLIT_SUFFIX .%01d.fits')
+	merge_mef(im.split('.fits')[0] + '.flag', range(1, next + 1), im.split('.fits')[0] + '.flag.miss.fits')
 	for j in range(1, next + 1, 1):
 	    os.remove(im.split('.fits')[0] + '.flag.' + str(j) + '.fits')
 	    continue
@@ -370,36 +467,58 @@ def project_combine(maskin, maskout, im, next, options):
     bertin_par = bertin_param()
     root = im.split('.fits')[0]
 
-    for j in range(1, next + 1, 1):
-#        print " --", root, j, "of ", next
-        # copy header
-        infits = root + '.temp.fits'
-        outhead = root + '.flag.' + str(j) + '.head'
-        copy_header_MEF(infits, outhead, j, ['XTENSION', 'PCOUNT', 'GCOUNT'])
-
-        # Swarp image
-        swarppar = bertin_par.get_swarpproj1param(options)
-        swarppar['IMAGEOUT_NAME']  = root + '.flag.' + str(j) + '.fits'
-        swarppar['WEIGHTOUT_NAME'] = root + '.flag.' + str(j) + '.weight.fits'
-        swarppar['RESAMPLE_SUFFIX'] = '.' + str(j) + '.resamp.fits'
-        swarppar['VERBOSE_TYPE'] = 'QUIET'
-        #swarp2(maskin, swarppar)
-        cstr = ""
-        for k in swarppar:
-            cstr += " -" + str(k) + " " + str(swarppar[k]) + " "
-        print "swarp %s %s " % (maskin, cstr)
-        os.system("swarp %s %s " % (maskin, cstr))
-
-        os.remove(outhead)
-        os.remove(root + '.flag.' + str(j) + '.weight.fits')
-
-    print "\n >>> Join the extensions ..."
-    print     "missfits -c " + options.cpath + "/missfits.conf " + root + '.flag  -OUTFILE_TYPE MULTI -SAVE_TYPE NEW -SPLIT_SUFFIX .%01d.fits'
-    os.system("missfits -c " + options.cpath + "/missfits.conf " + root + '.flag  -OUTFILE_TYPE MULTI -SAVE_TYPE NEW -SPLIT_SUFFIX .%01d.fits')
-    # rm intermediate (single extenstion) flag files
-    for j in range(1, next + 1, 1):
-        os.remove(root + '.flag.' + str(j) + '.fits')
-    os.system('echo -n "## Built "; ls ' + root+'.flag.miss.fits')
+    native_mask = getattr(options, 'mask_engine', 'ww') == 'native'
+    projected = None
+    if getattr(options, 'proj', 'swarp') == 'native':
+        # Nearest neighbour projection in python, with cached pixel maps
+        projector = get_projector(maskin, getattr(options, 'map_quantum', 0.01), 16,
+                                  getattr(options, 'map_cache', '') or None, getattr(options, 'nwin', 2))
+        with pyfits.open(root + '.temp.fits') as ptemp:
+            theads = [hdu.header for hdu in ptemp]
+        if native_mask:
+            # projected chip by chip as the mask is built: no .flag.miss file
+            projected = lambda j: projector.project(theads[j])
+        else:
+            with mef_writer(root + '.flag.miss.fits') as mef:
+                for j in range(1, next + 1, 1):
+                    mef.add(projector.project(theads[j]), theads[j])
+    else:
+        # The projections of the chips are independent: run them concurrently,
+        # with their temporary products in the scratch directory
+        runner = tool_runner(getattr(options, 'nproc', 1), getattr(options, 'scratch', None))
+        froot = runner.scratch_path(root + '.flag')
+        for j in range(1, next + 1, 1):
+            # copy header
+            infits = root + '.temp.fits'
+            outhead = froot + '.' + str(j) + '.head'
+            copy_header_MEF(infits, outhead, j, ['XTENSION', 'PCOUNT', 'GCOUNT'])
+
+            # Swarp image
+            swarppar = bertin_par.get_swarpproj1param(options)
+            swarppar['IMAGEOUT_NAME']  = froot + '.' + str(j) + '.fits'
+            swarppar['WEIGHTOUT_NAME'] = froot + '.' + str(j) + '.weight.fits'
+            swarppar['RESAMPLE_SUFFIX'] = '.' + str(j) + '.resamp.fits'
+            swarppar['RESAMPLE_DIR'] = runner.scratch or '.'
+            swarppar['VERBOSE_TYPE'] = 'QUIET'
+            swarppar['WRITE_XML'] = 'N'
+            if runner.nproc > 1:
+                swarppar['NTHREADS'] = 1
+            runner.submit("swarp", maskin, swarppar)
+
+        for (argv, rc, dt) in runner.wait(check=True):
+            print " >> %s done in %0.1f s" % (argv[argv.index('-IMAGEOUT_NAME') + 1], dt)
+        runner.close()
+        for j in range(1, next + 1, 1):
+            os.remove(froot + '.' + str(j) + '.head')
+            os.remove(froot + '.' + str(j) + '.weight.fits')
+
+        print "\n >>> Join the extensions ..."
+        merge_mef(froot, range(1, next + 1), root + '.flag.miss.fits')
+        # rm intermediate (single extenstion) flag files
+        for j in range(1, next + 1, 1):
+            os.remove(froot + '.' + str(j) + '.fits')
+    if projected is None:
+        os.system('echo -n "## Built "; ls ' + root+'.flag.miss.fits')
 
     # Build the final mask
     print '\n >>> Merge into final mask ...'
@@ -419,7 +538,33 @@ def project_combine(maskin, maskout, im, next, options):
     add_val(wwpar,'WEIGHT_MAX','1.5')
     add_val(wwpar,'WEIGHT_OUTFLAGS','1')
     wwpar['VERBOSE_TYPE'] = "QUIET"
+    keys  =['CTYPE1','CTYPE2','CRVAL1','CRVAL2','CRPIX1','CRPIX2','CD1_1','CD1_2','CD2_1','CD2_2']
+    check = getattr(options, 'mask_engine', 'ww') == 'check'
+
+    if native_mask:
+        # uint8 mask with the astrometry of the image, written in one pass
+        comb = mask_combiner.from_wwpar(wwpar)
+        if projected is not None:
+            comb.replace(root + '.flag.miss.fits', projected)
+        cards = {}
+        with pyfits.open(root+".fits") as ihdus:
+            for i in range(1, next + 1):
+                cards[i] = [ihdus[i].header.cards[key] for key in keys]
+        comb.write(root + options.outweight_suf + '_tmp', cards=cards)
+        if projected is not None:
+            print " >> projected %s: %i pixel maps reused, %i computed, %i windows read" % (
+                maskin, projector.cache.nhit, projector.cache.nmiss, projector.reader.nread)
+        else:
+            os.remove(root + '.flag.miss.fits')
+        os.remove(root + '.temp.fits')
+        os.rename(root + options.outweight_suf + '_tmp', root + options.outweight_suf)
+        return
+
     ww2(wwpar)
+    if check:
+        # mask_lib mask of the same inputs, to compare with the final mask
+        native = root + options.outweight_suf + '.native'
+        mask_combiner.from_wwpar(wwpar).write(native)
 
     os.remove(root + '.temp.fits')
     os.remove(root + '.flag.miss.fits')
@@ -432,7 +577,6 @@ def project_combine(maskin, maskout, im, next, options):
     # copy astro kwds of image to mask and convert mask to integer
     ihdus = pyfits.open(root+".fits")
     mhdus = pyfits.open(out,   mode="update")
-    keys  =['CTYPE1','CTYPE2','CRVAL1','CRVAL2','CRPIX1','CRPIX2','CD1_1','CD1_2','CD2_1','CD2_2']
     nkeys = len(keys)
     for i in range(1,17):
         # convert mask data to byte
@@ -445,33 +589,104 @@ def project_combine(maskin, maskout, im, next, options):
             val = hdi[key]
             hdm[key] = val
     mhdus.close(output_verify='silentfix+ignore')
+    if check:
+        compare_masks(out, native)
+        os.remove(native)
 
 
 #-----------------------------------------------------------------------------
 
 # Read a list og keywords in a list of images
-def read_header(list, keys):
-    ''' Read a list of keywords in a list of images '''
-    data = {}
-    for k in keys:
-	data[k] = []
-
-    for im in list:
-	pyim = pyfits.open(im)
-	for k in keys:
-	    try:
-		val = pyim[0].header[k]
-	    except KeyError():
-		val = 'Nada'
-	    data[k].append(val)
-
-        pyim.close()
-    return data
+def read_header(list, keys, catalog=None, nproc=8):
+    ''' Read a list of keywords in a list of images.  The primary headers are
+    scanned directly (see fitshead_lib.py) by nproc threads; with a header
+    catalogue (metacat_lib.header_cat) the keywords are taken from it when
+    the files have not changed.  Missing keywords are set to 'Nada' '''
+    if catalog is not None:
+        return catalog.read_keys(list, keys)
+    return scan_files(list, keys, 0, nproc)
+
+
+# Index of the sky frames by filter, date and position
+class sky_index:
+    """ Index of a list of sky frames, to find quickly those close in time
+    and position to a given image.
+
+    The frames are grouped by FILTER, and within each group sorted by
+    MJDATE, so that the frames within dtime of a date are found by binary
+    search.  Large groups also get a KD-tree on (RA, DEC) that is used when
+    many frames fall in the time window.  The final selection uses the same
+    distance and time tests as the get_skylist* functions, and returns the
+    indices of the frames in the list, sorted by time difference (ties in
+    list order).  Frames with non-numeric date or position are ignored.
+    """
+
+    def __init__(self, sublist, data_sub, kd_min=256):
+        self.kd_min = kd_min
+        rows = {}
+        for ind in range(len(sublist)):
+            try:
+                vals = [float(data_sub[k][ind]) for k in ('MJDATE', 'RA_DEG', 'DEC_DEG')]
+            except (TypeError, ValueError):
+                continue
+            rows.setdefault(data_sub['FILTER'][ind], []).append([ind] + vals)
+
+        self.groups = {}
+        for filt in rows:
+            arr = numpy.array(rows[filt])
+            arr = arr[numpy.argsort(arr[:, 1], kind='mergesort')]
+            grp = {}
+            grp['ind'] = arr[:, 0].astype(int)
+            grp['mjd'] = arr[:, 1]
+            grp['ra']  = arr[:, 2]
+            grp['dec'] = arr[:, 3]
+            grp['name'] = numpy.array([sublist[i] for i in grp['ind']], dtype=object)
+            if 'JITTER_I' in data_sub:
+                grp['jitter'] = numpy.array([data_sub['JITTER_I'][i] for i in grp['ind']], dtype=object)
+            grp['tree'] = None
+            if cKDTree is not None and len(arr) >= kd_min:
+                grp['tree'] = cKDTree(arr[:, 2:4])
+            self.groups[filt] = grp
+
+    def query(self, filter0, date0, ra0, dec0, cosdec2, dtime, dist2, exclude_im=None, exclude_ind=None, jitter=None):
+        """ Indices of the frames of filter filter0 within dtime of date0 and
+        with (dRA^2 * cosdec2 + dDEC^2) <= dist2, excluding image exclude_im,
+        index exclude_ind and, if given, the frames with JITTER_I == jitter """
+        grp = self.groups.get(filter0)
+        if grp is None:
+            return []
+
+        # time window (with a margin for the rounding; exact test below)
+        lo = numpy.searchsorted(grp['mjd'], date0 - dtime - 1.e-9, 'left')
+        hi = numpy.searchsorted(grp['mjd'], date0 + dtime + 1.e-9, 'right')
+        sel = numpy.arange(lo, hi)
+
+        # many frames in the window: preselect on position with the tree
+        if grp['tree'] is not None and len(sel) > self.kd_min and cosdec2 > 0:
+            rad = math.sqrt(dist2 / cosdec2) * (1 + 1.e-9)
+            near = grp['tree'].query_ball_point([ra0, dec0], rad)
+            sel = numpy.intersect1d(sel, near)
+
+        dt = numpy.abs(date0 - grp['mjd'][sel])
+        dra = grp['ra'][sel] - ra0
+        ddec = grp['dec'][sel] - dec0
+        ok = (dt <= dtime) & (dra * dra * cosdec2 + ddec * ddec <= dist2)
+        if exclude_im is not None:
+            ok &= (grp['name'][sel] != exclude_im)
+        if exclude_ind is not None:
+            ok &= (grp['ind'][sel] != exclude_ind)
+        if jitter is not None and 'jitter' in grp:
+            ok &= (grp['jitter'][sel] != jitter)
+
+        sel = sel[ok]
+        order = numpy.lexsort((grp['ind'][sel], dt[ok]))
+        return [int(i) for i in grp['ind'][sel][order]]
 
 
 # Get the list of images to perform the skysubtaction
-def get_skylist(ind0, imlist, data, options):
-    ''' Get the list of images to perform the skysubtaction '''
+def get_skylist(ind0, imlist, data, options, index=None):
+    ''' Get the list of images to perform the skysubtaction 
+    index: optional sky_index of imlist, to select the images quickly '''
     dtime = options.dtime2  # in minutes
     dist2 = options.dist2  # in arcsec
 
@@ -486,7 +701,11 @@ def get_skylist(ind0, imlist, data, options):
 
     good_im = []
     dtime_list = []
-    for ind in range(len(imlist)):
+    if index is not None:     # preselection, same tests below
+        cand = index.query(filter0, date0, ra0, dec0, (math.cos(dec0)) ** 2, options.dtime2, dist2, exclude_ind=ind0)
+    else:
+        cand = range(len(imlist))
+    for ind in cand:
 	if ind != ind0 and filter0 == data['FILTER'][ind]:
 	    d2 = (data['RA_DEG'][ind] - ra0) * (data['RA_DEG'][ind] - ra0) * (math.cos(dec0)) ** 2 + (data['DEC_DEG'][ind] - dec0) * (data['DEC_DEG'][ind] - dec0)
 	    if d2 <= dist2:
@@ -494,8 +713,7 @@ def get_skylist(ind0, imlist, data, options):
 		dtime_list.append(abs(data['MJDATE'][ind0] - data['MJDATE'][ind]))
 
     # sort
-    dtime_sorted = range(len(good_im))
-    dtime_sorted.sort(lambda x, y: cmp(dtime_list[x], dtime_list[y]))
+    dtime_sorted = sorted(range(len(good_im)), key=dtime_list.__getitem__)
 
     # final list
     final = []
@@ -508,8 +726,9 @@ def get_skylist(ind0, imlist, data, options):
 
 
 # Get the list of images to perform the skysubtaction (with sublist)
-def get_skylist_sub(im, ind0, sublist, data, data_sub, options):
-    ''' Get the list of images to perform the skysubtaction '''
+def get_skylist_sub(im, ind0, sublist, data, data_sub, options, index=None):
+    ''' Get the list of images to perform the skysubtaction
+    index: optional sky_index of sublist, to select the images quickly '''
     dtime = options.dtime2  # in minutes
     dist2 = options.dist2  # in arcsec
 
@@ -527,7 +746,11 @@ def get_skylist_sub(im, ind0, sublist, data, data_sub, options):
     good_im = []
     dtime_list = []
     filename_list = []
-    for ind in range(len(sublist)):
+    if index is not None:     # preselection, same tests below
+        cand = index.query(filter0, date0, ra0, dec0, cosdec2, options.dtime2, dist2, exclude_im=im)
+    else:
+        cand = range(len(sublist))
+    for ind in cand:
 	if sublist[ind] != im and filter0 == data_sub['FILTER'][ind]:
 	    d2 = (data_sub['RA_DEG'][ind] - ra0) * (data_sub['RA_DEG'][ind] - ra0) * cosdec2 + (data_sub['DEC_DEG'][ind] - dec0) * (data_sub['DEC_DEG'][ind] - dec0)
 	    if d2 <= dist2:
@@ -536,10 +759,7 @@ def get_skylist_sub(im, ind0, sublist, data, data_sub, options):
 		filename_list.append(data_sub['FILENAME'][ind])
 
     # sort
-    dtime_sorted = range(len(good_im))
-    filename_sorted = range(len(good_im))
-    dtime_sorted.sort(lambda x, y: cmp(dtime_list[x], dtime_list[y]))
-    filename_sorted.sort(lambda x, y: cmp(dtime_list[x], dtime_list[y]))
+    dtime_sorted = sorted(range(len(good_im)), key=dtime_list.__getitem__)
 
 
     # final list
@@ -578,8 +798,9 @@ def get_skylist_sub(im, ind0, sublist, data, data_sub, options):
 # Get the list of images to perform the skysubtaction (with sublist) ######### TO FIX ##########
 
 
-def get_skylist_sub_new(im, ind0, sublist, data, data_sub, options):
-    ''' Get the list of images to perform the sky subtraction '''
+def get_skylist_sub_new(im, ind0, sublist, data, data_sub, options, index=None):
+    ''' Get the list of images to perform the sky subtraction
+    index: optional sky_index of sublist, to select the images quickly '''
     dtime = options.dtime2  # in minutes
     dist2 = options.dist2  # in arcsec
 
@@ -597,7 +818,11 @@ def get_skylist_sub_new(im, ind0, sublist, data, data_sub, options):
     good_im = []
     dtime_list = []
     filename_list = []
-    for ind in range(len(sublist)):
+    if index is not None:     # preselection, same tests below
+        cand = index.query(filter0, date0, ra0, dec0, cosdec2, options.dtime2, dist2, exclude_im=im)
+    else:
+        cand = range(len(sublist))
+    for ind in cand:
         if sublist[ind] != im and filter0 == data_sub['FILTER'][ind]:
             d2 = (data_sub['RA_DEG'][ind] - ra0) * (data_sub['RA_DEG'][ind] - ra0) * cosdec2 + (data_sub['DEC_DEG'][ind] - dec0) * (data_sub['DEC_DEG'][ind] - dec0)
             if d2 <= dist2:
@@ -606,10 +831,7 @@ def get_skylist_sub_new(im, ind0, sublist, data, data_sub, options):
                 filename_list.append(data_sub['FILENAME'][ind])
 
     # sort
-    dtime_sorted = range(len(good_im))
-    filename_sorted = range(len(good_im))
-    dtime_sorted.sort(lambda x, y: cmp(dtime_list[x], dtime_list[y]))
-    filename_sorted.sort(lambda x, y: cmp(dtime_list[x], dtime_list[y]))
+    dtime_sorted = sorted(range(len(good_im)), key=dtime_list.__getitem__)
 
 #    if options.numcube == 0:
     final = []
@@ -627,13 +849,14 @@ def get_skylist_sub_new(im, ind0, sublist, data, data_sub, options):
     return final2
 
 
-def get_skylist_dr6(im, ind0, sublist, data, data_sub, options):
+def get_skylist_dr6(im, ind0, sublist, data, data_sub, options, index=None):
     ''' Updates for DR6
     Get the list of images to perform the sky subtraction
     2023.apr:
     - delete some commeted lines;
     - check sky bgd values in sublist and remove outliers
     2023.aug: add jitter kwd
+    2026.oct: optional sky_index of sublist, to select the images quickly
     '''
 
     numpy.set_printoptions(precision=4)
@@ -654,7 +877,11 @@ def get_skylist_dr6(im, ind0, sublist, data, data_sub, options):
     good_im = []
     dtime_list = []
     filename_list = []
-    for ind in range(len(sublist)):
+    if index is not None:     # preselection, same tests below
+        cand = index.query(filter0, date0, ra0, dec0, cosdec2, options.dtime2, dist2, exclude_im=im, jitter=jitter0)
+    else:
+        cand = range(len(sublist))
+    for ind in cand:
 	if (sublist[ind] != im) and (filter0 == data_sub['FILTER'][ind]) and (jitter0 != data_sub['JITTER_I'][ind]) :
 	    d2 = (data_sub['RA_DEG'][ind] - ra0) * (data_sub['RA_DEG'][ind] - ra0) * cosdec2 + (data_sub['DEC_DEG'][ind] - dec0) * (data_sub['DEC_DEG'][ind] - dec0)
 	    if d2 <= dist2:
@@ -663,11 +890,7 @@ def get_skylist_dr6(im, ind0, sublist, data, data_sub, options):
 		filename_list.append(data_sub['FILENAME'][ind])
 
     # sort
-    dtime_sorted = range(len(good_im))   
-    filename_sorted = range(len(good_im))
-
-    dtime_sorted.sort(lambda x, y: cmp(dtime_list[x], dtime_list[y]))
-    filename_sorted.sort(lambda x, y: cmp(dtime_list[x], dtime_list[y]))
+    dtime_sorted = sorted(range(len(good_im)), key=dtime_list.__getitem__)
 
     final = []
     count = 0
@@ -736,55 +959,44 @@ def cp_head(infits, outhead):
     file.close()
 
 
+def sky_keys(im):
+    ''' List of the images used to build the sky (SKYIM0, SKYIM1, ...
+    keywords) of an image, and its history '''
+    hd = scan_file(im, (0,))[0]
+    listv = []
+    ind = 0
+    while 'SKYIM' + str(ind) in hd:
+        listv.append(hd['SKYIM' + str(ind)])
+        ind += 1
+    return listv, hd.get('HISTORY', [])
+
+
 def cp_skykeys(inn, outt):
     ''' Copy the list of images used to build the sky from one image to the other '''
     # Read keys
-    pi = pyfits.open(inn)
-
-    listk = []
-    listv = []
-    ind = 0
-    hdin = pi[0].header
-    while 'SKYIM' + str(ind) in hdin:
-	listk.append('SKYIM' + str(ind))
-	listv.append(pi[0].header['SKYIM' + str(ind)])
-	ind += 1
-    histkey = 1   # let's hope
-    try:
-        hist = hdin['history']
-    except:
-        histkey = 0
-    pi.close()
+    listv, hist = sky_keys(inn)
 
     # Write keys
     with pyfits.open(outt, mode='update') as pi:
-	for (key, val) in zip(listk, listv):
-	    pi[0].header[key] = val
-        if histkey:
-            for i in range(len(hist)):
-                pi[0].header['history'] = hist[i]
+        for (ind, val) in enumerate(listv):
+            pi[0].header['SKYIM' + str(ind)] = val
+        for h in hist:
+            pi[0].header['history'] = h
 
 
 def check_same_sky(im_old, skylist):
     # get the keywords
-    pi = pyfits.open(im_old)
-
-    ind = 0
-    list_k = []
-    while pi[0].header.has_key('SKYIM' + str(ind)):
-	list_k.append(pi[0].header['SKYIM' + str(ind)])
-	ind += 1
-    pi.close()
+    list_k = sky_keys(im_old)[0]
 
     print list_k
     print skylist
 
     # Check if same list of images
     if len(skylist) != len(list_k):
-	return 0
+        return 0
     for key in list_k:
-	if not key in skylist:
-	    return 0
+        if not key in skylist:
+            return 0
     return 1
 
 
@@ -805,65 +1017,207 @@ def exclude_chips(skylist, image, ext, list_exclude):
 
 
 #########################
-def med_row(args):
-    """ Compute median on a row """
-
-    (mma, i) = args
-    resu = []
-    for j in range(mma.shape[0]):
-	resu.append(numpy.median(mma[j, :].compressed()))
-    return (i, resu)
+def nanmedian_count(cube):
+    """ Median along the first axis ignoring the NaNs, and number of valid
+    values.  As numpy.nanmedian: for an even number of values it is the
+    mean of the two central ones, and NaN when there is no valid value.
+    Without NaNs only the two central values are partitioned, otherwise
+    the (short) frame axis is sorted, which puts the NaNs last. """
+    nfr = cube.shape[0]
+    nval = numpy.isfinite(cube).sum(axis=0)
+    if (nval == nfr).all():
+        part = numpy.partition(cube, [(nfr - 1) // 2, nfr // 2], axis=0)
+        lo = part[(nfr - 1) // 2]
+        hi = part[nfr // 2]
+    else:
+        srt = numpy.sort(cube, axis=0)
+        lo = numpy.take_along_axis(srt, ((nval - 1) // 2)[numpy.newaxis], axis=0)[0]
+        hi = numpy.take_along_axis(srt, (nval // 2)[numpy.newaxis], axis=0)[0]
+    return 0.5 * (lo + hi), nval
+
+
+def sorted_stats(srt, nval, nsig=3.0):
+    """ Statistics of the values of each pixel from the values sorted along
+    the first axis, NaNs last, and their number nval (as in sliding_median).
+    Returns a dictionary of float32 arrays: median, mad (median absolute
+    deviation), mean, std and var (as numpy.nanstd / nanvar), clipped (mean
+    of the values within nsig * 1.4826 * mad of the median) and the int16
+    count.  The NaNs are NaN where there is no valid value. """
+    nfr = srt.shape[0]
+    nval = numpy.asarray(nval).astype(numpy.int64)
+    lo = numpy.maximum(nval - 1, 0) // 2
+    hi = numpy.minimum(nval // 2, nfr - 1)
+    take = lambda a, idx: numpy.take_along_axis(a, idx[numpy.newaxis], axis=0)[0]
+    cnt = numpy.maximum(nval, 1).astype(numpy.float32)
+
+    # a single float32 work buffer of the size of srt for all the statistics
+    valid = numpy.isfinite(srt)
+    buf = numpy.zeros(srt.shape, dtype=numpy.float32)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        med = (0.5 * (take(srt, lo) + take(srt, hi))).astype(numpy.float32)
+        med[nval == 0] = numpy.nan
+
+        numpy.copyto(buf, srt, where=valid)
+        mean = buf.sum(axis=0) / cnt
+        numpy.subtract(buf, mean, out=buf)
+        buf[~valid] = 0
+        buf *= buf
+        var = buf.sum(axis=0) / cnt
+
+        numpy.subtract(srt, med, out=buf)      # NaNs (last) where srt is NaN
+        numpy.abs(buf, out=buf)
+        buf.sort(axis=0)
+        mad = 0.5 * (take(buf, lo) + take(buf, hi))
+
+        # |srt - med| <= cut, the NaNs excluded
+        cut = nsig * 1.4826 * mad
+        keep = (srt >= med - cut) & (srt <= med + cut)
+        nkeep = keep.sum(axis=0)
+        buf.fill(0)
+        numpy.copyto(buf, srt, where=keep)
+        clipped = buf.sum(axis=0) / numpy.maximum(nkeep, 1).astype(numpy.float32)
+        clipped[nkeep == 0] = med[nkeep == 0]
+
+    none = nval == 0
+    res = {'median': med, 'mad': mad, 'mean': mean, 'std': numpy.sqrt(var), 'var': var, 'clipped': clipped}
+    for k in res:
+        res[k] = res[k].astype(numpy.float32)
+        res[k][none] = numpy.nan
+    res['count'] = nval.astype(numpy.int16)
+    return res
+
+
+def cube_stats(cube, nsig=3.0):
+    """ sorted_stats of a frame-major cube with the masked pixels NaN: the
+    frame axis is sorted once for all the statistics """
+    srt = numpy.sort(cube, axis=0)
+    return sorted_stats(srt, numpy.isfinite(srt).sum(axis=0), nsig)
 
 
 def med_cube_multiproc(cube, options):
-    pool = Pool(processes=options.nproc)
-    imshape = cube[:, :, 0].shape
-
-    # Get the final mask / number of images for each pixel
-    cube_nval = numpy.ma.ones(cube.shape)
-    ma_nval = numpy.ma.array(cube_nval, mask=numpy.ma.getmask(cube)).sum(axis=2)
-    mask_fin = numpy.zeros(imshape)
-    mask_filled = numpy.ma.filled(ma_nval, fill_value=0)
-    ind = numpy.where(mask_filled < 1)
-    mask_fin[ind] = 1
-
-    # get the median
-    res = numpy.zeros(imshape)
-    list_args = []
-    for i in range(imshape[0]):
-	arg = [cube[i, :, :], i]
-	list_args.append(arg)
-    results = pool.map(med_row, list_args)
-    pool.close()
-    for (i, v) in results:
-	res[i, :] = v
-
-    # re-create the final mask
-    res_mask = numpy.ma.array(res, mask=mask_fin)
+    """ Median of a masked cube along its last axis; returns the median,
+    masked where no value is available, and the number of values """
+    frames = [numpy.ma.filled(cube[:, :, n].astype(numpy.float32), numpy.nan) for n in range(cube.shape[2])]
+    res, nval = combine_frames(frames, 'median', getattr(options, 'mem_max', 256) or 256, options.nproc)
+
+    res_mask = numpy.ma.array(res, mask=(nval < 1))
+    ma_nval = numpy.ma.array(nval, mask=(nval < 1))
 
     return res_mask, ma_nval
 
 
+def thread_map(func, args, nproc=1):
+    """ Apply func to each element of args with a pool of nproc threads;
+    the results are returned in order.  The threads share the memory of the
+    process, so the arrays they work on are not copied. """
+    if nproc <= 1 or len(args) <= 1:
+        return [func(arg) for arg in args]
+    pool = ThreadPool(min(nproc, len(args)))
+    try:
+        res = pool.map(func, args)
+    finally:
+        pool.close()
+        pool.join()
+    return res
+
+
+def pixel_chunks(npix, nproc):
+    """ Split range(npix) in nproc (start, end) chunks """
+    step = -(-npix // max(nproc, 1))
+    return [(p0, min(p0 + step, npix)) for p0 in range(0, npix, step)]
+
+
+def tile_rows(nframes, shape, mem_max):
+    """ Number of rows of a float32 tile of nframes frames that fits in
+    mem_max MB """
+    nrow = int(mem_max * 1024. * 1024. / (4. * nframes * shape[1]))
+    return max(1, min(nrow, shape[0]))
+
+
+def combine_frames(frames, stat='median', mem_max=256, nproc=1):
+    """ Combine a stack of frames pixel by pixel.
+
+    frames is a list of 2D arrays (or a frame-major cube) with the masked
+    pixels set to NaN.  The frames are copied by row tiles into a float32,
+    frame-major, contiguous buffer, and reduced along the frame axis with
+    stat: median, mean, std or var.  The tiles are processed by nproc
+    threads, each with its own buffer, so that at most mem_max MB are used.
+    Returns the combined float32 image and the number of valid values of
+    each pixel (the result is NaN where there is none).
+    """
+    nfr = len(frames)
+    shape = frames[0].shape
+    nrow = tile_rows(nfr, shape, mem_max / float(max(nproc, 1)))
+    func = {'mean': numpy.nanmean, 'std': numpy.nanstd, 'var': numpy.nanvar}.get(stat)
+
+    res  = numpy.empty(shape, dtype=numpy.float32)
+    nval = numpy.empty(shape, dtype=numpy.int16)
+
+    def do_tile(y0):
+        y1 = min(y0 + nrow, shape[0])
+        tile = numpy.empty((nfr, y1 - y0, shape[1]), dtype=numpy.float32)
+        for n in range(nfr):
+            tile[n] = frames[n][y0:y1]
+        if stat == 'median':
+            res[y0:y1], nval[y0:y1] = nanmedian_count(tile)
+        else:
+            nval[y0:y1] = numpy.isfinite(tile).sum(axis=0)
+            res[y0:y1] = func(tile, axis=0)
+
+    thread_map(do_tile, range(0, shape[0], nrow), nproc)
+    return res, nval
+
+
+def frame_stats(frames, mem_max=256, nproc=1, nsig=3.0):
+    """ All the statistics of cube_stats (median, mad, mean, std, var,
+    clipped, count) of a stack of frames, in one pass over row tiles as in
+    combine_frames """
+    nfr = len(frames)
+    shape = frames[0].shape
+    nrow = tile_rows(nfr, shape, mem_max / float(max(nproc, 1)))
+    res = {}
+    for k in ('median', 'mad', 'mean', 'std', 'var', 'clipped'):
+        res[k] = numpy.empty(shape, dtype=numpy.float32)
+    res['count'] = numpy.empty(shape, dtype=numpy.int16)
+
+    def do_tile(y0):
+        y1 = min(y0 + nrow, shape[0])
+        tile = numpy.empty((nfr, y1 - y0, shape[1]), dtype=numpy.float32)
+        for n in range(nfr):
+            tile[n] = frames[n][y0:y1]
+        for k, val in cube_stats(tile, nsig).items():
+            res[k][y0:y1] = val
+
+    thread_map(do_tile, range(0, shape[0], nrow), nproc)
+    return res
+
+
 def med_im(arg):
     return (arg[1], numpy.median(arg[0].flatten().compressed()))
 
 
 def get_median_fits(arg):
-    """ Get the median of a fits image """
-    (im, mask) = arg
-    mlist = []
+    """ Get the median of the unmasked pixels of each chip of a fits image;
+    arg is (im, mask), or (im, mask, cache) to take the levels from / keep
+    them in a skylevel_lib.level_cache """
+    (im, mask) = arg[:2]
+    cache = arg[2] if len(arg) > 2 else None
 
     pyim = pyfits.open(im)
-    pymask = pyfits.open(mask)
     next = len(pyim)
+    if cache is not None:
+        pyim.close()
+        if next == 1:
+            return [im, cache.get(im, 0)]
+        return [im, cache.get_all(im, range(1, next))]
+
+    pymask = pyfits.open(mask)
     if next == 1:
-	im_mask = numpy.ma.array(pyim[0].data, mask=1 - pymask[0].data)
-	mlist = [im, numpy.median(im_mask.compressed())]
+	mlist = [im, masked_level(pyim[0].data, pymask[0].data)]
     else:
 	mmlist = []
 	for iext in range(next)[1:]:
-	    im_mask = numpy.ma.array(pyim[iext].data, mask=1 - pymask[iext].data)
-	    mmlist.append(numpy.median(im_mask.compressed()))
+	    mmlist.append(masked_level(pyim[iext].data, pymask[iext].data))
 	mlist = [im, mmlist]
     pyim.close()
     pymask.close()
@@ -871,247 +1225,122 @@ def get_median_fits(arg):
     return mlist
 
 
-#########################
-
-def compute_sky_linreg(im00, iext, SKY_median, data_y, skylist, sky_im):
-    """ Compute the sky with a linear regression """
-
-    ext = iext
-
-    # Mean of each px (i,j) values (across the "sky image" axis)
-    mean_data_y = numpy.ma.mean(data_y, axis=0)
+def level_cache_opt(options):
+    """ skylevel_lib.level_cache of the options: --level-dir, and
+    --level-approx with --level-tol for approximate levels """
+    method = 'approx' if getattr(options, 'level_approx', False) else 'median'
+    return level_cache(getattr(options, 'level_dir', '') or None, options.inmask_suf, method,
+                       getattr(options, 'level_tol', 0.5))
 
-    # Subtract mean
-    dmean_y = numpy.ma.array(numpy.zeros(data_y.shape), mask=numpy.ma.getmask(data_y))
-    for i in range(data_y.shape[0]):
-	dmean_y[i] = data_y[i] - mean_data_y
 
-    ########################
-    # Get the median lists #
-    ########################
+def sky_median_table(options):
+    """ SKY_median table of the create_skyim_SCALELVL* functions: the masked
+    levels of the chips, from the sidecar files (skylevel_lib.py) """
+    return level_table(level_cache_opt(options))
 
-    data_x = []
-    for im in skylist:
-	data_x.append(SKY_median[im][iext - 1])
-    t_data_x = numpy.array(data_x)
-
-    np_data_x = numpy.transpose(numpy.tile(t_data_x, (data_y.shape[1], 1)))  # Numpy version
-    ma_data_x = numpy.ma.array(np_data_x, mask=numpy.ma.getmask(data_y))     # masked array version
-
-    # Mean value of median_sky for each pixel (mean on the "sky images" axis)
-    mean_data_x = numpy.ma.mean(ma_data_x, axis=0)
-
-    # Subtract mean from the median values
-    dmean_x0 = np_data_x - numpy.array([mean_data_x for i in range(data_y.shape[0])])
-    dmean_x = numpy.ma.array(dmean_x0, mask=numpy.ma.getmask(data_y))
-
-    ##########################
-    # Compute the regression #
-    ##########################
-
-    ma_data_x2 = ma_data_x * ma_data_x
-    dmean_x2 = dmean_x * dmean_x
-
-    num = dmean_x * dmean_y
-    snum = num.sum(axis=0)
-    sdenom = dmean_x2.sum(axis=0)
-
-    aa = snum / sdenom
-    bb = mean_data_y - aa * mean_data_x
-
-    np_ar = numpy.reshape(numpy.ma.filled(aa, 0), sky_im[skylist[0]][0].shape)
-    np_br = numpy.reshape(numpy.ma.filled(bb, 0), sky_im[skylist[0]][0].shape)
 
+#########################
 
-    #####################
-    # Get the sky image #
-    #####################
-
-    sky_im0 = (np_ar * SKY_median[im00][ext - 1] + np_br)
-
-    return sky_im0
+def linreg_frames(frames, xlev, x0, nsig=2.0, niter=1, mem_max=256, nproc=1):
+    """ Pixel by pixel linear regression y = a*x + b of a stack of frames on
+    their sky levels, evaluated at the level x0.
+
+    frames is a list of 2D arrays with the masked pixels set to NaN, or of
+    masked arrays, and xlev their levels.  The regression is computed from
+    the per-pixel sums n, Sx, Sxx, Sy, Sxy accumulated frame by frame over
+    float32 row tiles (at most mem_max MB, processed by nproc threads), the
+    levels being centred on their mean.  Then, niter times, the values more
+    than nsig times the rms of the residuals away from the fit are rejected
+    and the regression is recomputed.  Where the levels of the valid frames
+    are all equal the sky is their mean.
+    Returns the float32 sky (NaN where there is no valid value) and the
+    number of values used for each pixel.
+    """
+    nfr = len(frames)
+    shape = frames[0].shape
+    xlev = numpy.asarray(xlev, dtype=numpy.float64)
+    xm = xlev.mean()
+    xc = xlev - xm
+    nrow = tile_rows(nfr + 1, shape, mem_max / float(max(nproc, 1)))
+
+    sky  = numpy.empty(shape, dtype=numpy.float32)
+    nval = numpy.empty(shape, dtype=numpy.int16)
+
+    def fit(tile, keep):
+        n   = numpy.zeros(tile.shape[1:])
+        sx  = numpy.zeros(tile.shape[1:])
+        sxx = numpy.zeros(tile.shape[1:])
+        sy  = numpy.zeros(tile.shape[1:])
+        sxy = numpy.zeros(tile.shape[1:])
+        for i in range(nfr):
+            k = keep[i]
+            y = numpy.where(k, tile[i], 0)
+            n   += k
+            sx  += k * xc[i]
+            sxx += k * xc[i]**2
+            sy  += y
+            sxy += xc[i] * y
+        denom = n * sxx - sx * sx
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            a = numpy.where(denom > 1e-12 * n * n, (n * sxy - sx * sy) / denom, 0.)
+            b = (sy - a * sx) / n
+        return a, b, n
+
+    def do_tile(y0):
+        y1 = min(y0 + nrow, shape[0])
+        tile = numpy.empty((nfr, y1 - y0, shape[1]), dtype=numpy.float32)
+        for i in range(nfr):
+            tile[i] = numpy.ma.filled(frames[i][y0:y1].astype(numpy.float32), numpy.nan)
+        keep = numpy.isfinite(tile)
+        a, b, n = fit(tile, keep)
+
+        for it in range(niter):
+            ss = numpy.zeros(tile.shape[1:])
+            for i in range(nfr):
+                r = tile[i] - (a * xc[i] + b)
+                ss += numpy.where(keep[i], r * r, 0)
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                lim = nsig * numpy.sqrt(ss / n)
+            nrej = 0
+            for i in range(nfr):
+                with numpy.errstate(invalid='ignore'):
+                    out = keep[i] & (numpy.abs(tile[i] - (a * xc[i] + b)) > lim)
+                keep[i] &= ~out
+                nrej += out.sum()
+            if nrej == 0:
+                break
+            a, b, n = fit(tile, keep)
+
+        sky[y0:y1] = a * (x0 - xm) + b
+        nval[y0:y1] = n
+
+    thread_map(do_tile, range(0, shape[0], nrow), nproc)
+    return sky, nval
 
 
 def create_skyim_SCALELVL2(im00, skylist, sub_im, sky_im, ext, outim, SKY_median, options):
-    """ Create a sky image with pattern normalized to BACKLVL=1000 / median around 0 """
-    iext = ext
+    """ Create the sky image of im00 from a linear regression, pixel by pixel,
+    of the sky frames on their median levels, with one 2-sigma clipping of
+    the outliers (see linreg_frames).  Returns the sky (0 where there is no
+    valid value) and the number of values used for each pixel.  With
+    SKY_median None the levels are those of the sidecar files. """
 
+    if SKY_median is None:
+        SKY_median = sky_median_table(options)
+    frames = [sky_im[im][ext - 1] for im in skylist]
+    levels = [SKY_median[im][ext - 1] for im in skylist]
 
-    #############################
-    # Open the images in pyfits #
-    #############################
-
-    pyim_list = {}
-    for im in skylist:
-	pyim_list[im] = sky_im[im][iext - 1]
+    sky, nval = linreg_frames(frames, levels, SKY_median[im00][ext - 1], nsig=2.0, niter=1,
+                              mem_max=getattr(options, 'mem_max', 256) or 256,
+                              nproc=getattr(options, 'nproc', 1))
 
-    imshape = pyim_list[skylist[0]].shape
-
-    #################################
-    # Get the flattened pixel lists #
-    #################################
-
-    im_3d = []
-    mask_3d = []
-    for ii, im in enumerate(skylist):
-	im_3d.append(numpy.ma.array(sky_im[im][ext - 1].flatten()))
-	mask_3d.append(numpy.array(numpy.ma.getmask(sky_im[im][ext - 1]).flatten()))
-    data_y = numpy.ma.array(numpy.array(im_3d), mask=numpy.array(mask_3d))
-
-    # Mean of each px (i,j) values (across the "sky image" axis)
-    mean_data_y = numpy.ma.mean(data_y, axis=0)
-
-    # Subtract mean
-    dmean_y = numpy.ma.array(numpy.zeros(data_y.shape), mask=numpy.ma.getmask(data_y))
-    for i in range(data_y.shape[0]):
-	dmean_y[i] = data_y[i] - mean_data_y
-
-    ########################
-    # Get the median lists #
-    ########################
-
-    data_x = []
-    for im in skylist:
-	data_x.append(SKY_median[im][iext - 1])
-    t_data_x = numpy.array(data_x)
-
-    np_data_x = numpy.transpose(numpy.tile(t_data_x, (data_y.shape[1], 1)))  # Numpy version
-    ma_data_x = numpy.ma.array(np_data_x, mask=numpy.ma.getmask(data_y))  # masked array version
-
-    # Mean value of median_sky for each pixel (mean on the "sky images" axis)
-    mean_data_x = numpy.ma.mean(ma_data_x, axis=0)
-
-    # Subtract mean from the median values
-    dmean_x0 = np_data_x - numpy.array([mean_data_x for i in range(data_y.shape[0])])
-    dmean_x = numpy.ma.array(dmean_x0, mask=numpy.ma.getmask(data_y))
-
-    ##########################
-    # Compute the regression #
-    ##########################
-
-    ma_data_x2 = ma_data_x * ma_data_x
-    dmean_x2 = dmean_x * dmean_x
-
-    num = dmean_x * dmean_y
-    snum = num.sum(axis=0)
-    sdenom = dmean_x2.sum(axis=0)
-
-    aa = snum / sdenom
-    bb = mean_data_y - aa * mean_data_x
-
-    np_ar = numpy.reshape(numpy.ma.filled(aa, 0), sky_im[skylist[0]][0].shape)
-    np_br = numpy.reshape(numpy.ma.filled(bb, 0), sky_im[skylist[0]][0].shape)
-
-
-    #####################
-    # Get the sky image #
-    #####################
-
-    sky_im0 = (np_ar * SKY_median[im00][ext - 1] + np_br)
-
-
-    ##################
-    # Sigma clipping #
-    ##################
-
-    if 1:
-	print "SIze sky_im0 ", sky_im0.shape
-	print "Size data_y", data_y.shape
-
-	# sky = numpy.tile(aa * SKY_median[im00][ext-1] + bb,(data_y.shape[0],1))
-	# print "Size sky ",sky.shape
-
-	# Get the expected values (from a*MEDIAN+b) for each pixel for each sky image
-	sky_medians = numpy.array([SKY_median[imm][ext - 1] for imm in skylist])
-	print "Size medians ", sky_medians.shape
-
-	sky_medians2 = numpy.transpose(numpy.tile(sky_medians, (data_y.shape[1], 1)))
-	print "Size medians2 ", sky_medians2.shape
-
-	a_s = numpy.tile(aa, (data_y.shape[0], 1))
-	b_s = numpy.tile(bb, (data_y.shape[0], 1))
-
-	print "a_s_shape ", a_s.shape
-	print "b_s_shape ", b_s.shape
-
-	# Get the expected values from the linear regression for each pixel
-	expected = a_s * sky_medians2 + b_s
-
-	print "expected shape ", expected.shape
-
-	print "TEST", aa.shape
-	print sky_medians
-
-	print a_s[0, 10000]
-	print b_s[0, 10000]
-
-	print sky_medians
-	print expected[:, 10000]
-	print data_y[:, 10000]
-
-	# Get the residual
-	res0 = data_y - expected
-	res = numpy.ma.array(res0, mask=numpy.ma.getmask(data_y))
-
-	# Get the std for the clipping
-	std_res = numpy.ma.std(res, axis=0)
-	print "std res shape ", std_res.shape
-	print "std res 10000", std_res[10000]
-	print "res 10000", res[:, 10000]
-
-	nsig = 2.0
-
-	std_res2 = numpy.tile(std_res, (data_y.shape[0], 1))
-	print "std_res2 shape", std_res2.shape
-
-	# Get the sigma normalized residual
-	limit = res / std_res2
-
-
-	# Get the outliers
-	ind = numpy.where(abs(limit) > nsig)
-	print len(ind)
-	print len(ind[0])
-	print len(ind[0]) * 1.0 / (data_y.shape[1] * 1.0) / (data_y.shape[0] * 1.0)
-
-	###############
-	if 0:
-	    j = 0
-	    k = 336323
-	    print j, k
-	    j = ind[0][k]
-	    for k0 in range(1000):
-		k = k0 * 33
-		print "\n\nTEST"
-		j = ind[0][k]
-		for i in range(9):
-		    print sky_medians[i], expected[i, j], data_y[i, j], res[i, j], std_res2[i, j], limit[i, j]
-	################
-
-	# Mask the outliers
-	data_y[ind] = numpy.ma.masked
-
-	# Recompute the sky
-	sky_new = compute_sky_linreg(im00, iext, SKY_median, data_y, skylist, sky_im)
-
-    skyy = numpy.reshape(numpy.ma.filled(sky_im0, 0), sky_im[skylist[0]][0].shape)
-    # fitslib.narray2fits(skyy,"sky.fits")
-    # sys.exit(0)
-
-    ######################
-    # Get the nval image #
-    ######################
-
-    nval = numpy.ones(data_y.shape)
-    ma_nval = numpy.ma.array(nval, mask=numpy.ma.getmask(data_y))
-    nval_tot = ma_nval.sum(axis=0)
-    nval = numpy.reshape(numpy.ma.filled(nval_tot, 0), sky_im[skylist[0]][0].shape)
-
-    return sky_im0, nval
+    return numpy.nan_to_num(sky), nval
 
 
 def create_skyim_SCALELVL(skylist, ext, outim, SKY_median, options):
-    """ Create a sky image with pattern normalized to BACKLVL=1000 / median around 0 """
+    """ Create a sky image with pattern normalized to BACKLVL=1000 / median around 0.
+    With SKY_median None the levels are taken from the sidecar files, and
+    those missing are computed from the frames read here """
     iext = ext
 
     options.SKYLVL_method = "median"
@@ -1121,58 +1350,503 @@ def create_skyim_SCALELVL(skylist, ext, outim, SKY_median, options):
     #############################
 
     # print "Read the im/mask"
-    pyim_list = {}
+    frames = []
     for im in skylist:
-	pyim_list[im] = []
 	pyim = pyfits.open(im)
 
 	mask = im.split(".fits")[0] + options.inmask_suf
 	pymask = pyfits.open(mask)
 
-	pyim_list[im] = numpy.ma.array(pyim[iext].data, mask=1 - pymask[iext].data, dtype=numpy.float64)
+	data = pyim[iext].data.astype(numpy.float32)
+	data[pymask[iext].data == 0] = numpy.nan
+	frames.append(data)
 
 	pyim.close()
 	pymask.close()
 
-    imshape = pyim_list[skylist[0]].shape
-
-    #############################
-    # Data cube with all images #
-    #############################
-
-    cube_array = numpy.ma.dstack([pyim_list[im] for im in skylist])
-
     ######################
     # List of sky levels #
     # Scale if needed    #
     ######################
 
-    SKLVL = numpy.array([SKY_median[im][iext - 1] for im in skylist])
+    if SKY_median is None:
+        cache = level_cache_opt(options)
+        SKLVL = numpy.array([cache.get(im, iext, fr) for (im, fr) in zip(skylist, frames)])
+    else:
+        SKLVL = numpy.array([SKY_median[im][iext - 1] for im in skylist])
 
     for i, lvl in enumerate(SKLVL):
 	if options.noscale:
-	    cube_array[:, :, i] -= lvl
+	    frames[i] -= lvl
 	else:
-	    cube_array[:, :, i] = (cube_array[:, :, i] - lvl) / lvl * 1000.0
-
-    ########################
-    # For number of pixels #
-    ########################
-
-    sky_nn = numpy.ma.array(numpy.ones(cube_array.shape), mask=numpy.ma.getmask(cube_array))
+	    frames[i] -= lvl
+	    frames[i] *= 1000.0 / lvl
 
     ###############
     # Get the sky #
     ###############
+    mem_max = getattr(options, 'mem_max', 256) or 256
     if options.meansky:      # Use mean
-	sky_lvl = cube_array.mean(axis=2)
-	if options.npix:
-	    sky_nval = numpy.ma.filled(sky_nn.sum(axis=2), fill_value=0)
-	else:
+	sky_lvl, sky_nval = combine_frames(frames, 'mean', mem_max, getattr(options, 'nproc', 1))
+	if not options.npix:
 	    sky_nval = 0
     else:  # Use median
-	sky_lvl, sky_nval = med_cube_multiproc(cube_array, options)
+	sky_lvl, sky_nval = combine_frames(frames, 'median', mem_max, getattr(options, 'nproc', 1))
 
-    return sky_lvl, sky_nval
+    return numpy.ma.masked_invalid(sky_lvl), sky_nval
 
 #########################
+
+
+#-----------------------------------------------------------------------------
+# Streaming access to the sky frames (mkAltSky.py)
+#-----------------------------------------------------------------------------
+
+class sky_frame_buffer:
+    """ Bounded ring buffer of decoded, masked chips of the sky frames.
+
+    Holds one extension only.  Each entry is (data, mask, level) where data
+    is the float32 chip with the masked pixels set to NaN, mask is the chip
+    of the input mask, bit-packed (mask_lib.bitmask: numpy sees it as the
+    0/1 mask), and level the median of the unmasked pixels.  When the
+    buffer is full the least recently used frame is dropped, so that when the
+    targets are walked in time order each frame is read from disk only once.
+    With a level cache (skylevel_lib.level_cache) the levels are taken from
+    the sidecar files of the frames when there.
+
+    The frames are stored normalised by their own level, which makes them
+    independent of the target:
+    - method 'rescale':  data / level
+    - method 'subtract': data - level
+    - method None:       data as read
+
+    The frames of the next target can be read ahead by a background thread
+    (prefetch).  They count in the nbuf frames of the buffer.  Only the
+    reading is done in that thread; the levels (and the level cache) are
+    handled in the calling thread, by get().
+    """
+
+    def __init__(self, ext, nbuf, mask_suf="_mask.fits", method=None, levels=None):
+        self.ext = ext
+        self.nbuf = max(nbuf, 1)
+        self.mask_suf = mask_suf
+        self.method = method
+        self.levels = levels        # skylevel_lib.level_cache, or None
+        self.frames = OrderedDict()
+        self.pending = OrderedDict()  # frames being read ahead
+        self.pool = None
+        self.nread = 0
+
+    def __contains__(self, im):
+        return im in self.frames
+
+    def load(self, im):
+        """ Read chip ext of image im and of its mask; the masked pixels of
+        the chip are set to NaN.  Touches no state of the buffer, so that it
+        can run in the background thread. """
+        pim = pyfits.open(im)
+        pmsk = pyfits.open(im.split('.fits')[0] + self.mask_suf)
+        data = pim[self.ext].data.astype(numpy.float32)
+        mask = bitmask.from_array(pmsk[self.ext].data)
+        pim.close()
+        pmsk.close()
+
+        mask.apply(data, numpy.nan)               # masked regions set to NaN
+        return (data, mask)
+
+    def read(self, im, loaded=None):
+        """ The (data, mask, level) entry of image im, from its chip as given
+        by load() (read now if not given) """
+        (data, mask) = loaded or self.load(im)
+        if self.levels is not None:
+            level = self.levels.get(im, self.ext, data)
+        else:
+            level = numpy.nanmedian(data)
+        if self.method == 'rescale':
+            data /= level
+        elif self.method == 'subtract':
+            data -= level
+        self.nread += 1
+        return (data, mask, level)
+
+    def make_room(self, keep=()):
+        """ Drop the least recently used frames that are not in keep until
+        one more frame fits in the buffer, the frames being read ahead
+        included; False if that is not possible """
+        while len(self.frames) + len(self.pending) >= self.nbuf:
+            old = next((x for x in self.frames if x not in keep), None)
+            if old is None:
+                return False
+            del self.frames[old]
+        return True
+
+    def get(self, im):
+        """ Return the (data, mask, level) entry for image im """
+        if im in self.frames:
+            entry = self.frames.pop(im)
+        else:
+            if im in self.pending:
+                entry = self.read(im, self.pending.pop(im).get())
+            else:
+                entry = self.read(im)
+            self.make_room()
+        self.frames[im] = entry
+        return entry
+
+    def prefetch(self, ims, current=()):
+        """ Start reading, in a background thread, the frames ims of the next
+        target that are neither in the buffer nor already being read.  Room
+        is made for them by dropping the least recently used frames that are
+        neither in ims nor in current (the frames of the current target);
+        when there is not enough, the last ones are not read ahead.  Frames
+        read ahead that are in neither list are dropped. """
+        keep = set(ims) | set(current)
+        for im in [x for x in self.pending if x not in keep]:
+            del self.pending[im]
+        if self.pool is None:
+            self.pool = ThreadPool(1)
+        for im in ims:
+            if im in self.frames or im in self.pending:
+                continue
+            if not self.make_room(keep):
+                break
+            self.pending[im] = self.pool.apply_async(self.load, (im,))
+
+    def close(self):
+        """ Stop the background thread and drop the frames read ahead """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.pending.clear()
+
+
+class sky_set_memo:
+    """ Small LRU store of the products computed from a set of sky frames,
+    keyed by the sorted list of frames.  Targets with the same sky list
+    then reuse the same stack median. """
+
+    def __init__(self, nmax=4):
+        self.nmax = max(nmax, 1)
+        self.sets = OrderedDict()
+        self.nhit = 0
+
+    def key(self, skylist):
+        return tuple(sorted(skylist))
+
+    def get(self, skylist):
+        """ Return the products stored for skylist, or None """
+        key = self.key(skylist)
+        if key not in self.sets:
+            return None
+        self.nhit += 1
+        val = self.sets.pop(key)
+        self.sets[key] = val
+        return val
+
+    def put(self, skylist, val):
+        key = self.key(skylist)
+        if key in self.sets:
+            del self.sets[key]
+        while len(self.sets) >= self.nmax:
+            self.sets.popitem(last=False)
+        self.sets[key] = val
+
+
+class sliding_median:
+    """ Per-pixel median of a set of frames that changes a little at a time.
+
+    The values of each pixel are kept sorted along the first axis of an
+    (nmax, npix) float32 array, with the NaNs (masked pixels and unused
+    slots) at the end.  When the set of frames changes only the frames that
+    are dropped or added are deleted from / inserted in the sorted columns;
+    the array is rebuilt with a full sort when more than a fraction rebuild
+    of the set changes.  The sum of the masks (counts map) is kept as well.
+    """
+
+    def __init__(self, nmax, rebuild=0.5, nproc=1):
+        self.nmax = nmax
+        self.rebuild = rebuild
+        self.nproc = nproc
+        self.frames = OrderedDict()      # name -> (data, mask) of the current set
+        self.sorted = None
+        self.nval = None
+        self.counts = None
+        self.shape = None
+        self.nupdate = 0
+        self.nbuild = 0
+
+    def build(self):
+        """ Rebuild the sorted array from the current frames """
+        self.sorted = numpy.empty((self.nmax, self.npix), dtype=numpy.float32)
+        self.sorted.fill(numpy.nan)
+        self.counts = None
+        for n, (data, mask) in enumerate(self.frames.values()):
+            self.sorted[n] = data.ravel()
+            if self.counts is None:
+                self.counts = numpy.zeros(mask.shape, dtype=mask.dtype)
+            self.counts += mask
+
+        def sort_chunk(chunk):
+            self.sorted[:, chunk[0]:chunk[1]].sort(axis=0)
+        thread_map(sort_chunk, pixel_chunks(self.npix, self.nproc), self.nproc)
+        self.nval = numpy.isfinite(self.sorted).sum(axis=0).astype(numpy.int16)
+        self.nbuild += 1
+
+    def insert_chunk(self, val, p0, p1):
+        srt = self.sorted[:, p0:p1]
+        val = val[p0:p1]
+        idx = (srt < val).sum(axis=0)
+        idx[~numpy.isfinite(val)] = self.nmax
+        for k in range(self.nmax - 1, 0, -1):
+            numpy.copyto(srt[k], srt[k - 1], where=(idx < k))
+            numpy.copyto(srt[k], val, where=(idx == k))
+        numpy.copyto(srt[0], val, where=(idx == 0))
+
+    def delete_chunk(self, val, p0, p1):
+        srt = self.sorted[:, p0:p1]
+        val = val[p0:p1]
+        ok = numpy.isfinite(val)
+        idx = (srt < val).sum(axis=0)
+        idx[~ok] = self.nmax
+        for k in range(self.nmax - 1):
+            numpy.copyto(srt[k], srt[k + 1], where=(idx <= k))
+        srt[self.nmax - 1][ok] = numpy.nan
+
+    def insert(self, data, mask):
+        """ Insert the values of a frame in the sorted columns """
+        val = data.ravel()
+        thread_map(lambda c: self.insert_chunk(val, c[0], c[1]), pixel_chunks(self.npix, self.nproc), self.nproc)
+        self.nval += numpy.isfinite(val)
+        self.counts += mask
+
+    def delete(self, data, mask):
+        """ Delete the values of a frame from the sorted columns """
+        val = data.ravel()
+        thread_map(lambda c: self.delete_chunk(val, c[0], c[1]), pixel_chunks(self.npix, self.nproc), self.nproc)
+        self.nval -= numpy.isfinite(val)
+        self.counts -= mask
+
+    def update(self, names, get):
+        """ Make names the current set of frames; get(name) returns the
+        (data, mask) of a frame not yet in the set """
+        drop = [nn for nn in self.frames if nn not in names]
+        add  = [nn for nn in names if nn not in self.frames]
+        if len(drop) == 0 and len(add) == 0:
+            return
+
+        if len(names) > self.nmax:
+            self.nmax = len(names)
+            self.sorted = None
+        rebuild = self.sorted is None or len(drop) + len(add) > self.rebuild * len(names)
+
+        for nn in drop:
+            if not rebuild:
+                self.delete(*self.frames[nn])
+            del self.frames[nn]
+        for nn in add:
+            self.frames[nn] = get(nn)
+            if self.shape is None:
+                self.shape = self.frames[nn][0].shape
+                self.npix = self.frames[nn][0].size
+            if not rebuild:
+                self.insert(*self.frames[nn])
+
+        if rebuild:
+            self.build()
+        else:
+            self.nupdate += 1
+
+    def median(self):
+        """ Median of the valid values of each pixel (NaN if none) """
+        ipix = numpy.arange(self.npix)
+        lo = self.sorted[(self.nval.astype(int) - 1) // 2, ipix]
+        hi = self.sorted[self.nval // 2, ipix]
+        return (0.5 * (lo + hi)).reshape(self.shape)
+
+    def values(self):
+        """ The sorted values, as an (nmax, ny, nx) array """
+        return self.sorted.reshape((self.nmax,) + self.shape)
+
+    def stats(self, nsig=3.0, mem_max=256):
+        """ sorted_stats of the current set, from the values already sorted,
+        by row tiles within mem_max MB as in frame_stats """
+        nrow = tile_rows(self.nmax, self.shape, mem_max / float(max(self.nproc, 1)))
+        step = nrow * self.shape[1]
+        res = {}
+        for k in ('median', 'mad', 'mean', 'std', 'var', 'clipped'):
+            res[k] = numpy.empty(self.npix, dtype=numpy.float32)
+        res['count'] = numpy.empty(self.npix, dtype=numpy.int16)
+
+        def do_tile(p0):
+            p1 = min(p0 + step, self.npix)
+            for k, val in sorted_stats(self.sorted[:, p0:p1], self.nval[p0:p1], nsig).items():
+                res[k][p0:p1] = val
+        thread_map(do_tile, range(0, self.npix, step), self.nproc)
+
+        for k in res:
+            res[k] = res[k].reshape(self.shape)
+        return res
+
+
+#-----------------------------------------------------------------------------
+# Native median sky combine (mkSky.py --engine native)
+#-----------------------------------------------------------------------------
+
+def median_sky_exts(skylist, exts, mask_suf="_mask.fits", options=None):
+    """ Median sky of a list of sky frames, pixel by pixel in detector
+    coordinates, as swarp builds it in mkSky.py (nearest neighbour
+    resampling to the same grid, background subtracted with a mesh larger
+    than the chips, median combine with the masks as weights).  The
+    background of a frame is that of a single mesh over the chip, computed
+    as SWarp and SExtractor do it (background_lib.mesh_stats).
+
+    For each extension of exts yields (ext, sky, nval): the float32 sky,
+    0 where no frame is valid, and the number of frames used per pixel.
+    The frames are read with memory mapping, one extension at a time. """
+    mem_max = getattr(options, 'mem_max', 256) or 256
+    nproc = getattr(options, 'nproc', 1)
+
+    pyims  = [pyfits.open(im) for im in skylist]
+    pymask = [pyfits.open(im.split('.fits')[0] + mask_suf) for im in skylist]
+    try:
+        for ext in exts:
+            frames = []
+            for (pi, pm) in zip(pyims, pymask):
+                data = pi[ext].data.astype(numpy.float32)
+                bad = pm[ext].data == 0
+                data[bad] = numpy.nan
+                level = mesh_stats(data, None, data.shape[1], data.shape[0])[0][0, 0]
+                if level > -BIG:                # else too few valid pixels: as is
+                    data -= level
+                frames.append(data)
+            sky, nval = combine_frames(frames, 'median', mem_max, nproc)
+            sky[nval == 0] = 0
+            yield ext, sky, nval
+    finally:
+        for p in pyims + pymask:
+            p.close()
+
+
+#-----------------------------------------------------------------------------
+# Writing of multi-extension FITS files (in place of missfits)
+#-----------------------------------------------------------------------------
+
+def read_exp(expfile):
+    """ Cards of a missfits .exp (or swarp .head) sidecar file """
+    cards = []
+    for line in open(expfile):
+        line = line.rstrip('\n')
+        if line.strip() == '' or line[:8].strip() == 'END':
+            continue
+        cards.append(pyfits.Card.fromstring(line[:80]))
+    return cards
+
+
+class mef_writer:
+    """ Write a multi-extension FITS file one extension at a time.
+
+    The primary header is written at creation, then each image extension
+    with add(data, header, cards): header (e.g. that of a single extension
+    file produced by swarp) gives the keywords of the extension, the
+    structural ones excepted, and cards (e.g. from read_exp) are added or
+    replace its values.  The file is written under a temporary name and
+    renamed at close, so that an incomplete file is never left in place.
+
+    Usage:
+        with mef_writer(out, primary_header) as mef:
+            for ext in exts:
+                mef.add(data, header, read_exp(expfile))
+    """
+
+    struct_keys = ['SIMPLE', 'EXTEND', 'XTENSION', 'BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT',
+                   'BZERO', 'BSCALE', 'BLANK', 'CHECKSUM', 'DATASUM']
+    bitpix = {'uint8': 8, 'int16': 16, 'int32': 32, 'int64': 64, 'float32': -32, 'float64': -64}
+
+    def __init__(self, filename, header=None):
+        self.filename = filename
+        self.tmpname = filename + '.tmp%i' % os.getpid()
+        self.file = open(self.tmpname, 'wb')
+        self.next = 0
+        hd = pyfits.PrimaryHDU().header
+        hd['EXTEND'] = True
+        if header is not None:
+            self.copy_cards(header, hd)
+        self.write_header(hd)
+
+    def copy_cards(self, header, hd):
+        for card in header.cards:
+            key = card.keyword
+            if key in self.struct_keys or key.startswith('NAXIS'):
+                continue
+            if key == 'HISTORY':
+                hd.add_history(card.value)
+            elif key in ('COMMENT', ''):
+                hd.add_comment(card.value)
+            else:
+                hd[key] = (card.value, card.comment)
+
+    def write_header(self, hd):
+        self.file.write(hd.tostring(sep='', endcard=True, padding=True).encode('ascii'))
+
+    def add(self, data, header=None, cards=[]):
+        """ Append an image extension """
+        data = numpy.asarray(data)
+        if data.dtype == bool:
+            data = data.astype(numpy.uint8)
+        if data.dtype.name not in self.bitpix:
+            raise ValueError("mef_writer: data type %s not supported" % data.dtype)
+        hd = pyfits.Header()
+        hd['XTENSION'] = ('IMAGE', 'Image extension')
+        hd['BITPIX'] = self.bitpix[data.dtype.name]
+        hd['NAXIS'] = data.ndim
+        for n in range(data.ndim):
+            hd['NAXIS%i' % (n + 1)] = data.shape[data.ndim - 1 - n]
+        hd['PCOUNT'] = 0
+        hd['GCOUNT'] = 1
+        if header is not None:
+            self.copy_cards(header, hd)
+        for card in cards:
+            hd[card.keyword] = (card.value, card.comment)
+        self.write_header(hd)
+
+        data.astype(data.dtype.newbyteorder('>'), copy=False).tofile(self.file)
+        nbytes = data.size * data.dtype.itemsize
+        if nbytes % 2880:
+            self.file.write(b'\0' * (2880 - nbytes % 2880))
+        self.next += 1
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        os.rename(self.tmpname, self.filename)
+
+    def abort(self):
+        self.file.close()
+        self.file = None
+        os.remove(self.tmpname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def merge_mef(root, exts, out, header=None, split_suffix='.%01d.fits', exp_suffix=None):
+    """ Merge the single extension files root+split_suffix%ext into the MEF
+    out, with the primary header header, and, if exp_suffix is given, the
+    cards of the root+'.%i'+exp_suffix files, as missfits -OUTFILE_TYPE MULTI
+    does.  The single extension files are not removed. """
+    with mef_writer(out, header) as mef:
+        for ext in exts:
+            with pyfits.open(root + split_suffix % ext, memmap=True) as pi:
+                cards = []
+                if exp_suffix is not None:
+                    cards = read_exp(root + ('.%i' % ext) + exp_suffix)
+                mef.add(pi[0].data, pi[0].header, cards)
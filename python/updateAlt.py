@@ -13,6 +13,7 @@
  - it is assumed that all images have 16 extensions
  - removed superfluous checks
  06-07-18, AMo: changed to updateWeights: just update the weight file. 
+ Oct.18: chips processed in parallel (-T threads)
 
 --------------------------------------------------------------------
 '''
@@ -21,9 +22,12 @@ import os, sys
 import numpy as np
 import astropy.io.fits as fits
 from optparse import OptionParser
+from mask_lib import bitmask
+from parallel_lib import chip_map
 
 parser = OptionParser()
 parser.add_option('-l', '--list', dest='imlist', help='list of fits sub files', type='string', default='')
+parser.add_option('-T', '--n-thread', dest='nproc', help='Number of chips processed in parallel (def: 1)', type='int', default=1)
 
 try:
     opts,args = parser.parse_args(sys.argv[1:])
@@ -32,6 +36,13 @@ except:
     sys.exit(1);
 
 
+def mask_chip(item):
+    """ Set to 0 the weights of the pixels without sky; returns their number """
+    (cnt, wgt) = item
+    cnt = bitmask.from_array(cnt)     # pixels with a sky
+    cnt.apply(wgt)
+    return cnt.size - cnt.count()
+
 file = open(opts.imlist, 'r')
 lines = file.readlines()
 file.close()
@@ -51,12 +62,7 @@ for line in lines:
     else:
         ww = fits.open(wgt, mode="update")
         
-        tot=0
-        for i in range(1,n_ext):
-            zz = np.nonzero(ss[i].data == 0)
-            tot += len(zz[0])
-            #print ">> ext %i, npix %i"%(i, len(zz[0]))
-            ww[i].data[zz] = 0
+        tot = sum(chip_map(mask_chip, [(ss[i].data, ww[i].data) for i in range(1,n_ext)], opts.nproc))
         
         ww[0].header['history'] = "# weights updated based on %s"%sky
         ww.close(output_verify='silentfix+ignore')
@@ -14,9 +14,11 @@ import math
 import numpy as np
 import astropy.io.fits as pyfits
 from optparse import OptionParser
+from mask_lib import read_bitmasks
 
 parser = OptionParser()
 parser.add_option('-l', '--list',   dest='flist',  help='List of images', type='string', default="")
+parser.add_option('-T', '--n-thread', dest='nproc', help='Number of chips read in parallel (def: 1)', type='int', default=1)
 
 # Parse command line
 try:
@@ -32,18 +34,11 @@ file.close()
 
 for line in lines:
     ima  = line.split()[0]
-    pima = pyfits.open(ima)
+    fr = [m.fraction() for m in read_bitmasks(ima, nproc=opts.nproc)]
 
-    n_ext = len(pima)
-    if n_ext == 1:
-        fr = np.mean(pima[0].data)
-        print "%-22s  %0.2f "%(ima.split('.')[0], 100*fr)
+    if len(fr) == 1:
+        print "%-22s  %0.2f "%(ima.split('.')[0], 100*fr[0])
     else:
-        fr = []
-        for i in range(1,n_ext):
-            fr.append(np.mean(pima[i].data))
         print "%-20s"%ima.split('.')[0], ' '.join(["%5.2f"%x for x in fr])
-    
-    pima.close()
 
 exit(0)